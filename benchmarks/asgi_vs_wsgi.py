@@ -0,0 +1,246 @@
+"""
+Compares the ASGI serving mode with the WSGI app under many concurrent
+clients. Both apps are driven in-process against the same seeded SQLite
+database so that the numbers only reflect the serving model:
+
+* reads: every client repeatedly fetches area and event items. The WSGI side
+  uses one thread per client, like a threaded WSGI server holding one
+  connection per thread; the ASGI side uses one coroutine per client.
+* streams: a number of update stream subscribers is held open and a single
+  change is published to all of them. Reports the threads needed, the memory
+  grown and the time until every subscriber received the change.
+
+Run from the repository root:
+
+    python benchmarks/asgi_vs_wsgi.py --clients 500 --streams 2000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.getcwd())
+
+from werkzeug.test import EnvironBuilder
+from nearbyEvents import create_app, db
+from nearbyEvents.asgi import NearbyEventsASGI
+from nearbyEvents.models import Area, Country, Event
+
+
+def rss_kb():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def seed(app, areas, events_per_area):
+    with app.app_context():
+        db.create_all()
+        db.session.add(Country(country="Finland", currency="EUR"))
+        for i in range(areas):
+            area = Area(name="area-{}".format(i))
+            db.session.add(area)
+            for j in range(events_per_area):
+                event = Event(
+                    name="event-{}-{}".format(i, j),
+                    max_tickets=100,
+                    ticket_price=10,
+                    status="On sale",
+                    event_begin="2021-06-01 18:00:00"
+                )
+                event.in_area = area
+                db.session.add(event)
+        db.session.commit()
+
+
+def paths(areas, events_per_area, count):
+    for n in range(count):
+        i = n % areas
+        if n % 2:
+            yield "/api/areas/area-{}/".format(i)
+        else:
+            yield "/api/events/event-{}-{}/".format(i, n % events_per_area)
+
+
+def report(name, latencies, elapsed):
+    print("{:>5}: {:8.0f} req/s  p50 {:7.2f} ms  p99 {:7.2f} ms".format(
+        name, len(latencies) / elapsed,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000
+    ))
+
+
+def bench_wsgi_reads(app, args):
+    latencies = []
+
+    def client(number):
+        own = []
+        for path in paths(args.areas, args.events, args.requests):
+            environ = EnvironBuilder(path=path).get_environ()
+            start = time.perf_counter()
+            body = b"".join(app(environ, lambda status, headers, exc_info=None: None))
+            own.append(time.perf_counter() - start)
+        latencies.extend(own)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as executor:
+        list(executor.map(client, range(args.clients)))
+    report("wsgi", latencies, time.perf_counter() - start)
+
+
+async def asgi_get(asgi_app, path):
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "root_path": "", "query_string": b"",
+        "headers": [], "server": ("localhost", 80), "client": ("127.0.0.1", 1),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await asgi_app(scope, receive, send)
+
+
+def bench_asgi_reads(asgi_app, args):
+    latencies = []
+
+    async def client(number):
+        for path in paths(args.areas, args.events, args.requests):
+            start = time.perf_counter()
+            await asgi_get(asgi_app, path)
+            latencies.append(time.perf_counter() - start)
+
+    async def main():
+        await asyncio.gather(*(client(n) for n in range(args.clients)))
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    report("asgi", latencies, time.perf_counter() - start)
+
+
+def bench_wsgi_streams(app, args):
+    before_rss, before_threads = rss_kb(), threading.active_count()
+    received = threading.Semaphore(0)
+    stop = threading.Event()
+
+    def subscriber(number):
+        environ = EnvironBuilder(path="/api/updates/").get_environ()
+        for chunk in app(environ, lambda status, headers, exc_info=None: None):
+            if b"event: area" in chunk:
+                received.release()
+            if stop.is_set():
+                break
+
+    threads = [threading.Thread(target=subscriber, args=(n,), daemon=True) for n in range(args.streams)]
+    for thread in threads:
+        thread.start()
+    broker = app.extensions["nearby_changes"]
+    while broker.subscriber_count < args.streams:
+        time.sleep(0.01)
+    grown_rss, threads_used = rss_kb() - before_rss, threading.active_count() - before_threads
+    start = time.perf_counter()
+    broker.publish({"type": "area", "action": "updated", "name": "area-0"})
+    for n in range(args.streams):
+        received.acquire()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for thread in threads:
+        thread.join()
+    print(" wsgi: {} streams  {} threads  +{} kB RSS  fan-out {:.1f} ms".format(
+        args.streams, threads_used, grown_rss, elapsed * 1000
+    ))
+
+
+def bench_asgi_streams(asgi_app, args):
+    broker = asgi_app.flask_app.extensions["nearby_changes"]
+
+    async def main():
+        before_rss, before_threads = rss_kb(), threading.active_count()
+        disconnect = asyncio.Event()
+        received = asyncio.Semaphore(0)
+
+        async def subscriber(number):
+            scope = {
+                "type": "http", "http_version": "1.1", "method": "GET",
+                "scheme": "http", "path": "/api/updates/", "root_path": "",
+                "query_string": b"", "headers": [],
+                "server": ("localhost", 80), "client": ("127.0.0.1", 1),
+            }
+
+            async def receive():
+                await disconnect.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                if b"event: area" in message.get("body", b""):
+                    received.release()
+
+            await asgi_app(scope, receive, send)
+
+        tasks = [asyncio.ensure_future(subscriber(n)) for n in range(args.streams)]
+        while broker.subscriber_count < args.streams:
+            await asyncio.sleep(0.01)
+        grown_rss, threads_used = rss_kb() - before_rss, threading.active_count() - before_threads
+        start = time.perf_counter()
+        broker.publish({"type": "area", "action": "updated", "name": "area-0"})
+        for n in range(args.streams):
+            await received.acquire()
+        elapsed = time.perf_counter() - start
+        disconnect.set()
+        await asyncio.gather(*tasks)
+        print(" asgi: {} streams  {} threads  +{} kB RSS  fan-out {:.1f} ms".format(
+            args.streams, threads_used, grown_rss, elapsed * 1000
+        ))
+
+    asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=20, help="requests per client")
+    parser.add_argument("--streams", type=int, default=1000)
+    parser.add_argument("--areas", type=int, default=100)
+    parser.add_argument("--events", type=int, default=20, help="events per area")
+    args = parser.parse_args()
+
+    db_fd, db_fname = tempfile.mkstemp()
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "SSE_KEEPALIVE": 1,
+    }
+    try:
+        app = create_app(config)
+        seed(app, args.areas, args.events)
+        asgi_app = NearbyEventsASGI(app)
+        print("{} concurrent clients x {} item GETs".format(args.clients, args.requests))
+        bench_wsgi_reads(app, args)
+        bench_asgi_reads(asgi_app, args)
+        print("{} concurrent update streams".format(args.streams))
+        bench_wsgi_streams(app, args)
+        bench_asgi_streams(asgi_app, args)
+        asgi_app.shutdown()
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+"""
+Load generator for the API. Drives either a running server (--url, for
+example a local flask serve) or the app in-process through Flask test
+clients against a freshly seeded SQLite database (the default), with a
+traffic mix or a recorded capture.
+
+Traffic mix (--mix, weights in percent):
+
+* item:   GET of an area or event item, names drawn from a Zipf
+          distribution (--zipf) over the catalogue, so a few hot items get
+          most of the reads
+* scan:   GET of the area or event collection
+* byarea: GET of one page of a Zipf-chosen area's events
+* post:   POST of a new event
+* put:    PUT changing the status of a Zipf-chosen event
+* burst:  a burst of --burst-size concurrent PUTs on the hottest event, the
+          write pattern of a sale opening (the API has no booking endpoint)
+
+The catalogue is read from the target's collections before the run. With
+--concurrency 1,2,4,... the load runs for --duration seconds at each level
+and a throughput and latency curve is printed; the saturation point is the
+first level after which throughput grows by less than 5%. --output writes
+the curve as JSON.
+
+Replay (--replay capture.jsonl) sends recorded requests instead, one JSON
+object per line with "method", "path" and optionally "json", "headers" and
+"t" (seconds from the start of the capture, honoured when --speed is set,
+scaled by it). Lines without method and path are skipped.
+
+Run from the repository root:
+
+    python benchmarks/loadtest.py --concurrency 1,4,16,64 --duration 10
+    python benchmarks/loadtest.py --url http://127.0.0.1:5000 --token <JWT>
+    python benchmarks/loadtest.py --replay capture.jsonl --speed 1
+"""
+import argparse
+import bisect
+import http.client
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+
+sys.path.append(os.getcwd())
+
+DEFAULT_MIX = "item=80,scan=4,byarea=6,post=4,put=4,burst=2"
+AREA_ID = re.compile(r"/areas/id/(\d+)/")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class HttpTarget(object):
+    """
+    Sends requests to a server, keeping a connection per thread.
+    """
+
+    def __init__(self, url, headers):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.headers = headers
+        self._local = threading.local()
+
+    def request(self, method, path, document=None, headers=None):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        all_headers = dict(self.headers, **(headers or {}))
+        body = None
+        if document is not None:
+            body = json.dumps(document)
+            all_headers["Content-Type"] = "application/json"
+        try:
+            connection.request(method, path, body, all_headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self._local.connection = None
+            return 599, b""
+        return response.status, data
+
+
+class AppTarget(object):
+    """
+    Sends requests to the app in-process, a test client per thread.
+    """
+
+    def __init__(self, app, headers):
+        self.app = app
+        self.headers = headers
+        self._local = threading.local()
+
+    def request(self, method, path, document=None, headers=None):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=document,
+            headers=dict(self.headers, **(headers or {}))
+        )
+        return response.status_code, response.get_data()
+
+
+def seeded_app(areas, events_per_area):
+    from nearbyEvents import create_app, db
+    from nearbyEvents.models import Area, Country, Event
+
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    })
+    with app.app_context():
+        db.create_all()
+        db.session.add(Country(country="Finland", currency="EUR"))
+        db.session.flush()
+        db.session.execute(Area.__table__.insert(), [
+            {"name": "area-{}".format(i)} for i in range(areas)
+        ])
+        area_ids = [row[0] for row in db.session.query(Area.id).order_by(Area.id)]
+        db.session.execute(Event.__table__.insert(), [
+            {
+                "name": "event-{}-{}".format(i, j), "max_tickets": 100, "ticket_price": 10,
+                "status": "On sale", "event_begin": "2021.06.01", "area_id": area_id,
+                "tickets_sold": 0, "revenue": 0
+            }
+            for i, area_id in enumerate(area_ids) for j in range(events_per_area)
+        ])
+        db.session.commit()
+        db.session.remove()
+    return app, db_fd, db_fname
+
+
+class Zipf(object):
+    """
+    Zipf distribution over ranks 0..size-1 with exponent s.
+    """
+
+    def __init__(self, size, s):
+        self.cumulative = list(itertools.accumulate(1 / (rank ** s) for rank in range(1, size + 1)))
+
+    def sample(self, rng):
+        return bisect.bisect(self.cumulative, rng.random() * self.cumulative[-1])
+
+
+class Catalogue(object):
+    """
+    Names of the target's areas and events, hottest first.
+    """
+
+    def __init__(self, target):
+        status, body = target.request("GET", "/api/areas/")
+        areas = json.loads(body)["items"]
+        self.area_names = {item["id"]: item["name"] for item in areas}
+        self.areas = [item["name"] for item in areas]
+        status, body = target.request("GET", "/api/events/")
+        self.events = []
+        for item in json.loads(body)["items"]:
+            href = item.get("@controls", {}).get("nearby:area", {}).get("href", "")
+            match = AREA_ID.search(href)
+            area = self.area_names.get(int(match.group(1))) if match else None
+            if area is not None:
+                self.events.append((item["name"], area))
+        if not self.areas or not self.events:
+            raise SystemExit("The target has no areas or events to load")
+
+
+class TrafficMix(object):
+    """
+    Draws requests of the configured mix. Each request is a list of
+    (kind, method, path, document) sent concurrently, a burst has several.
+    """
+
+    def __init__(self, catalogue, weights, zipf_s, burst_size):
+        self.catalogue = catalogue
+        self.kinds = list(weights)
+        self.cumulative = list(itertools.accumulate(weights.values()))
+        self.area_ranks = Zipf(len(catalogue.areas), zipf_s)
+        self.event_ranks = Zipf(len(catalogue.events), zipf_s)
+        self.burst_size = burst_size
+        self._created = itertools.count()
+
+    def _event_document(self, name, area, status):
+        return {
+            "name": name, "max_tickets": 100, "ticket_price": 10,
+            "status": status, "event_begin": "2021.06.01", "area_name": area
+        }
+
+    def draw(self, rng):
+        kind = self.kinds[bisect.bisect(self.cumulative, rng.random() * self.cumulative[-1])]
+        quote = urllib.parse.quote
+        if kind == "item":
+            if rng.random() < 0.5:
+                area = self.catalogue.areas[self.area_ranks.sample(rng)]
+                return [(kind, "GET", "/api/areas/{}/".format(quote(area)), None)]
+            event = self.catalogue.events[self.event_ranks.sample(rng)][0]
+            return [(kind, "GET", "/api/events/{}/".format(quote(event)), None)]
+        if kind == "scan":
+            return [(kind, "GET", rng.choice(["/api/areas/", "/api/events/"]), None)]
+        if kind == "byarea":
+            area = self.catalogue.areas[self.area_ranks.sample(rng)]
+            return [(kind, "GET", "/api/areas/{}/events/?limit=50".format(quote(area)), None)]
+        if kind == "post":
+            area = self.catalogue.areas[self.area_ranks.sample(rng)]
+            name = "load-{}-{}-{}".format(os.getpid(), threading.get_ident(), next(self._created))
+            return [(kind, "POST", "/api/events/", self._event_document(name, area, "On sale"))]
+        if kind == "put":
+            event, area = self.catalogue.events[self.event_ranks.sample(rng)]
+            document = self._event_document(event, area, rng.choice(["On sale", "Sold out"]))
+            return [(kind, "PUT", "/api/events/{}/".format(quote(event)), document)]
+        event, area = self.catalogue.events[0]
+        return [
+            (kind, "PUT", "/api/events/{}/".format(quote(event)),
+                self._event_document(event, area, "Sold out" if i % 2 else "On sale"))
+            for i in range(self.burst_size)
+        ]
+
+
+class Results(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = Counter()
+
+    def record(self, kind, status, seconds):
+        with self._lock:
+            self.latencies[kind].append(seconds)
+            self.statuses[status] += 1
+
+    def all_latencies(self):
+        return [value for values in self.latencies.values() for value in values]
+
+    def summary(self, elapsed):
+        latencies = self.all_latencies()
+        return {
+            "requests": len(latencies),
+            "throughput": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+            "p90_ms": percentile(latencies, 0.9) * 1000 if latencies else None,
+            "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+            "statuses": dict(self.statuses),
+            "by_kind": {
+                kind: {"requests": len(values), "p99_ms": percentile(values, 0.99) * 1000}
+                for kind, values in sorted(self.latencies.items())
+            },
+        }
+
+
+def _send(target, results, kind, method, path, document, headers=None):
+    start = time.perf_counter()
+    status, body = target.request(method, path, document, headers)
+    results.record(kind, status, time.perf_counter() - start)
+
+
+def run_mix(target, mix, concurrency, duration, seed):
+    results = Results()
+    deadline = time.monotonic() + duration
+
+    def worker(number):
+        rng = random.Random(seed * 1000 + number)
+        while time.monotonic() < deadline:
+            requests = mix.draw(rng)
+            if len(requests) == 1:
+                _send(target, results, *requests[0])
+                continue
+            threads = [threading.Thread(target=_send, args=(target, results) + request) for request in requests]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results.summary(time.perf_counter() - start)
+
+
+def read_capture(path):
+    requests, skipped = [], 0
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if not isinstance(record, dict) or "method" not in record or "path" not in record:
+                skipped += 1
+                continue
+            requests.append(record)
+    return requests, skipped
+
+
+def run_replay(target, requests, concurrency, speed):
+    results = Results()
+    queue = iter(requests)
+    lock = threading.Lock()
+    started = time.monotonic()
+    first = requests[0].get("t", 0) if requests else 0
+
+    def worker():
+        while True:
+            with lock:
+                record = next(queue, None)
+            if record is None:
+                return
+            if speed and "t" in record:
+                delay = (record["t"] - first) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            _send(target, results, "replay", record["method"].upper(), record["path"],
+                record.get("json"), record.get("headers")
+            )
+
+    threads = [threading.Thread(target=worker) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results.summary(time.monotonic() - started)
+
+
+def report(concurrency, summary):
+    print("{:>5} clients {:8.0f} req/s  p50 {:7.2f} ms  p90 {:7.2f} ms  p99 {:7.2f} ms  {}".format(
+        concurrency, summary["throughput"], summary["p50_ms"] or 0, summary["p90_ms"] or 0,
+        summary["p99_ms"] or 0, summary["statuses"]
+    ))
+
+
+def saturation(curve):
+    """
+    Returns the first level after which throughput grows by less than 5%.
+    """
+
+    for previous, current in zip(curve, curve[1:]):
+        if current["throughput"] < previous["throughput"] * 1.05:
+            return previous
+    return curve[-1]
+
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("item", "scan", "byarea", "post", "put", "burst"):
+            raise argparse.ArgumentTypeError("unknown kind {}".format(kind))
+        weights[kind] = float(weight)
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="server to load, the app is run in-process when not given")
+    parser.add_argument("--token", help="JWT sent with every request")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of the name popularity")
+    parser.add_argument("--burst-size", type=int, default=20)
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per concurrency level")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--areas", type=int, default=100, help="areas of the in-process database")
+    parser.add_argument("--events", type=int, default=20, help="events per area of the in-process database")
+    parser.add_argument("--replay", help="JSONL capture to replay instead of the mix")
+    parser.add_argument("--speed", type=float, default=None, help="replay at the capture's pace times SPEED")
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    headers = {"Authorization": "Bearer " + args.token} if args.token else {}
+    levels = [int(level) for level in args.concurrency.split(",")]
+    cleanup = None
+    if args.url:
+        target = HttpTarget(args.url, headers)
+    else:
+        app, db_fd, db_fname = seeded_app(args.areas, args.events)
+        cleanup = (db_fd, db_fname)
+        target = AppTarget(app, headers)
+    try:
+        if args.replay:
+            requests, skipped = read_capture(args.replay)
+            print("Replaying {} requests ({} lines skipped)".format(len(requests), skipped))
+            summary = run_replay(target, requests, levels[-1], args.speed)
+            report(levels[-1], summary)
+            results = {"replay": summary}
+        else:
+            mix = TrafficMix(Catalogue(target), args.mix, args.zipf, args.burst_size)
+            curve = []
+            for level in levels:
+                summary = run_mix(target, mix, level, args.duration, args.seed)
+                summary["concurrency"] = level
+                curve.append(summary)
+                report(level, summary)
+            saturated = saturation(curve)
+            print("Saturation at {} clients, {:.0f} req/s".format(
+                saturated["concurrency"], saturated["throughput"]
+            ))
+            results = {"curve": curve, "saturation": saturated["concurrency"]}
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if cleanup is not None:
+            os.close(cleanup[0])
+            os.unlink(cleanup[1])
+
+
+if __name__ == "__main__":
+    main()
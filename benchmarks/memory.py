@@ -0,0 +1,149 @@
+"""
+Memory footprint of the collection endpoints. Seeds a large SQLite database,
+then requests /api/events/ and /api/areas/ repeatedly through the WSGI app
+and reports for each endpoint:
+
+* the peak RSS of the process after the requests,
+* the peak traced allocation of a single request and its ratio to the size
+  of the response (tracemalloc),
+* the memory still allocated after the requests compared to after the first
+  one, which grows when something keeps request state alive,
+* the NearbyEventsBuilder, Event and Area objects still alive after the
+  requests and the size of the session's identity map.
+
+With the limits given, exits with status 1 if any of them is exceeded, so it
+can gate a CI job:
+
+    python benchmarks/memory.py --areas 1000 --events-per-area 100 \\
+        --requests 20 --max-ratio 40 --max-growth-kb 512
+"""
+import argparse
+import gc
+import os
+import resource
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.append(os.getcwd())
+
+from nearbyEvents import create_app, db
+from nearbyEvents.models import Area, Country, Event
+from nearbyEvents.utils import NearbyEventsBuilder
+
+
+def seed(app, areas, events_per_area):
+    with app.app_context():
+        db.create_all()
+        db.session.add(Country(country="Finland", currency="EUR"))
+        db.session.flush()
+        db.session.execute(Area.__table__.insert(), [
+            {"name": "area-{}".format(i)} for i in range(areas)
+        ])
+        area_ids = [row[0] for row in db.session.query(Area.id).order_by(Area.id)]
+        db.session.execute(Event.__table__.insert(), [
+            {
+                "name": "event-{}-{}".format(i, j), "max_tickets": 100, "ticket_price": 10,
+                "status": "On sale", "event_begin": "2021.06.01", "area_id": area_id,
+                "tickets_sold": 0, "revenue": 0
+            }
+            for i, area_id in enumerate(area_ids) for j in range(events_per_area)
+        ])
+        db.session.commit()
+
+
+def live_objects():
+    gc.collect()
+    counts = dict.fromkeys((NearbyEventsBuilder, Event, Area), 0)
+    for obj in gc.get_objects():
+        if type(obj) in counts:
+            counts[type(obj)] += 1
+    return {cls.__name__: count for cls, count in counts.items()}
+
+
+def measure(app, path, requests):
+    """
+    Requests path the given number of times and returns the measurements.
+    """
+
+    client = app.test_client()
+    tracemalloc.start()
+    try:
+        size = len(client.get(path).data)
+        gc.collect()
+        baseline, _ = tracemalloc.get_traced_memory()
+        peak = 0
+        for i in range(requests):
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+            response = client.get(path)
+            assert response.status_code == 200
+            response.close()
+            del response
+            current, request_peak = tracemalloc.get_traced_memory()
+            peak = max(peak, request_peak - start)
+        gc.collect()
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    with app.app_context():
+        identity_map = len(db.session.identity_map)
+        db.session.remove()
+    return {
+        "response_kb": size / 1024,
+        "peak_kb": peak / 1024,
+        "ratio": peak / size,
+        "growth_kb": (retained - baseline) / 1024,
+        "identity_map": identity_map,
+        "live": live_objects(),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--areas", type=int, default=1000)
+    parser.add_argument("--events-per-area", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--max-ratio", type=float, default=None,
+        help="Largest allowed peak allocation per request as a multiple of the response size")
+    parser.add_argument("--max-growth-kb", type=float, default=None,
+        help="Largest allowed growth of allocated memory over the requests")
+    parser.add_argument("--max-rss-mb", type=float, default=None)
+    args = parser.parse_args()
+
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "LAZY_INIT": True,
+    })
+    failures = []
+    try:
+        seed(app, args.areas, args.events_per_area)
+        for path in ("/api/events/", "/api/areas/"):
+            result = measure(app, path, args.requests)
+            print("{:14} response {:9.0f} KB  peak/request {:9.0f} KB ({:4.1f}x)  "
+                "growth {:7.1f} KB  identity map {}  live {}  max RSS {:.0f} MB".format(
+                path, result["response_kb"], result["peak_kb"], result["ratio"],
+                result["growth_kb"], result["identity_map"], result["live"],
+                result["max_rss_kb"] / 1024
+            ))
+            if args.max_ratio is not None and result["ratio"] > args.max_ratio:
+                failures.append("{} allocates {:.1f}x its response".format(path, result["ratio"]))
+            if args.max_growth_kb is not None and result["growth_kb"] > args.max_growth_kb:
+                failures.append("{} retained {:.1f} KB".format(path, result["growth_kb"]))
+            if args.max_rss_mb is not None and result["max_rss_kb"] / 1024 > args.max_rss_mb:
+                failures.append("max RSS {:.0f} MB".format(result["max_rss_kb"] / 1024))
+            if any(result["live"].values()) or result["identity_map"]:
+                failures.append("{} left objects alive: {}".format(path, result["live"]))
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+    for failure in failures:
+        print("FAIL:", failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,9 @@
 import os
-from flask import Flask
-from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, jsonify
 from nearbyEvents.constants import *
+from nearbyEvents.routing import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 app = None
 # Based on http://flask.pocoo.org/docs/1.0/tutorial/factory/#the-application-factory
 # Modified for Flask SQLAlchemy
@@ -20,17 +19,183 @@ def create_app(test_config=None):
     )
     else:
         app.config.from_mapping(test_config)
+    # Bounded per-subscriber buffer and keep-alive interval of the update stream
+    app.config.setdefault("SSE_BUFFER_SIZE", 100)
+    app.config.setdefault("SSE_KEEPALIVE", 15)
+    # Thread pools of the ASGI serving mode, see nearbyEvents.asgi
+    app.config.setdefault("ASGI_DB_THREADS", 8)
+    app.config.setdefault("ASGI_WSGI_THREADS", 16)
+    # Lifetime in seconds and maximum number of stored idempotency keys
+    app.config.setdefault("IDEMPOTENCY_TTL", 24 * 60 * 60)
+    app.config.setdefault("IDEMPOTENCY_MAX_KEYS", 100000)
+    # Unpaid reservations are released after RESERVATION_HOLD_TTL seconds by a
+    # sweep every RESERVATION_SWEEP_INTERVAL seconds (disabled when None)
+    app.config.setdefault("RESERVATION_HOLD_TTL", 15 * 60)
+    app.config.setdefault("RESERVATION_SWEEP_INTERVAL", None)
+    app.config.setdefault("RESERVATION_SWEEP_BATCH", 500)
+    # File locked by the one process that sweeps, defaults to the instance folder
+    app.config.setdefault("RESERVATION_SWEEP_LOCK", None)
+    # Seconds a loaded statistics snapshot is reused, see nearbyEvents.analytics
+    app.config.setdefault("STATS_SNAPSHOT_TTL", 60)
+    # Directory of the files that tell the server workers to drop their
+    # catalogue caches, defaults to the instance folder
+    app.config.setdefault("CATALOGUE_EPOCH_DIR", None)
+    # Bloom filters of area and event names answering requests for unknown
+    # names, see nearbyEvents.bloom
+    app.config.setdefault("NAME_FILTER_ERROR_RATE", 0.01)
+    app.config.setdefault("NAME_FILTER_REBUILD_INTERVAL", 5)
+    # Default and largest number of events per page of an area's events
+    app.config.setdefault("EVENTS_PAGE_SIZE", 100)
+    app.config.setdefault("EVENTS_MAX_PAGE_SIZE", 1000)
+    # Months of the area calendars counted on every request from the current
+    # one, later and earlier months are cached, see nearbyEvents.calendar
+    app.config.setdefault("CALENDAR_LIVE_MONTHS", 2)
+    app.config.setdefault("CALENDAR_CACHE_TTL", 300)
+    app.config.setdefault("CALENDAR_CACHE_SIZE", 10000)
+    # Count item requests in a decaying count-min sketch shared by the
+    # workers and keep the POPULARITY_TOP_K hottest, see
+    # nearbyEvents.popularity. POPULARITY_FILE defaults to the instance folder.
+    app.config.setdefault("POPULARITY_TRACKING", True)
+    app.config.setdefault("POPULARITY_SKETCH_WIDTH", 2048)
+    app.config.setdefault("POPULARITY_SKETCH_DEPTH", 4)
+    app.config.setdefault("POPULARITY_TOP_K", 100)
+    app.config.setdefault("POPULARITY_DECAY_INTERVAL", 60)
+    app.config.setdefault("POPULARITY_FILE", None)
+    # Cache rendered area and event items and render the ITEM_CACHE_WARM
+    # hottest ahead of requests, see nearbyEvents.itemcache
+    app.config.setdefault("ITEM_CACHE", False)
+    app.config.setdefault("ITEM_CACHE_SIZE", 10000)
+    app.config.setdefault("ITEM_CACHE_WARM", 20)
+    # Commit the writes of concurrent PUT requests together, waiting at most
+    # GROUP_COMMIT_WINDOW seconds for a batch, see nearbyEvents.groupcommit
+    app.config.setdefault("GROUP_COMMIT", False)
+    app.config.setdefault("GROUP_COMMIT_WINDOW", 0.002)
+    app.config.setdefault("GROUP_COMMIT_MAX_BATCH", 100)
+    # URIs of read-only replicas serving GET requests, and seconds a client
+    # keeps reading from the primary after a write, see nearbyEvents.routing
+    app.config.setdefault("READ_REPLICAS", [])
+    app.config.setdefault("READ_REPLICA_STICKY_SECONDS", 5)
+    # Connection pools of the primary database and the replicas, see
+    # nearbyEvents.pool. Without DB_POOL_SIZE the driver defaults are kept.
+    app.config.setdefault("DB_POOL_SIZE", None)
+    app.config.setdefault("DB_POOL_MAX_OVERFLOW", 10)
+    app.config.setdefault("DB_POOL_TIMEOUT", 30)
+    app.config.setdefault("DB_POOL_RECYCLE", None)
+    app.config.setdefault("DB_POOL_PRE_PING", False)
+    app.config.setdefault("DB_POOL_SLOW_CHECKOUT", 0.1)
+    # Run the sessions of GET requests without a transaction
+    app.config.setdefault("READ_ONLY_AUTOCOMMIT", False)
+    # Per-client token buckets of each route, (tokens per second, burst) by
+    # endpoint or priority, and the load at which requests are shed, see
+    # nearbyEvents.limits
+    app.config.setdefault("RATE_LIMIT", False)
+    app.config.setdefault("RATE_LIMITS", {"write": (10, 20), "read": (20, 50), "scan": (2, 10)})
+    app.config.setdefault("RATE_LIMIT_SLOTS", 65536)
+    app.config.setdefault("SHED_MAX_INFLIGHT", None)
+    app.config.setdefault("SHED_DB_LATENCY", None)
+    # Require a JWT signed with one of JWT_KEYS (key id -> key) for POST, PUT
+    # and DELETE, see nearbyEvents.auth
+    app.config.setdefault("JWT_REQUIRED", False)
+    app.config.setdefault("JWT_KEYS", None)
+    app.config.setdefault("JWT_ALGORITHM", "HS256")
+    app.config.setdefault("JWT_CACHE_SIZE", 10000)
+    app.config.setdefault("JWT_LEEWAY", 0)
+    # Profile requests carrying PROFILE_KEY in the X-Profile header or the
+    # profile query parameter, and a PROFILE_SAMPLE_RATE share of all
+    # requests, see nearbyEvents.profiling
+    app.config.setdefault("PROFILE_KEY", None)
+    app.config.setdefault("PROFILE_SAMPLE_RATE", 0.0)
+    app.config.setdefault("PROFILE_DIR", None)
+    app.config.setdefault("PROFILE_MAX_FILES", 100)
+    # Export request traces to a JSON lines file and/or a Zipkin compatible
+    # collector, see nearbyEvents.tracing
+    app.config.setdefault("TRACE_FILE", None)
+    app.config.setdefault("TRACE_COLLECTOR", None)
+    app.config.setdefault("TRACE_SAMPLE_RATE", 1.0)
+    app.config.setdefault("TRACE_SERVICE_NAME", "nearbyEvents")
+    app.config.setdefault("TRACE_QUEUE_SIZE", 10000)
+    # Online snapshots of the SQLite database, see nearbyEvents.backup.
+    # BACKUP_DIR defaults to the backups folder of the instance.
+    app.config.setdefault("BACKUP_DIR", None)
+    app.config.setdefault("BACKUP_KEEP", 10)
+    app.config.setdefault("BACKUP_STEP_PAGES", 1000)
+    app.config.setdefault("BACKUP_STEP_SLEEP", 0.005)
+    # Rows backfilled per transaction by migrateDatabase and the pause
+    # between the transactions, see nearbyEvents.migrations
+    app.config.setdefault("MIGRATION_CHUNK_SIZE", 5000)
+    app.config.setdefault("MIGRATION_CHUNK_SLEEP", 0.01)
+    # Defer initialization work to first use, see nearbyEvents.startup
+    app.config.setdefault("LAZY_INIT", False)
         
     try:
         os.makedirs(app.instance_path)
     except OSError:
         pass
+    from . import pool
+    pool.init_app(app)
     db.init_app(app)
     
     from . import models
     from . import api
-    app.cli.add_command(models.initializeDatabase)
-    app.cli.add_command(models.generateTestDatabase)
+    from . import startup
+    from . import sweeper
+    from . import aggregates
+    from . import areas
+    from . import bloom
+    from . import calendar
+    from . import itemcache
+    from . import groupcommit
+    from . import routing
+    from . import auth
+    from . import tracing
+    from .notifications import CatalogueEpochs, ChangeBroker
+    app.extensions["nearby_changes"] = ChangeBroker(app.config["SSE_BUFFER_SIZE"])
+    epochs = app.extensions["nearby_epochs"] = CatalogueEpochs(
+        app.config["CATALOGUE_EPOCH_DIR"] or app.instance_path
+    )
+    app.extensions["nearby_changes"].add_listener(epochs.on_change)
+    # Callables run by every server worker before it accepts traffic
+    app.extensions["nearby_warmup"] = []
+    app.extensions["nearby_sweeper"] = sweeper.SweepMetrics()
+    areas.init_app(app)
+    bloom.init_app(app)
+    calendar.init_app(app)
+    # The modules of features that are turned off are not imported
+    if app.config["POPULARITY_TRACKING"]:
+        from . import popularity
+        popularity.init_app(app)
+    itemcache.init_app(app)
+    groupcommit.init_app(app)
+    auth.init_app(app)
+    if app.config["PROFILE_KEY"] is not None or app.config["PROFILE_SAMPLE_RATE"]:
+        from . import profiling
+        profiling.init_app(app)
+    tracing.init_app(app)
+    # Before the other request hooks, rejected requests skip them
+    if app.config["RATE_LIMIT"]:
+        from . import limits
+        limits.init_app(app)
+    routing.init_app(app)
+    app.before_first_request(lambda: sweeper.start_sweeper(app))
+    # Commands and rarely used views import their modules when they run
+    app.cli = startup.LazyGroup(app.name, {
+        "initializeDatabase": "nearbyEvents.models:initializeDatabase",
+        "generateTestDatabase": "nearbyEvents.models:generateTestDatabase",
+        "serve": "nearbyEvents.server:serve",
+        "startupProfile": "nearbyEvents.startup:startupProfile",
+        "sweepReservations": "nearbyEvents.sweeper:sweepReservations",
+        "refreshAggregates": "nearbyEvents.aggregates:refreshAggregates",
+        "syncReplicas": "nearbyEvents.routing:syncReplicas",
+        "backupDatabase": "nearbyEvents.backup:backupDatabase",
+        "restoreDatabase": "nearbyEvents.backup:restoreDatabase",
+        "migrateDatabase": "nearbyEvents.migrations:migrateDatabase",
+    })
+    app.add_url_rule("/admin/backups/", "admin_backups",
+        auth.admin_required(startup.LazyView("nearbyEvents.backup:list_backups"))
+    )
+    app.add_url_rule("/admin/backups/", "admin_create_backup",
+        auth.admin_required(startup.LazyView("nearbyEvents.backup:create_backup")), methods=["POST"]
+    )
     app.register_blueprint(api.api_bp)
     
     @app.route(LINK_RELATIONS_URL)
@@ -44,7 +209,24 @@ def create_app(test_config=None):
     @app.route("/admin/")
     def admin_site():
         return app.send_static_file("html/admin.html")
+
+    @app.route("/admin/metrics/")
+    @auth.admin_required
+    def admin_metrics():
+        metrics = {
+            "pool": app.extensions["nearby_pool"].as_dict(),
+            "sweeper": app.extensions["nearby_sweeper"].as_dict(),
+        }
+        if "nearby_limiter" in app.extensions:
+            metrics["load"] = app.extensions["nearby_limiter"].monitor.as_dict()
+        if "nearby_item_cache" in app.extensions:
+            metrics["item_cache"] = app.extensions["nearby_item_cache"].as_dict()
+        if "nearby_group_commit" in app.extensions:
+            metrics["group_commit"] = app.extensions["nearby_group_commit"].metrics.as_dict()
+        return jsonify(metrics)
         
+    if not app.config["LAZY_INIT"]:
+        startup.preload(app)
     return app
 
 #app=create_app()
\ No newline at end of file
@@ -0,0 +1,244 @@
+"""
+Materialized ticket sales per event and per area. The counters on Event
+(tickets_sold, revenue) and Area (capacity, tickets_sold, revenue) are
+updated in the same transaction as the tickets, reservations and events they
+summarize, so reading them never needs to count tickets.
+
+Changes made through the ORM are picked up before every flush and written as
+relative updates (tickets_sold = tickets_sold + n), which stay correct when
+several requests sell tickets of the same event at once. Bulk deletes that
+bypass the ORM, like the reservation sweeper, call release_reservations.
+Both announce the changed areas and events to the change broker, so the
+cached responses that show the counters are dropped.
+"""
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import and_, event as sa_event, func, inspect, select
+from nearbyEvents import db
+from nearbyEvents.models import Area, Event, Reservation, Ticket
+from nearbyEvents.notifications import add_counter_changes, mark_counted
+
+areas = Area.__table__
+events = Event.__table__
+reservations = Reservation.__table__
+tickets = Ticket.__table__
+
+
+def _ticket_event(session, ticket):
+    reservation = ticket.in_reservation
+    if reservation is None and ticket.reservation_id is not None:
+        reservation = session.query(Reservation).get(ticket.reservation_id)
+    if reservation is None:
+        return None
+    event = reservation.for_event
+    if event is None and reservation.event_id is not None:
+        event = session.query(Event).get(reservation.event_id)
+    return event
+
+
+def _area_with_id(session, area_id):
+    if area_id is None:
+        return None
+    return session.query(Area).get(area_id)
+
+
+def _area_change(session, event):
+    """
+    Returns the areas an event moves from and to in this flush, or None if
+    its area does not change.
+    """
+
+    state = inspect(event)
+    column = state.attrs.area_id.history
+    relation = state.attrs.in_area.history
+    if not (column.added or column.deleted or relation.added or relation.deleted):
+        return None
+    if relation.deleted:
+        old = relation.deleted[0]
+    else:
+        old = _area_with_id(session, (column.deleted or column.unchanged or [None])[0])
+    if relation.added:
+        new = relation.added[0]
+    elif relation.deleted:
+        new = None
+    else:
+        new = _area_with_id(session, (column.added or [None])[0])
+    return old, new
+
+
+def _add(totals, obj, *deltas):
+    current = totals.setdefault(obj, [0] * len(deltas))
+    for i, delta in enumerate(deltas):
+        current[i] += delta
+
+
+def _apply(session, obj, column, delta):
+    if not delta:
+        return
+    if inspect(obj).persistent:
+        setattr(obj, column.key, column + delta)
+        mark_counted(session, obj)
+    else:
+        setattr(obj, column.key, (getattr(obj, column.key) or 0) + delta)
+
+
+@sa_event.listens_for(db.session, "before_flush")
+def _maintain_aggregates(session, flush_context, instances):
+    event_totals = {}
+    area_totals = {}
+
+    for obj in session.new:
+        if isinstance(obj, Ticket):
+            event = _ticket_event(session, obj)
+            if event is None:
+                continue
+            if obj.price is None:
+                obj.price = event.ticket_price or 0
+            _add(event_totals, event, 1, obj.price)
+        elif isinstance(obj, Event):
+            area = obj.in_area or _area_with_id(session, obj.area_id)
+            if area is not None:
+                _add(area_totals, area, obj.max_tickets or 0, 0, 0)
+
+    for obj in session.deleted:
+        if isinstance(obj, Ticket):
+            event = _ticket_event(session, obj)
+            if event is not None and event not in session.deleted:
+                _add(event_totals, event, -1, -(obj.price or 0))
+        elif isinstance(obj, Event):
+            area = obj.in_area
+            if area is not None and area not in session.deleted:
+                _add(area_totals, area,
+                    -(obj.max_tickets or 0), -(obj.tickets_sold or 0), -(obj.revenue or 0)
+                )
+
+    for obj in list(session.dirty):
+        if not isinstance(obj, Event) or obj in session.deleted:
+            continue
+        change = _area_change(session, obj)
+        capacity = inspect(obj).attrs.max_tickets.history
+        old_capacity = (capacity.deleted or capacity.unchanged or [0])[0] or 0
+        if change is not None and change[0] is not change[1]:
+            old, new = change
+            if old is not None and old not in session.deleted:
+                _add(area_totals, old,
+                    -old_capacity, -(obj.tickets_sold or 0), -(obj.revenue or 0)
+                )
+            if new is not None:
+                _add(area_totals, new,
+                    obj.max_tickets or 0, obj.tickets_sold or 0, obj.revenue or 0
+                )
+        elif capacity.added and obj.in_area is not None:
+            _add(area_totals, obj.in_area, (obj.max_tickets or 0) - old_capacity, 0, 0)
+
+    for event, (sold, revenue) in event_totals.items():
+        _apply(session, event, Event.tickets_sold, sold)
+        _apply(session, event, Event.revenue, revenue)
+        change = None if event in session.new else _area_change(session, event)
+        if change is not None:
+            area = change[1]
+        else:
+            area = event.in_area or _area_with_id(session, event.area_id)
+        if area is not None:
+            _add(area_totals, area, 0, sold, revenue)
+
+    for area, (capacity, sold, revenue) in area_totals.items():
+        _apply(session, area, Area.capacity, capacity)
+        _apply(session, area, Area.tickets_sold, sold)
+        _apply(session, area, Area.revenue, revenue)
+
+
+def release_reservations(reservation_ids):
+    """
+    Subtracts the tickets of the given unpaid reservations from the
+    aggregates. Must run in the transaction that deletes them, before the
+    delete statements.
+    """
+
+    released = and_(
+        reservations.c.id.in_(reservation_ids),
+        reservations.c.paid == False,
+        tickets.c.reservation_id == reservations.c.id
+    )
+    in_area = and_(released, reservations.c.event_id == events.c.id, events.c.area_id == areas.c.id)
+    changed = db.session.execute(select([
+        events.c.id, events.c.name, events.c.area_id, events.c.begins_at, areas.c.name.label("area_name")
+    ]).select_from(events.outerjoin(areas, events.c.area_id == areas.c.id)).where(
+        events.c.id.in_(select([reservations.c.event_id]).where(released))
+    )).fetchall()
+    db.session.execute(areas.update().where(
+        areas.c.id.in_(select([events.c.area_id]).where(and_(
+            released, reservations.c.event_id == events.c.id
+        )))
+    ).values(
+        tickets_sold=areas.c.tickets_sold - select([func.count(tickets.c.id)]).where(in_area).as_scalar(),
+        revenue=areas.c.revenue - select([func.coalesce(func.sum(tickets.c.price), 0)]).where(in_area).as_scalar()
+    ))
+    of_event = and_(released, reservations.c.event_id == events.c.id)
+    db.session.execute(events.update().where(
+        events.c.id.in_(select([reservations.c.event_id]).where(released))
+    ).values(
+        tickets_sold=events.c.tickets_sold - select([func.count(tickets.c.id)]).where(of_event).as_scalar(),
+        revenue=events.c.revenue - select([func.coalesce(func.sum(tickets.c.price), 0)]).where(of_event).as_scalar()
+    ))
+    add_counter_changes(db.session, changed)
+
+
+def fill_ticket_prices(where=None):
+    """
+    Gives tickets sold before prices were stored the current price of their
+    event. where limits the update to some tickets.
+    """
+
+    condition = tickets.c.price == None
+    if where is not None:
+        condition = and_(condition, where)
+    db.session.execute(tickets.update().where(condition).values(
+        price=select([func.coalesce(events.c.ticket_price, 0)]).where(and_(
+            reservations.c.id == tickets.c.reservation_id,
+            events.c.id == reservations.c.event_id
+        )).as_scalar()
+    ))
+
+
+def refresh_event_aggregates(where=None):
+    of_event = and_(reservations.c.event_id == events.c.id, tickets.c.reservation_id == reservations.c.id)
+    statement = events.update()
+    if where is not None:
+        statement = statement.where(where)
+    db.session.execute(statement.values(
+        tickets_sold=select([func.count(tickets.c.id)]).where(of_event).as_scalar(),
+        revenue=select([func.coalesce(func.sum(tickets.c.price), 0)]).where(of_event).as_scalar()
+    ))
+
+
+def refresh_area_aggregates(where=None):
+    in_area = events.c.area_id == areas.c.id
+    statement = areas.update()
+    if where is not None:
+        statement = statement.where(where)
+    db.session.execute(statement.values(
+        capacity=select([func.coalesce(func.sum(events.c.max_tickets), 0)]).where(in_area).as_scalar(),
+        tickets_sold=select([func.coalesce(func.sum(events.c.tickets_sold), 0)]).where(in_area).as_scalar(),
+        revenue=select([func.coalesce(func.sum(events.c.revenue), 0)]).where(in_area).as_scalar()
+    ))
+
+
+def refresh_aggregates():
+    """
+    Recomputes every aggregate from the tickets. Used to repair the counters
+    after manual changes. migrateDatabase fills them in for existing
+    databases a chunk at a time.
+    """
+
+    fill_ticket_prices()
+    refresh_event_aggregates()
+    refresh_area_aggregates()
+    db.session.commit()
+
+
+@click.command("refreshAggregates")
+@with_appcontext
+def refreshAggregates():
+    refresh_aggregates()
+    click.echo("Ticket sales aggregates recomputed")
@@ -0,0 +1,236 @@
+"""
+Sales and pricing statistics computed over columnar snapshots of the
+catalogue. A snapshot loads the event and ticket columns with two queries
+straight into NumPy arrays; every statistic is then a handful of array
+operations instead of a loop over ORM objects.
+
+Snapshots are cached per app for STATS_SNAPSHOT_TTL seconds, so bursts of
+requests for different statistics share one load.
+"""
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+from flask import current_app
+from sqlalchemy import select
+from nearbyEvents import db
+from nearbyEvents.models import Area, Event, Reservation, Ticket
+
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+
+Snapshot = namedtuple("Snapshot", [
+    "loaded_at",
+    # One entry per area, indexed by the area codes below
+    "area_names",
+    # One entry per event
+    "event_price", "event_max_tickets", "event_begin", "event_area",
+    # One entry per ticket, event is an index into the event arrays
+    "ticket_event", "ticket_price", "ticket_sold_at", "ticket_paid",
+])
+
+_lock = threading.Lock()
+
+
+def _column(rows, index, dtype):
+    return np.fromiter((row[index] for row in rows), dtype=dtype, count=len(rows))
+
+
+def load_snapshot():
+    """
+    Loads the columns used by the statistics into a Snapshot. Must be called
+    within an application context.
+    """
+
+    events = Event.__table__
+    areas = Area.__table__
+    reservations = Reservation.__table__
+    tickets = Ticket.__table__
+
+    rows = db.session.execute(select([areas.c.id, areas.c.name]).order_by(areas.c.name)).fetchall()
+    area_names = [row.name for row in rows]
+    area_codes = {row.id: code for code, row in enumerate(rows)}
+
+    rows = db.session.execute(select([
+        events.c.id, events.c.ticket_price, events.c.max_tickets,
+        events.c.begins_at, events.c.area_id
+    ]).order_by(events.c.id)).fetchall()
+    event_ids = _column(rows, 0, np.int64)
+    event_price = np.array([np.nan if row[1] is None else row[1] for row in rows], dtype=np.float64)
+    event_max_tickets = _column(rows, 2, np.int64)
+    event_begin = np.array([row[3] or "NaT" for row in rows], dtype="datetime64[s]")
+    event_area = np.fromiter(
+        (area_codes.get(row[4], -1) for row in rows), dtype=np.int64, count=len(rows)
+    )
+
+    rows = db.session.execute(select([
+        reservations.c.event_id, tickets.c.price,
+        reservations.c.created_at, reservations.c.paid
+    ]).where(tickets.c.reservation_id == reservations.c.id)).fetchall()
+    ticket_event = np.searchsorted(event_ids, _column(rows, 0, np.int64))
+    ticket_price = np.array([np.nan if row[1] is None else row[1] for row in rows], dtype=np.float64)
+    missing = np.isnan(ticket_price)
+    # Tickets sold before prices were recorded per ticket use the event's price
+    ticket_price[missing] = event_price[ticket_event[missing]]
+    ticket_sold_at = np.array([row[2] for row in rows], dtype="datetime64[s]")
+    ticket_paid = _column(rows, 3, np.bool_)
+
+    return Snapshot(
+        time.monotonic(), area_names,
+        event_price, event_max_tickets, event_begin, event_area,
+        ticket_event, ticket_price, ticket_sold_at, ticket_paid
+    )
+
+
+def get_snapshot():
+    """
+    Returns the cached snapshot of the current app, loading a new one when it
+    is older than STATS_SNAPSHOT_TTL seconds.
+    """
+
+    extensions = current_app.extensions
+    ttl = current_app.config["STATS_SNAPSHOT_TTL"]
+    with _lock:
+        snapshot = extensions.get("nearby_stats")
+        if snapshot is None or time.monotonic() - snapshot.loaded_at > ttl:
+            snapshot = extensions["nearby_stats"] = load_snapshot()
+    return snapshot
+
+
+def _summary(values, percentiles):
+    values = values[~np.isnan(values)]
+    if not values.size:
+        return {"count": 0}
+    points = np.percentile(values, percentiles)
+    return {
+        "count": int(values.size),
+        "mean": float(values.mean()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "percentiles": {"{:g}".format(p): float(v) for p, v in zip(percentiles, points)},
+    }
+
+
+def grouped_percentiles(groups, values, group_count, percentiles):
+    """
+    Computes the percentiles of values within every group at once. Returns an
+    array of shape (group_count, len(percentiles)) that is NaN for empty
+    groups, and the group sizes. Uses the same linear interpolation as
+    np.percentile.
+    """
+
+    if not values.size:
+        return np.full((group_count, len(percentiles)), np.nan), np.zeros(group_count, dtype=np.int64)
+    order = np.lexsort((values, groups))
+    groups = groups[order]
+    values = values[order]
+    counts = np.bincount(groups, minlength=group_count)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    positions = (counts[:, None] - 1) * (np.asarray(percentiles, dtype=np.float64) / 100)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, np.maximum(counts[:, None] - 1, 0))
+    fraction = positions - lower
+    empty = counts == 0
+    lower = np.where(empty[:, None], 0, starts[:, None] + lower)
+    upper = np.where(empty[:, None], 0, starts[:, None] + upper)
+    result = values[lower] * (1 - fraction) + values[upper] * fraction
+    result[empty] = np.nan
+    return result, counts
+
+
+def price_statistics(snapshot, percentiles=DEFAULT_PERCENTILES):
+    """
+    Percentiles of the listed event prices and of the prices tickets were
+    actually sold for.
+    """
+
+    return {
+        "events": _summary(snapshot.event_price, percentiles),
+        "tickets": _summary(snapshot.ticket_price, percentiles),
+    }
+
+
+def price_histogram(snapshot, bins=10):
+    """
+    Histogram of the prices of sold tickets with equal width bins.
+    """
+
+    prices = snapshot.ticket_price[~np.isnan(snapshot.ticket_price)]
+    if not prices.size:
+        return {"edges": [], "counts": []}
+    counts, edges = np.histogram(prices, bins=bins)
+    return {"edges": edges.tolist(), "counts": counts.tolist()}
+
+
+def area_statistics(snapshot, percentiles=DEFAULT_PERCENTILES):
+    """
+    Event price distribution, capacity, tickets sold and revenue per area.
+    """
+
+    area_count = len(snapshot.area_names)
+    priced = (snapshot.event_area >= 0) & ~np.isnan(snapshot.event_price)
+    points, counts = grouped_percentiles(
+        snapshot.event_area[priced], snapshot.event_price[priced], area_count, percentiles
+    )
+    in_area = snapshot.event_area >= 0
+    capacity = np.bincount(
+        snapshot.event_area[in_area], weights=snapshot.event_max_tickets[in_area], minlength=area_count
+    )
+    ticket_area = snapshot.event_area[snapshot.ticket_event]
+    sold = ticket_area >= 0
+    tickets_sold = np.bincount(ticket_area[sold], minlength=area_count)
+    revenue = np.bincount(
+        ticket_area[sold], weights=np.nan_to_num(snapshot.ticket_price[sold]), minlength=area_count
+    )
+    result = []
+    for code, name in enumerate(snapshot.area_names):
+        result.append({
+            "area_name": name,
+            "events_priced": int(counts[code]),
+            "price_percentiles": {
+                "{:g}".format(p): None if np.isnan(v) else float(v)
+                for p, v in zip(percentiles, points[code])
+            },
+            "capacity": int(capacity[code]),
+            "tickets_sold": int(tickets_sold[code]),
+            "revenue": float(revenue[code]),
+        })
+    return result
+
+
+def sell_through_curve(snapshot, horizon=30):
+    """
+    Share of the capacity sold as a function of the number of days before the
+    events begin, over the events with a known begin time. The entry for day d
+    counts the tickets sold at least d days before their event.
+    """
+
+    known = ~np.isnat(snapshot.event_begin)
+    capacity = int(snapshot.event_max_tickets[known].sum())
+    begins = snapshot.event_begin[snapshot.ticket_event]
+    counted = ~np.isnat(begins)
+    lead = (begins[counted] - snapshot.ticket_sold_at[counted]).astype(np.int64) // 86400
+    # Tickets sold after the event began count from day 0, early sales count
+    # from the horizon
+    sold_on = np.bincount(np.clip(lead, 0, horizon), minlength=horizon + 1)
+    sold_by = np.cumsum(sold_on[::-1])[::-1]
+    share = sold_by / capacity if capacity else np.zeros(horizon + 1)
+    return {
+        "events": int(known.sum()),
+        "capacity": capacity,
+        "days_before": list(range(horizon + 1)),
+        "tickets_sold": sold_by.tolist(),
+        "sell_through": share.tolist(),
+    }
+
+
+def event_sell_through(snapshot, percentiles=DEFAULT_PERCENTILES):
+    """
+    Distribution of the sold share of capacity over the events.
+    """
+
+    sold = np.bincount(snapshot.ticket_event, minlength=snapshot.event_max_tickets.size)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        share = np.where(
+            snapshot.event_max_tickets > 0, sold / snapshot.event_max_tickets, np.nan
+        )
+    return _summary(share, percentiles)
@@ -5,13 +5,21 @@ from flask_restful import Api
 from nearbyEvents.resources.area import AreaCollection, AreaItem
 from nearbyEvents.resources.event import EventCollection, EventItem
 from nearbyEvents.resources.eventsbyarea import EventsByArea
+from nearbyEvents.resources.calendar import AreaCalendar
+from nearbyEvents.resources.updates import CatalogueUpdates
+from nearbyEvents.resources.stats import SalesStatistics
+from nearbyEvents.tracing import trace_resource
 
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
-api = Api(api_bp)
+api = Api(api_bp, decorators=[trace_resource])
 
 api.add_resource(AreaCollection, "/areas/")
-api.add_resource(AreaItem, "/areas/<area>/")
+# Rows are addressed by id, the name routes are kept as aliases
+api.add_resource(AreaItem, "/areas/id/<int:area_id>/", "/areas/<area>/")
 api.add_resource(EventCollection, "/events/")
-api.add_resource(EventItem, "/events/<event>/")
-api.add_resource(EventsByArea, "/areas/<area>/events/")
\ No newline at end of file
+api.add_resource(EventItem, "/events/id/<int:event_id>/", "/events/<event>/")
+api.add_resource(EventsByArea, "/areas/id/<int:area_id>/events/", "/areas/<area>/events/")
+api.add_resource(AreaCalendar, "/areas/id/<int:area_id>/calendar/", "/areas/<area>/calendar/")
+api.add_resource(CatalogueUpdates, "/updates/")
+api.add_resource(SalesStatistics, "/stats/")
@@ -0,0 +1,105 @@
+"""
+Area resolution for the resources. Areas change rarely but are looked up on
+every event write, so each process keeps the complete name <-> id maps of
+the areas and answers lookups from them, including misses, without a query.
+
+The map is dropped after every committed area change: in the committing
+process through the change broker, in the other server workers through the
+areas epoch file (see notifications.CatalogueEpochs) checked on every lookup.
+"""
+import threading
+from flask import current_app
+from nearbyEvents import db
+from nearbyEvents.models import Area
+from nearbyEvents.routing import use_primary
+
+
+class AreaResolver(object):
+
+    def __init__(self, epoch):
+        self.epoch = epoch
+        self._lock = threading.Lock()
+        # name -> id and id -> name, replaced together
+        self._maps = None
+        self._loaded_at = None
+
+    def load(self):
+        """
+        Loads the names and ids of all areas. Must be called within an
+        application context.
+        """
+
+        with self._lock:
+            # Read the epoch first so that a change committed during the
+            # query causes another reload
+            epoch = self.epoch.current()
+            # A lagging replica would hide the change until the next one
+            with use_primary():
+                ids = dict(db.session.query(Area.name, Area.id))
+            self._maps = ids, {area_id: name for name, area_id in ids.items()}
+            self._loaded_at = epoch
+        return self._maps
+
+    def _current(self):
+        maps = self._maps
+        if maps is None or self.epoch.current() != self._loaded_at:
+            maps = self.load()
+        return maps
+
+    def resolve(self, name):
+        """
+        Returns the id of the area with the given name, or None if there is no
+        such area.
+        """
+
+        return self._current()[0].get(name)
+
+    def name_of(self, area_id):
+        """
+        Returns the name of the area with the given id, or None if there is no
+        such area.
+        """
+
+        return self._current()[1].get(area_id)
+
+    def exists(self, name):
+        return name in self._current()[0]
+
+    def invalidate(self):
+        self._maps = None
+
+    def on_change(self, message):
+        """
+        Change broker listener, drops the map after area changes.
+        """
+
+        if message["type"] == "area":
+            self.invalidate()
+
+
+def init_app(app):
+    resolver = app.extensions["nearby_areas"] = AreaResolver(app.extensions["nearby_epochs"]["area"])
+    app.extensions["nearby_changes"].add_listener(resolver.on_change)
+    app.extensions["nearby_warmup"].append(resolver.load)
+    return resolver
+
+
+def get_resolver():
+    return current_app.extensions["nearby_areas"]
+
+
+def get_area(name=None, area_id=None):
+    """
+    Returns the Area with the given name or id, or None. Unknown areas are
+    answered without a query and repeated lookups within a request are
+    served from the session's identity map.
+    """
+
+    resolver = get_resolver()
+    if area_id is None:
+        area_id = resolver.resolve(name)
+    elif resolver.name_of(area_id) is None:
+        return None
+    if area_id is None:
+        return None
+    return db.session.query(Area).get(area_id)
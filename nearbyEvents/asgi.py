@@ -0,0 +1,423 @@
+"""
+ASGI serving mode of the API. Reads of the area and event resources and the
+update stream are served natively on the event loop: the database is queried
+on a small fixed pool of threads and a request that waits for its rows or for
+change notifications costs a coroutine instead of a thread. Every other
+request is passed to the Flask WSGI app on a bounded pool of worker threads.
+
+Serve with any ASGI server, for example:
+
+    uvicorn --factory nearbyEvents.asgi:create_asgi_app
+
+No ASGI server is in requirements.txt, uvicorn 0.13 or newer is an optional
+dependency of this mode only.
+"""
+import asyncio
+import contextvars
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, _app_ctx_stack, _request_ctx_stack
+from sqlalchemy import select
+from werkzeug.exceptions import HTTPException
+from werkzeug.urls import url_decode
+from nearbyEvents import create_app, db
+from nearbyEvents.constants import *
+from nearbyEvents.models import Area, Event
+from nearbyEvents.utils import create_error_response
+from nearbyEvents.resources.area import area_item_body, area_collection_body, area_not_found
+from nearbyEvents.resources.event import event_item_body, event_collection_body, event_not_found
+from nearbyEvents.resources.eventsbyarea import (
+    PageArgs, events_by_area_body, events_by_area_query, unknown_area
+)
+from nearbyEvents.resources.updates import format_sse
+from nearbyEvents.routing import read_engine
+
+areas = Area.__table__
+events = Event.__table__
+
+
+def build_environ(scope, body):
+    """
+    Builds a WSGI environ from an ASGI http scope and the request body.
+    """
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("ascii"),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"] = server[0]
+    environ["SERVER_PORT"] = str(server[1])
+    client = scope.get("client")
+    if client:
+        environ["REMOTE_ADDR"] = client[0]
+        environ["REMOTE_PORT"] = str(client[1])
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1")
+        if name == "content-length":
+            key = "CONTENT_LENGTH"
+        elif name == "content-type":
+            key = "CONTENT_TYPE"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        value = value.decode("latin1")
+        if key in environ:
+            value = environ[key] + "," + value
+        environ[key] = value
+    if body and "CONTENT_LENGTH" not in environ:
+        environ["CONTENT_LENGTH"] = str(len(body))
+    return environ
+
+
+async def read_body(receive):
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return b"".join(chunks)
+
+
+class AsyncDatabase(object):
+    """
+    Runs Core queries of the async read paths on a fixed pool of threads.
+    """
+
+    def __init__(self, engine, size):
+        self.engine = engine
+        # Replica engine chosen for the request served by the current task
+        self.read_engine = contextvars.ContextVar("nearby_read_engine", default=None)
+        self._executor = ThreadPoolExecutor(size, thread_name_prefix="nearby-db")
+
+    def _fetchall(self, engine, statement):
+        with engine.connect() as connection:
+            return connection.execute(statement).fetchall()
+
+    async def fetchall(self, statement):
+        loop = asyncio.get_running_loop()
+        engine = self.read_engine.get() or self.engine
+        return await loop.run_in_executor(self._executor, self._fetchall, engine, statement)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class NearbyEventsASGI(object):
+    """
+    ASGI application wrapping a Flask app created by create_app. Native
+    handlers render their bodies with the same builders as the resources and
+    run the app's before and after request hooks, so responses are identical
+    to the WSGI path.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.adapter = flask_app.url_map.bind("localhost")
+        self.database = None
+        self._wsgi_executor = None
+        self.handlers = {
+            "api.areaitem": self.area_item,
+            "api.areacollection": self.area_collection,
+            "api.eventitem": self.event_item,
+            "api.eventcollection": self.event_collection,
+            "api.eventsbyarea": self.events_by_area,
+        }
+        # Handlers that also take the query string of the request
+        self.takes_query = {"api.eventsbyarea"}
+
+    def startup(self):
+        if self.database is not None:
+            return
+        config = self.flask_app.config
+        self.database = AsyncDatabase(
+            db.get_engine(self.flask_app), config["ASGI_DB_THREADS"]
+        )
+        self._wsgi_executor = ThreadPoolExecutor(
+            config["ASGI_WSGI_THREADS"], thread_name_prefix="nearby-wsgi"
+        )
+        # Native requests bypass the dispatch of the Flask app that would
+        # otherwise run these, e.g. starting the sweeper and query listeners
+        self.flask_app.try_trigger_before_first_request_functions()
+
+    def shutdown(self):
+        if self.database is None:
+            return
+        self.database.close()
+        self._wsgi_executor.shutdown(wait=True)
+        self.database = None
+        self._wsgi_executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        self.startup()
+        endpoint = None
+        if scope["method"] in ("GET", "HEAD"):
+            try:
+                endpoint, values = self.adapter.match(scope["path"], "GET")
+            except HTTPException:
+                endpoint = None
+        if endpoint in self.handlers:
+            if endpoint in self.takes_query:
+                values["query_string"] = scope.get("query_string", b"")
+            await self.serve_native(scope, send, self.handlers[endpoint], values)
+        elif endpoint == "api.catalogueupdates":
+            await self.stream_updates(scope, receive, send)
+        else:
+            await self.serve_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _suspend(self):
+        # Request contexts are bound to the thread, which every coroutine on
+        # the loop shares, so a context is taken off the stacks while its
+        # request awaits and put back afterwards without tearing it down.
+        app_ctx = _app_ctx_stack.top
+        request_ctx = _request_ctx_stack.pop()
+        _app_ctx_stack.pop()
+        return app_ctx, request_ctx
+
+    def _resume(self, suspended):
+        app_ctx, request_ctx = suspended
+        _app_ctx_stack.push(app_ctx)
+        _request_ctx_stack.push(request_ctx)
+
+    async def serve_native(self, scope, send, handler, values):
+        ctx = self.flask_app.request_context(build_environ(scope, b""))
+        ctx.push()
+        try:
+            response = self.flask_app.preprocess_request()
+            if response is None:
+                self.database.read_engine.set(read_engine())
+                suspended = self._suspend()
+                try:
+                    render = await handler(**values)
+                finally:
+                    self._resume(suspended)
+                response = render()
+            response = self.flask_app.make_response(response)
+            response = self.flask_app.process_response(response)
+        finally:
+            ctx.pop()
+        await self.send_response(scope, send, response.status_code,
+            response.headers.to_wsgi_list(), response.get_data()
+        )
+
+    async def serve_wsgi(self, scope, receive, send):
+        environ = build_environ(scope, await read_body(receive))
+        loop = asyncio.get_running_loop()
+        status, headers, body = await loop.run_in_executor(
+            self._wsgi_executor, self._call_wsgi, environ
+        )
+        await self.send_response(scope, send, status, headers, body)
+
+    def _call_wsgi(self, environ):
+        result = {}
+
+        def start_response(status, headers, exc_info=None):
+            result["status"] = int(status.split(" ", 1)[0])
+            result["headers"] = headers
+
+        iterable = self.flask_app(environ, start_response)
+        try:
+            body = b"".join(iterable)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+        return result["status"], result["headers"], body
+
+    async def send_response(self, scope, send, status, headers, body):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (name.lower().encode("latin1"), value.encode("latin1"))
+                for name, value in headers
+            ],
+        })
+        if scope["method"] == "HEAD":
+            body = b""
+        await send({"type": "http.response.body", "body": body})
+
+    def _might_exist(self, kind, name):
+        # Never rebuilds on the loop, an outdated filter only answers maybe
+        return self.flask_app.extensions["nearby_names"][kind].might_exist(name, rebuild=False)
+
+    def _cached_item(self, kind, name, item_id):
+        # Served from the item cache, which the native reads do not fill
+        cache = self.flask_app.extensions.get("nearby_item_cache")
+        found = cache.get(kind, name, item_id) if cache is not None else None
+        if found is None:
+            return None
+        self._record(kind, found[0])
+        return lambda: Response(found[2], 200, mimetype=MASON)
+
+    def _record(self, kind, item_id):
+        popularity = self.flask_app.extensions.get("nearby_popularity")
+        if popularity is not None:
+            popularity.record(kind, item_id)
+
+    async def area_item(self, area=None, area_id=None):
+        cached = self._cached_item("area", area, area_id)
+        if cached is not None:
+            return cached
+        if area_id is None and not self._might_exist("area", area):
+            rows = []
+        else:
+            rows = await self.database.fetchall(select([
+                areas.c.id, areas.c.name, areas.c.capacity, areas.c.tickets_sold, areas.c.revenue
+            ]).where(
+                areas.c.id == area_id if area_id is not None else areas.c.name == area
+            ).limit(1))
+
+        def render():
+            if not rows:
+                return area_not_found(area, area_id)
+            self._record("area", rows[0].id)
+            return Response(json.dumps(area_item_body(rows[0])), 200, mimetype=MASON)
+        return render
+
+    async def area_collection(self):
+        rows = await self.database.fetchall(select([areas.c.id, areas.c.name]))
+        return lambda: Response(
+            json.dumps(area_collection_body(rows)), 200, mimetype=MASON
+        )
+
+    async def event_item(self, event=None, event_id=None):
+        cached = self._cached_item("event", event, event_id)
+        if cached is not None:
+            return cached
+        if event_id is None and not self._might_exist("event", event):
+            rows = []
+        else:
+            rows = await self.database.fetchall(select([
+                events.c.id, events.c.name, events.c.area_id, events.c.max_tickets,
+                events.c.tickets_sold, events.c.revenue
+            ]).where(
+                events.c.id == event_id if event_id is not None else events.c.name == event
+            ).limit(1))
+
+        def render():
+            if not rows:
+                return event_not_found(event, event_id)
+            self._record("event", rows[0].id)
+            return Response(json.dumps(event_item_body(rows[0])), 200, mimetype=MASON)
+        return render
+
+    async def event_collection(self):
+        rows = await self.database.fetchall(select([events.c.id, events.c.name, events.c.area_id]))
+        return lambda: Response(
+            json.dumps(event_collection_body(rows)), 200, mimetype=MASON
+        )
+
+    async def events_by_area(self, area=None, area_id=None, query_string=b""):
+        config = self.flask_app.config
+        try:
+            page = PageArgs(url_decode(query_string),
+                config["EVENTS_PAGE_SIZE"], config["EVENTS_MAX_PAGE_SIZE"]
+            )
+        except ValueError as e:
+            message = str(e)
+            return lambda: create_error_response(400, "Invalid query parameters", message)
+        if area_id is None and not self._might_exist("area", area):
+            rows = []
+        else:
+            rows = await self.database.fetchall(events_by_area_query(page, area, area_id))
+
+        def render():
+            if not rows:
+                return unknown_area(area, area_id)
+            return Response(json.dumps(events_by_area_body(rows[0].area_id, rows, page)), 200, mimetype=MASON)
+        return render
+
+    async def stream_updates(self, scope, receive, send):
+        with self.flask_app.request_context(build_environ(scope, b"")):
+            response = self.flask_app.preprocess_request()
+            if response is not None:
+                response = self.flask_app.make_response(response)
+        if response is not None:
+            await self.send_response(scope, send, response.status_code,
+                response.headers.to_wsgi_list(), response.get_data()
+            )
+            return
+
+        loop = asyncio.get_running_loop()
+        broker = self.flask_app.extensions["nearby_changes"]
+        keepalive = self.flask_app.config["SSE_KEEPALIVE"]
+        ready = asyncio.Event()
+        subscription = broker.subscribe()
+        subscription.waker = lambda: loop.call_soon_threadsafe(ready.set)
+        disconnected = loop.create_task(self._wait_disconnect(receive))
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", SSE.encode("latin1")),
+                    (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no"),
+                ],
+            })
+            await self._send_chunk(send, "retry: {}\n\n".format(SSE_RETRY_MS))
+            while not disconnected.done():
+                waiter = loop.create_task(ready.wait())
+                await asyncio.wait(
+                    {waiter, disconnected}, timeout=keepalive,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                waiter.cancel()
+                if disconnected.done():
+                    break
+                ready.clear()
+                messages, dropped = subscription.drain()
+                chunks = []
+                if dropped:
+                    chunks.append(format_sse({"dropped": dropped}, event="resync"))
+                for message in messages:
+                    chunks.append(format_sse(message, event=message["type"]))
+                await self._send_chunk(send, "".join(chunks) or ": keepalive\n\n")
+        finally:
+            broker.unsubscribe(subscription)
+            disconnected.cancel()
+
+    async def _send_chunk(self, send, text):
+        await send({
+            "type": "http.response.body",
+            "body": text.encode("utf8"),
+            "more_body": True
+        })
+
+    async def _wait_disconnect(self, receive):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+
+def create_asgi_app(test_config=None):
+    return NearbyEventsASGI(create_app(test_config))
@@ -0,0 +1,157 @@
+"""
+Bearer token authentication of the write methods of the resources. With
+JWT_REQUIRED set, POST, PUT and DELETE requests need an Authorization header
+with a JWT signed with one of the app's keys (JWT_ALGORITHM, HS256 by
+default); reads stay public. Admin endpoints always need a token with the
+claim "admin": true.
+
+The keys in JWT_KEYS (key id -> secret or PEM key) are parsed once when the
+app is created. A token without a "kid" header is checked against the key
+"default". Without JWT_KEYS no token is accepted and the admin endpoints
+are not found.
+
+Verified tokens are remembered by the SHA-256 of the token in a per-process
+LRU cache of JWT_CACHE_SIZE entries, so a client sending the same token again
+costs a hash and a dictionary lookup instead of a signature check. A cached
+token is still rejected once its "exp" time has passed.
+"""
+import collections
+import functools
+import hashlib
+import threading
+import time
+import jwt
+from flask import current_app, g, request
+from jwt.algorithms import get_default_algorithms
+from nearbyEvents.utils import create_error_response
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class TokenCache(object):
+    """
+    Bounded LRU cache of verified claims by token hash.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._claims = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest, now):
+        with self._lock:
+            claims = self._claims.get(digest)
+            if claims is None:
+                self.misses += 1
+                return None
+            if "exp" in claims and claims["exp"] <= now:
+                del self._claims[digest]
+                self.misses += 1
+                return None
+            self._claims.move_to_end(digest)
+            self.hits += 1
+            return claims
+
+    def put(self, digest, claims):
+        with self._lock:
+            self._claims[digest] = claims
+            self._claims.move_to_end(digest)
+            while len(self._claims) > self.size:
+                self._claims.popitem(last=False)
+
+
+class TokenVerifier(object):
+
+    def __init__(self, keys, algorithm, cache_size, leeway=0):
+        prepare = get_default_algorithms()[algorithm].prepare_key
+        self.keys = {kid: prepare(key) for kid, key in keys.items()}
+        self.algorithm = algorithm
+        self.leeway = leeway
+        self.cache = TokenCache(cache_size)
+
+    def verify(self, token):
+        """
+        Returns the claims of the token, raises jwt.InvalidTokenError if it is
+        not valid.
+        """
+
+        digest = hashlib.sha256(token.encode("utf-8")).digest()
+        claims = self.cache.get(digest, time.time() - self.leeway)
+        if claims is not None:
+            return claims
+        key = self.keys.get(jwt.get_unverified_header(token).get("kid", "default"))
+        if key is None:
+            raise jwt.InvalidTokenError("Unknown key id")
+        claims = jwt.decode(token, key, algorithms=[self.algorithm], leeway=self.leeway)
+        self.cache.put(digest, claims)
+        return claims
+
+
+def _unauthorized(message):
+    response = create_error_response(401, "Unauthorized", message)
+    response.headers["WWW-Authenticate"] = "Bearer"
+    return response
+
+
+def _authenticate():
+    """
+    Verifies the bearer token of the request and stores its claims in
+    g.jwt_claims. Returns an error response if there is no valid token.
+    """
+
+    verifier = current_app.extensions.get("nearby_jwt")
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if verifier is None or scheme.lower() != "bearer" or not token:
+        return _unauthorized("A bearer token is required")
+    try:
+        g.jwt_claims = verifier.verify(token.strip())
+    except jwt.InvalidTokenError as e:
+        return _unauthorized(str(e))
+    return None
+
+
+def jwt_required(method):
+    """
+    Decorator for resource methods that change resources. The verified
+    claims are stored in g.jwt_claims.
+    """
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if current_app.config["JWT_REQUIRED"] and request.method not in SAFE_METHODS:
+            error = _authenticate()
+            if error is not None:
+                return error
+        return method(*args, **kwargs)
+    return wrapper
+
+
+def admin_required(view):
+    """
+    Decorator for admin views, which need a token with the admin claim
+    whether or not JWT_REQUIRED is set.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if "nearby_jwt" not in current_app.extensions:
+            return create_error_response(404, "Not found", "Admin endpoints need JWT_KEYS")
+        error = _authenticate()
+        if error is not None:
+            return error
+        if g.jwt_claims.get("admin") is not True:
+            return create_error_response(403, "Forbidden", "Admin privileges are required")
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def init_app(app):
+    keys = app.config["JWT_KEYS"]
+    if not keys:
+        return None
+    verifier = app.extensions["nearby_jwt"] = TokenVerifier(
+        keys, app.config["JWT_ALGORITHM"], app.config["JWT_CACHE_SIZE"], app.config["JWT_LEEWAY"]
+    )
+    return verifier
@@ -0,0 +1,243 @@
+"""
+Online snapshots of the SQLite database. A snapshot is copied from the live
+database with the SQLite backup API, BACKUP_STEP_PAGES pages at a time with
+a BACKUP_STEP_SLEEP pause between the steps. The source is only locked while
+a step runs, so writers wait at most one step. A write made by another
+connection between the steps makes SQLite restart the copy, and the finished
+copy is always a consistent state of the database.
+
+The copy is gzip-compressed into BACKUP_DIR (by default the backups folder
+of the instance) as nearby-<UTC time>.db.gz next to a <name>.sha256 file in the
+sha256sum format, and only the BACKUP_KEEP newest snapshots are kept.
+
+Restoring checks the checksum and the integrity of the snapshot before the
+backup API writes it over the live database in a single step, so other
+connections see either the old or the restored database. The caches of the
+server workers are then told to reload. Snapshots are taken with the
+backupDatabase command or by admins with POST /admin/backups/, and restored
+with the restoreDatabase command. The module is only imported by those.
+"""
+import datetime
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import click
+from flask import current_app, jsonify
+from flask.cli import with_appcontext
+from flask_sqlalchemy import get_state
+from nearbyEvents.utils import create_error_response
+
+SNAPSHOT_NAME = re.compile(r"^nearby-[\w.-]+\.db\.gz$")
+CHUNK_SIZE = 1 << 20
+
+
+class BackupError(Exception):
+    pass
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SnapshotStore(object):
+    """
+    Directory of compressed snapshots, keeping the newest keep.
+    """
+
+    def __init__(self, directory, keep, step_pages, step_sleep):
+        self.directory = directory
+        self.keep = keep
+        self.step_pages = step_pages
+        self.step_sleep = step_sleep
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        if not SNAPSHOT_NAME.match(name):
+            raise BackupError("Invalid snapshot name {}".format(name))
+        return os.path.join(self.directory, name)
+
+    def names(self):
+        """
+        Returns the names of the stored snapshots, newest first.
+        """
+
+        try:
+            names = [name for name in os.listdir(self.directory) if SNAPSHOT_NAME.match(name)]
+        except FileNotFoundError:
+            return []
+        return sorted(names, reverse=True)
+
+    def describe(self, name):
+        path = self.path(name)
+        with open(path + ".sha256") as f:
+            checksum = f.read().split()[0]
+        return {"name": name, "size": os.path.getsize(path), "sha256": checksum}
+
+    def _prune(self):
+        for name in self.names()[self.keep:]:
+            for path in (self.path(name), self.path(name) + ".sha256"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def snapshot(self, source):
+        """
+        Copies the database of the DB-API connection source into a new
+        snapshot and returns its description.
+        """
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            started = time.monotonic()
+            name = "nearby-{}.db.gz".format(datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S.%f"))
+            fd, copy = tempfile.mkstemp(dir=self.directory, suffix=".db")
+            os.close(fd)
+            try:
+                target = sqlite3.connect(copy)
+                try:
+                    source.backup(target, pages=self.step_pages, sleep=self.step_sleep)
+                finally:
+                    target.close()
+                path = self.path(name)
+                with open(copy, "rb") as raw, gzip.open(path + ".tmp", "wb", compresslevel=6) as packed:
+                    shutil.copyfileobj(raw, packed, CHUNK_SIZE)
+                checksum = _sha256(path + ".tmp")
+                with open(path + ".sha256", "w") as f:
+                    f.write("{}  {}\n".format(checksum, name))
+                os.replace(path + ".tmp", path)
+                snapshot = {
+                    "name": name,
+                    "size": os.path.getsize(path),
+                    "database_size": os.path.getsize(copy),
+                    "sha256": checksum,
+                    "seconds": round(time.monotonic() - started, 3),
+                }
+            finally:
+                os.remove(copy)
+                if os.path.exists(os.path.join(self.directory, name + ".tmp")):
+                    os.remove(os.path.join(self.directory, name + ".tmp"))
+            self._prune()
+        return snapshot
+
+    def restore(self, name, target):
+        """
+        Verifies the snapshot and writes it over the database of the DB-API
+        connection target.
+        """
+
+        path = self.path(name)
+        if not os.path.exists(path):
+            raise BackupError("No snapshot {}".format(name))
+        expected = self.describe(name)["sha256"]
+        if _sha256(path) != expected:
+            raise BackupError("Checksum mismatch in {}".format(name))
+        fd, copy = tempfile.mkstemp(dir=self.directory, suffix=".db")
+        os.close(fd)
+        try:
+            with gzip.open(path, "rb") as packed, open(copy, "wb") as raw:
+                shutil.copyfileobj(packed, raw, CHUNK_SIZE)
+            source = sqlite3.connect(copy)
+            try:
+                result = source.execute("PRAGMA integrity_check").fetchone()[0]
+                if result != "ok":
+                    raise BackupError("Snapshot {} is corrupt: {}".format(name, result))
+                source.backup(target)
+            finally:
+                source.close()
+        finally:
+            os.remove(copy)
+
+
+def get_store(app):
+    # dict.setdefault keeps concurrent first uses on the same store
+    store = app.extensions.get("nearby_backups")
+    if store is None:
+        store = app.extensions.setdefault("nearby_backups", SnapshotStore(
+            app.config["BACKUP_DIR"] or os.path.join(app.instance_path, "backups"),
+            app.config["BACKUP_KEEP"], app.config["BACKUP_STEP_PAGES"], app.config["BACKUP_STEP_SLEEP"]
+        ))
+    return store
+
+
+def _primary(app):
+    engine = get_state(app).db.get_engine(app)
+    if engine.url.drivername != "sqlite":
+        raise BackupError("Snapshots are only supported for SQLite databases")
+    return engine
+
+
+def snapshot(app):
+    engine = _primary(app)
+    connection = engine.raw_connection()
+    try:
+        return get_store(app).snapshot(connection.connection)
+    finally:
+        connection.close()
+
+
+def restore(app, name):
+    engine = _primary(app)
+    connection = engine.raw_connection()
+    try:
+        get_store(app).restore(name, connection.connection)
+    finally:
+        connection.close()
+    # Pooled connections may hold pages of the replaced database
+    engine.dispose()
+    epochs = app.extensions["nearby_epochs"]
+    for kind in ("area", "event"):
+        epochs[kind].bump()
+        epochs.names[kind].bump()
+
+
+def list_backups():
+    store = get_store(current_app)
+    return jsonify({"backups": [store.describe(name) for name in store.names()]})
+
+
+def create_backup():
+    try:
+        return jsonify(snapshot(current_app._get_current_object())), 201
+    except BackupError as e:
+        return create_error_response(409, "Backup failed", str(e))
+
+
+@click.command("backupDatabase")
+@with_appcontext
+def backupDatabase():
+    try:
+        result = snapshot(current_app._get_current_object())
+    except BackupError as e:
+        raise click.ClickException(str(e))
+    click.echo("Wrote {name} ({size} bytes, sha256 {sha256}) in {seconds} s".format(**result))
+
+
+@click.command("restoreDatabase")
+@click.argument("name", required=False)
+@with_appcontext
+def restoreDatabase(name):
+    app = current_app._get_current_object()
+    store = get_store(app)
+    if name is None:
+        names = store.names()
+        if not names:
+            raise click.ClickException("No snapshots in {}".format(store.directory))
+        name = names[0]
+    started = time.monotonic()
+    try:
+        restore(app, name)
+    except BackupError as e:
+        raise click.ClickException(str(e))
+    click.echo("Restored {} in {:.3f} s".format(name, time.monotonic() - started))
+
@@ -0,0 +1,153 @@
+"""
+Negative lookups of area and event names. Each process keeps a Bloom filter
+of the existing names per kind, so requests for names that do not exist are
+answered with a 404 without querying the database.
+
+A filter never forgets a name: deleted names and hash collisions only make
+the caller fall through to the database, which stays the authority for
+every name the filter might contain. Names created or renamed in this
+process are added right after their commit and bump the names epoch file of
+the kind (see notifications.CatalogueEpochs), which other changes leave
+alone. When the names epoch shows a new name from another process, the
+filter is rebuilt from the database, at most once every
+NAME_FILTER_REBUILD_INTERVAL seconds, and answers "maybe" until then.
+"""
+import hashlib
+import math
+import threading
+import time
+from flask import current_app
+from nearbyEvents import db
+from nearbyEvents.models import Area, Event
+from nearbyEvents.routing import use_primary
+
+# Smallest capacity of a filter, leaves room for new names between rebuilds
+MIN_CAPACITY = 1024
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of strings with the given capacity and false positive rate.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, name):
+        digest = hashlib.blake2b(name.encode("utf-8"), digest_size=16).digest()
+        # Double hashing, the odd step visits distinct positions
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, name):
+        positions = self._positions(name)
+        with self._lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, name):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(name))
+
+
+class NameFilter(object):
+    """
+    Bloom filter of the names in one column, kept in step with the catalogue.
+    """
+
+    def __init__(self, kind, column, epoch, error_rate=0.01, rebuild_interval=5):
+        self.kind = kind
+        self.column = column
+        self.epoch = epoch
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self._lock = threading.Lock()
+        self._filter = None
+        self._seen = None
+        self._built_at = None
+
+    def build(self):
+        """
+        Rebuilds the filter from the database. Must be called within an
+        application context.
+        """
+
+        with self._lock:
+            epoch = self.epoch.current()
+            with use_primary():
+                names = [row[0] for row in db.session.query(self.column)]
+            bloom = BloomFilter(max(MIN_CAPACITY, 2 * len(names)), self.error_rate)
+            for name in names:
+                bloom.add(name)
+            self._filter = bloom
+            self._seen = epoch
+            self._built_at = time.monotonic()
+        return bloom
+
+    def might_exist(self, name, rebuild=True):
+        """
+        Returns False only if no row has the given name. With rebuild=False an
+        outdated filter is not rebuilt here and answers True, which lets
+        callers that must not block, or have no application context, use it.
+        """
+
+        bloom = self._filter
+        if bloom is None or bloom.count > bloom.capacity or self.epoch.current() != self._seen:
+            if not rebuild or (
+                bloom is not None and time.monotonic() - self._built_at < self.rebuild_interval
+            ):
+                return True
+            bloom = self.build()
+        return name in bloom
+
+    def on_change(self, message):
+        """
+        Change broker listener, adds created and renamed names and bumps the
+        names epoch for the other processes. A filter that was current before
+        the bump stays current.
+        """
+
+        if message["type"] != self.kind:
+            return
+        if message["action"] != "created" and "previous_name" not in message:
+            return
+        # Under the lock, so that _seen never passes a name not yet added
+        with self._lock:
+            bloom = self._filter
+            if bloom is not None:
+                bloom.add(message["name"])
+            bumped = self.epoch.bump()
+            if bloom is not None and self._seen == self.epoch.last_bump[0]:
+                self._seen = bumped
+
+
+def init_app(app):
+    epochs = app.extensions["nearby_epochs"]
+    filters = app.extensions["nearby_names"] = {
+        "area": NameFilter("area", Area.name, epochs.names["area"],
+            app.config["NAME_FILTER_ERROR_RATE"], app.config["NAME_FILTER_REBUILD_INTERVAL"]
+        ),
+        "event": NameFilter("event", Event.name, epochs.names["event"],
+            app.config["NAME_FILTER_ERROR_RATE"], app.config["NAME_FILTER_REBUILD_INTERVAL"]
+        ),
+    }
+    for name_filter in filters.values():
+        app.extensions["nearby_changes"].add_listener(name_filter.on_change)
+        app.extensions["nearby_warmup"].append(name_filter.build)
+    return filters
+
+
+def might_exist(kind, name):
+    """
+    Returns False if the current app has no area or event (kind) with the
+    given name.
+    """
+
+    return current_app.extensions["nearby_names"][kind].might_exist(name)
@@ -0,0 +1,172 @@
+"""
+Per-day event counts of an area's months for the calendar resource. A month
+is counted with one GROUP BY over the (area_id, begins_at) index.
+
+Past months and months at least CALENDAR_LIVE_MONTHS ahead change rarely,
+so their days are cached in each process, up to CALENDAR_CACHE_SIZE months.
+The current and the next months, where tickets sell, are always counted.
+Committed event changes, including ticket sales and reservations released
+by the sweeper through the event counters, drop only the months of the
+events they touch, before and after the change. Changes made by other
+server workers are not announced to this process and show up after
+CALENDAR_CACHE_TTL seconds.
+"""
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import and_, func, select
+from nearbyEvents import db
+from nearbyEvents.models import Event
+
+events = Event.__table__
+MISSING = object()
+
+
+def parse_month(value):
+    """
+    Returns the first day of a YYYY-MM month, raises ValueError if the value
+    is not one or the month has no previous or next month.
+    """
+
+    try:
+        month = datetime.datetime.strptime(value, "%Y-%m").date()
+        add_months(month, -1)
+        add_months(month, 1)
+    except (TypeError, ValueError):
+        raise ValueError("month must be given as YYYY-MM between 0001-02 and 9999-11")
+    return month
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def count_days(area_id, month):
+    """
+    Returns the days of the month with events of the area as dicts of the
+    date, the number of events and their remaining tickets.
+    """
+
+    start = datetime.datetime.combine(month, datetime.time())
+    end = datetime.datetime.combine(add_months(month, 1), datetime.time())
+    day = func.date(events.c.begins_at).label("day")
+    rows = db.session.execute(
+        select([
+            day,
+            func.count(events.c.id),
+            func.coalesce(func.sum(events.c.max_tickets - events.c.tickets_sold), 0)
+        ]).where(and_(
+            events.c.area_id == area_id, events.c.begins_at >= start, events.c.begins_at < end
+        )).group_by(day).order_by(day)
+    ).fetchall()
+    return [
+        {"date": str(date)[:10], "events": count, "tickets_remaining": int(remaining)}
+        for date, count, remaining in rows
+    ]
+
+
+class CalendarCache(object):
+    """
+    LRU cache of counted months by (area id, YYYY-MM).
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Bumped by every invalidation, so that a month counted before a
+        # change is not stored after it
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            days, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return days
+
+    def put(self, key, days, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (days, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, area_id=None, month=None):
+        """
+        Drops the given month of the area, all months of the area without a
+        month, and everything without an area.
+        """
+
+        with self._lock:
+            self.generation += 1
+            if area_id is None:
+                self._entries.clear()
+            elif month is not None:
+                self._entries.pop((area_id, month), None)
+            else:
+                for key in [key for key in self._entries if key[0] == area_id]:
+                    del self._entries[key]
+
+    def on_change(self, message):
+        """
+        Change broker listener, drops the months an event was and is in.
+        """
+
+        if message["type"] == "area":
+            if message["action"] == "deleted":
+                self.invalidate()
+            return
+        # The message lacks the fields that were not loaded
+        current = (message.get("area_id", MISSING), message.get("begins_at", MISSING))
+        previous = (
+            message.get("previous_area_id", current[0]), message.get("previous_begins_at", current[1])
+        )
+        for area_id, begins_at in {current, previous}:
+            if area_id is MISSING:
+                self.invalidate()
+            elif area_id is None:
+                continue
+            elif begins_at is MISSING:
+                self.invalidate(area_id)
+            elif begins_at is not None:
+                self.invalidate(area_id, begins_at[:7])
+
+
+def month_days(area_id, month):
+    """
+    Returns the counted days of the month, from the cache for past and far
+    future months.
+    """
+
+    today = datetime.date.today().replace(day=1)
+    cacheable = month < today or month >= add_months(today, current_app.config["CALENDAR_LIVE_MONTHS"])
+    if not cacheable:
+        return count_days(area_id, month)
+    cache = current_app.extensions["nearby_calendar"]
+    key = (area_id, month.strftime("%Y-%m"))
+    days = cache.get(key)
+    if days is None:
+        generation = cache.generation
+        days = count_days(area_id, month)
+        cache.put(key, days, generation)
+    return days
+
+
+def init_app(app):
+    cache = app.extensions["nearby_calendar"] = CalendarCache(
+        app.config["CALENDAR_CACHE_TTL"], app.config["CALENDAR_CACHE_SIZE"]
+    )
+    app.extensions["nearby_changes"].add_listener(cache.on_change)
+    return cache
@@ -2,4 +2,6 @@ MASON = "application/vnd.mason+json"
 LINK_RELATIONS_URL = "/nearbyevents/link-relations/"
 ERROR_PROFILE = "/profiles/error/"
 AREA_PROFILE = "/profiles/area/"
-EVENT_PROFILE = "/profiles/event/"
\ No newline at end of file
+EVENT_PROFILE = "/profiles/event/"
+SSE = "text/event-stream"
+SSE_RETRY_MS = 3000
@@ -0,0 +1,170 @@
+"""
+Group commit of resource writes. A write is expressed as a unit: a function
+that applies the change to the session it is given and returns whether the
+row it changes still existed. Without GROUP_COMMIT the unit runs in the
+request's session and is committed right away.
+
+With GROUP_COMMIT the request hands its unit to the committer thread of its
+process and waits. The committer collects the units arriving within
+GROUP_COMMIT_WINDOW seconds (at most GROUP_COMMIT_MAX_BATCH) and commits
+them in one transaction, so a burst of writes costs one fsync instead of one
+per request. If the batch fails, typically because one of the units violates
+a unique constraint, it is rolled back and every unit is committed on its
+own, which gives each request exactly the outcome it would have had alone.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from flask import current_app
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from nearbyEvents import db
+
+
+class GroupCommitMetrics(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.units = 0
+        self.batches = 0
+        self.fallbacks = 0
+        self.largest_batch = 0
+
+    def record(self, size, fallback):
+        with self._lock:
+            self.units += size
+            self.batches += 1
+            self.fallbacks += fallback
+            self.largest_batch = max(self.largest_batch, size)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "units": self.units,
+                "batches": self.batches,
+                "fallbacks": self.fallbacks,
+                "largest_batch": self.largest_batch,
+            }
+
+
+class GroupCommitter(object):
+
+    def __init__(self, app, window, max_batch):
+        self.app = app
+        self.window = window
+        self.max_batch = max_batch
+        self.metrics = GroupCommitMetrics()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # Threads do not survive a fork, each worker starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name="nearby-group-commit", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, unit):
+        """
+        Runs the unit in the next batch and returns its result. Raises the
+        IntegrityError of the unit if it could not be committed.
+        """
+
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((unit, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            with self.app.app_context():
+                try:
+                    self.commit_batch(batch)
+                except Exception as e:
+                    self.app.logger.exception("Group commit failed")
+                    for unit, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                finally:
+                    db.session.remove()
+
+    def commit_batch(self, batch):
+        """
+        Commits the units of the batch together, or one by one if that
+        fails. Must be called within an application context.
+        """
+
+        session = db.session
+        try:
+            results = [unit(session) for unit, future in batch]
+            session.commit()
+        except SQLAlchemyError:
+            session.rollback()
+            self.metrics.record(len(batch), True)
+            for unit, future in batch:
+                self._commit_one(session, unit, future)
+            return
+        self.metrics.record(len(batch), False)
+        for (unit, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _commit_one(self, session, unit, future):
+        try:
+            result = unit(session)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+
+def init_app(app):
+    if app.config["GROUP_COMMIT"]:
+        app.extensions["nearby_group_commit"] = GroupCommitter(
+            app, app.config["GROUP_COMMIT_WINDOW"], app.config["GROUP_COMMIT_MAX_BATCH"]
+        )
+
+
+def run_unit(unit):
+    """
+    Applies and commits a unit of work for the current request and returns
+    its result. Raises IntegrityError if the change conflicts with existing
+    rows; the request's session is rolled back in that case.
+    """
+
+    committer = current_app.extensions.get("nearby_group_commit")
+    if committer is None:
+        try:
+            result = unit(db.session)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise
+        return result
+    # End the request's read transaction so that it does not hold a lock the
+    # committer waits for
+    db.session.rollback()
+    return committer.submit(unit)
@@ -0,0 +1,111 @@
+"""
+Idempotency-Key support for POST requests. The outcome of a successful
+request is stored in the same transaction as the rows it created, so a retry
+carrying the same key gets the original response replayed from the
+idempotency table without validating the document again or touching the
+main tables. Stored outcomes expire after IDEMPOTENCY_TTL seconds and the
+table is kept below IDEMPOTENCY_MAX_KEYS rows.
+"""
+import datetime
+import functools
+import itertools
+from flask import Response, current_app, g, request
+from nearbyEvents import db
+from nearbyEvents.models import IdempotencyKey
+from nearbyEvents.utils import create_error_response
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+# Expired and surplus keys are purged on every PURGE_INTERVAL-th stored outcome
+PURGE_INTERVAL = 100
+_stored = itertools.count(1)
+
+
+def _cutoff():
+    return datetime.datetime.now() - datetime.timedelta(
+        seconds=current_app.config["IDEMPOTENCY_TTL"]
+    )
+
+
+def _lookup(key):
+    return IdempotencyKey.query.filter(
+        IdempotencyKey.key == key, IdempotencyKey.created_at >= _cutoff()
+    ).first()
+
+
+def _replay(stored):
+    if stored.method != request.method or stored.path != request.path:
+        return create_error_response(422, "Idempotency key reused",
+            "Key '{}' was already used for {} {}".format(stored.key, stored.method, stored.path)
+        )
+    headers = {REPLAYED_HEADER: "true"}
+    if stored.location is not None:
+        headers["Location"] = stored.location
+    return Response(status=stored.status, headers=headers)
+
+
+def purge_keys():
+    """
+    Deletes expired outcomes and the oldest ones beyond the size bound.
+    """
+
+    newest = db.session.query(db.func.max(IdempotencyKey.id)).scalar() or 0
+    IdempotencyKey.query.filter(db.or_(
+        IdempotencyKey.created_at < _cutoff(),
+        IdempotencyKey.id <= newest - current_app.config["IDEMPOTENCY_MAX_KEYS"]
+    )).delete(synchronize_session=False)
+
+
+def record_outcome(status, location=None):
+    """
+    Adds the outcome of the current request to the session if the client sent
+    an idempotency key. Must be called before the request's commit.
+    """
+
+    key = g.get("idempotency_key")
+    if key is None:
+        return
+    # An expired outcome of the same key may still be in the table
+    IdempotencyKey.query.filter(
+        IdempotencyKey.key == key, IdempotencyKey.created_at < _cutoff()
+    ).delete(synchronize_session=False)
+    db.session.add(IdempotencyKey(
+        key=key,
+        method=request.method,
+        path=request.path,
+        status=status,
+        location=location,
+        created_at=datetime.datetime.now()
+    ))
+    if next(_stored) % PURGE_INTERVAL == 0:
+        purge_keys()
+
+
+def idempotent(method):
+    """
+    Decorator for resource methods that create resources. Requests without
+    the header are passed through unchanged.
+    """
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return method(*args, **kwargs)
+        if not key or len(key) > 64:
+            return create_error_response(400, "Invalid idempotency key",
+                "{} must be 1-64 characters long".format(IDEMPOTENCY_HEADER)
+            )
+        stored = _lookup(key)
+        if stored is not None:
+            return _replay(stored)
+        g.idempotency_key = key
+        response = method(*args, **kwargs)
+        if response.status_code == 409:
+            # A concurrent retry with the same key may have won the race
+            stored = _lookup(key)
+            if stored is not None:
+                return _replay(stored)
+        return response
+    return wrapper
@@ -0,0 +1,282 @@
+"""
+Rendered responses of the area and event items, enabled with ITEM_CACHE.
+Each process keeps up to ITEM_CACHE_SIZE response bodies by item id, and
+the names of the cached items.
+
+Entries are dropped after every committed change of their item: in the
+committing process through the change broker, in the other server workers
+through the epoch files of areas and events (see
+notifications.CatalogueEpochs), which drop all cached items of the kind.
+Concurrent requests missing the same item wait for the first one to render
+it instead of all querying the database. The ITEM_CACHE_WARM hottest items
+(see nearbyEvents.popularity) are rendered when a worker starts and again
+by a background thread after they were dropped, so a burst of requests for a
+popular item right after a change finds it cached.
+"""
+import os
+import queue
+import threading
+from collections import OrderedDict
+from flask import current_app
+from nearbyEvents import db
+
+# Seconds a request waits for another one rendering the same item
+RENDER_WAIT = 5
+
+
+class ItemCache(object):
+
+    def __init__(self, epochs, max_entries):
+        self.epochs = epochs
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # (kind, id) -> (name, body) and (kind, name) -> id
+        self._entries = OrderedDict()
+        self._ids = {}
+        self._seen = {kind: epochs[kind].current() for kind in epochs.files}
+        self._rendering = {}
+        # Bumped by every invalidation, so that an item rendered before a
+        # change is not stored after it
+        self.generation = 0
+        self.hits = self.misses = self.coalesced = self.warmed = 0
+        # Called with the kind and ids of dropped items
+        self.on_drop = None
+
+    def _check_epoch(self, kind):
+        current = self.epochs[kind].current()
+        if current == self._seen[kind]:
+            return
+        with self._lock:
+            dropped = [key[1] for key in self._entries if key[0] == kind]
+            self._drop_kind(kind)
+            self._seen[kind] = current
+        if dropped and self.on_drop is not None:
+            self.on_drop(kind, dropped)
+
+    def _drop_kind(self, kind):
+        self.generation += 1
+        for key in [key for key in self._entries if key[0] == kind]:
+            del self._entries[key]
+        for key in [key for key in self._ids if key[0] == kind]:
+            del self._ids[key]
+
+    def get(self, kind, name=None, item_id=None):
+        """
+        Returns the (id, name, body) of the cached item with the given name or
+        id, or None.
+        """
+
+        self._check_epoch(kind)
+        with self._lock:
+            if item_id is None:
+                item_id = self._ids.get((kind, name))
+            entry = self._entries.get((kind, item_id))
+            if entry is None:
+                return None
+            self._entries.move_to_end((kind, item_id))
+            return (item_id,) + entry
+
+    def contains(self, kind, item_id):
+        return (kind, item_id) in self._entries
+
+    def put(self, kind, item_id, name, body, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[(kind, item_id)] = (name, body)
+            self._entries.move_to_end((kind, item_id))
+            self._ids[(kind, name)] = item_id
+            while len(self._entries) > self.max_entries:
+                (old_kind, old_id), (old_name, old_body) = self._entries.popitem(last=False)
+                self._ids.pop((old_kind, old_name), None)
+
+    def load(self, kind, name, item_id, render):
+        """
+        Returns the cached item or renders it with render(name, item_id),
+        which returns (id, name, body) or None for unknown items. Only one of
+        the concurrent requests for an item renders it.
+        """
+
+        found = self.get(kind, name, item_id)
+        if found is not None:
+            self.hits += 1
+            return found
+        key = (kind, name, item_id)
+        with self._lock:
+            waiting = self._rendering.get(key)
+            if waiting is None:
+                self._rendering[key] = threading.Event()
+        if waiting is not None:
+            waiting.wait(RENDER_WAIT)
+            found = self.get(kind, name, item_id)
+            if found is not None:
+                self.coalesced += 1
+                return found
+        self.misses += 1
+        try:
+            generation = self.generation
+            found = render(name, item_id)
+            if found is not None:
+                self.put(kind, found[0], found[1], found[2], generation)
+            return found
+        finally:
+            if waiting is None:
+                with self._lock:
+                    self._rendering.pop(key).set()
+
+    def invalidate(self, kind, item_id=None, names=()):
+        with self._lock:
+            if item_id is None:
+                self._drop_kind(kind)
+                return
+            self.generation += 1
+            entry = self._entries.pop((kind, item_id), None)
+            if entry is not None:
+                self._ids.pop((kind, entry[0]), None)
+            for name in names:
+                self._ids.pop((kind, name), None)
+
+    def on_change(self, message):
+        """
+        Change broker listener, drops the changed item. Runs after the epoch
+        was bumped for this change, so the other cached items stay valid.
+        """
+
+        kind = message["type"]
+        names = [message[key] for key in ("name", "previous_name") if key in message]
+        self.invalidate(kind, message.get("item_id"), names)
+        # The events of a deleted area lose their area link
+        if kind == "area" and message["action"] == "deleted":
+            self.invalidate("event")
+        previous, bumped = self.epochs[kind].last_bump
+        if self._seen[kind] == previous:
+            self._seen[kind] = bumped
+        if message.get("item_id") is not None and message["action"] != "deleted" and self.on_drop is not None:
+            self.on_drop(kind, [message["item_id"]])
+
+    def as_dict(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "warmed": self.warmed,
+        }
+
+
+class CacheWarmer(object):
+    """
+    Renders hot items into the cache from a background thread of each
+    process.
+    """
+
+    def __init__(self, app, cache, renderers, count):
+        self.app = app
+        self.cache = cache
+        self.renderers = renderers
+        self.count = count
+        self._queue = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_thread(self):
+        # Threads do not survive a fork, each worker starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            threading.Thread(target=self._run, name="nearby-cache-warmer", daemon=True).start()
+            self._pid = os.getpid()
+
+    def hot(self, kind=None):
+        popularity = self.app.extensions.get("nearby_popularity")
+        if popularity is None:
+            return []
+        return [(item_kind, item_id) for item_kind, item_id, count in popularity.hottest(self.count, kind)]
+
+    def on_drop(self, kind, item_ids):
+        popularity = self.app.extensions.get("nearby_popularity")
+        if popularity is None:
+            return
+        hot = [(kind, item_id) for item_id in item_ids if popularity.is_hot(kind, item_id)]
+        if hot:
+            self._ensure_thread()
+            self._queue.put(hot)
+
+    def _run(self):
+        while True:
+            items = self._queue.get()
+            try:
+                self.warm(items)
+            except Exception:
+                self.app.logger.exception("Warming the item cache failed")
+            finally:
+                self._queue.task_done()
+
+    def warm(self, items):
+        """
+        Renders the given (kind, id) items that are not cached.
+        """
+
+        with self.app.test_request_context("/"):
+            try:
+                for kind, item_id in items:
+                    if not self.cache.contains(kind, item_id):
+                        self.cache.load(kind, None, item_id, self.renderers[kind])
+                        self.cache.warmed += 1
+            finally:
+                db.session.remove()
+
+    def warm_up(self):
+        # Warm-up hook of the server workers
+        popularity = self.app.extensions.get("nearby_popularity")
+        if popularity is not None:
+            popularity.load()
+        self.warm(self.hot())
+
+    def flush(self):
+        """
+        Waits until the queued items have been rendered.
+        """
+
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.join()
+
+
+def serve_item(kind, name, item_id, render):
+    """
+    Returns the response body of the item with the given name or id, from
+    the cache when enabled, or None for unknown items. Counts the request
+    for the popularity of the item.
+    """
+
+    cache = current_app.extensions.get("nearby_item_cache")
+    if cache is None:
+        found = render(name, item_id)
+    else:
+        found = cache.load(kind, name, item_id, render)
+    if found is None:
+        return None
+    popularity = current_app.extensions.get("nearby_popularity")
+    if popularity is not None:
+        popularity.record(kind, found[0])
+    return found[2]
+
+
+def init_app(app):
+    if not app.config["ITEM_CACHE"]:
+        return None
+    from nearbyEvents.resources.area import render_area
+    from nearbyEvents.resources.event import render_event
+    cache = app.extensions["nearby_item_cache"] = ItemCache(
+        app.extensions["nearby_epochs"], app.config["ITEM_CACHE_SIZE"]
+    )
+    warmer = app.extensions["nearby_cache_warmer"] = CacheWarmer(
+        app, cache, {"area": render_area, "event": render_event}, app.config["ITEM_CACHE_WARM"]
+    )
+    cache.on_drop = warmer.on_drop
+    app.extensions["nearby_changes"].add_listener(cache.on_change)
+    app.extensions["nearby_warmup"].append(warmer.warm_up)
+    return cache
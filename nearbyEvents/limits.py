@@ -0,0 +1,226 @@
+"""
+Rate limiting and load shedding of API requests, enabled with RATE_LIMIT.
+
+Every request is given a priority: writes, catalogue item reads, and scans
+of collections. Each client has a token bucket per route; RATE_LIMITS gives
+the rate (tokens per second) and burst size by endpoint or by priority, and
+a request finding its bucket empty gets a 429 with Retry-After.
+
+The buckets live in an anonymous shared memory map created with the app, so
+the workers forked by the production server (flask serve) share them. The
+table has RATE_LIMIT_SLOTS slots addressed by the hash of client and route;
+two keys hashing to the same slot take turns with it, and a client displacing
+another starts with a full bucket.
+
+Load is measured per worker as requests in flight relative to
+SHED_MAX_INFLIGHT and the moving average of query time relative to
+SHED_DB_LATENCY. Scans are shed with a 503 once the load reaches 1, item
+reads once it reaches 2, writes never. Shed requests run no queries, so the
+average decays with the time since the latest query and shedding ends once
+the database had time to recover.
+"""
+import hashlib
+import math
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+from flask import g, request
+from sqlalchemy import event
+from nearbyEvents.routing import for_each_engine
+from nearbyEvents.utils import create_error_response
+
+# Key hash, tokens, last refill time
+SLOT = struct.Struct("<Qdd")
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+SCAN_ENDPOINTS = {
+    "api.areacollection", "api.eventcollection", "api.eventsbyarea", "api.salesstatistics"
+}
+# Load at which requests of each priority are shed
+SHED_AT = {"scan": 1.0, "read": 2.0}
+# Weight of the latest query in the average query time
+LATENCY_WEIGHT = 0.05
+# Seconds in which the average query time halves while no queries run
+LATENCY_HALF_LIFE = 1.0
+
+
+class TokenBuckets(object):
+    """
+    Fixed size table of token buckets in memory shared with forked
+    processes.
+    """
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._memory = mmap.mmap(-1, slots * SLOT.size)
+        self._lock = multiprocessing.Lock()
+
+    def take(self, key, rate, burst):
+        """
+        Takes a token from the bucket of the key. Returns 0 if one was
+        available, otherwise the seconds until there is one.
+        """
+
+        digest = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+        offset = digest % self.slots * SLOT.size
+        # A worker that died holding the lock must not stop the others
+        if not self._lock.acquire(timeout=0.05):
+            return 0
+        try:
+            now = time.monotonic()
+            owner, tokens, updated = SLOT.unpack_from(self._memory, offset)
+            if owner != digest:
+                tokens, updated = burst, now
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            SLOT.pack_into(self._memory, offset, digest, tokens, now)
+        finally:
+            self._lock.release()
+        return wait
+
+
+class LoadMonitor(object):
+    """
+    Requests in flight and average query time of this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.latency = 0.0
+        self.sampled = time.monotonic()
+        self.limited = 0
+        self.shed = 0
+
+    def enter(self):
+        with self._lock:
+            self.inflight += 1
+
+    def leave(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def reject(self, shed):
+        with self._lock:
+            if shed:
+                self.shed += 1
+            else:
+                self.limited += 1
+
+    def current_latency(self, now=None):
+        """
+        Returns the average query time, decayed by the time since the latest
+        query.
+        """
+
+        if now is None:
+            now = time.monotonic()
+        idle = now - self.sampled
+        return self.latency * 0.5 ** (max(idle, 0) / LATENCY_HALF_LIFE)
+
+    def record_query(self, seconds):
+        now = time.monotonic()
+        with self._lock:
+            latency = self.current_latency(now)
+            self.latency = latency + (seconds - latency) * LATENCY_WEIGHT
+            self.sampled = now
+
+    def load(self, max_inflight, max_latency):
+        load = 0.0
+        if max_inflight:
+            load = self.inflight / max_inflight
+        if max_latency:
+            load = max(load, self.current_latency() / max_latency)
+        return load
+
+    def as_dict(self):
+        return {
+            "inflight": self.inflight,
+            "query_latency": self.current_latency(),
+            "rate_limited": self.limited,
+            "shed": self.shed,
+        }
+
+
+def priority(req):
+    if req.method not in SAFE_METHODS:
+        return "write"
+    if req.endpoint in SCAN_ENDPOINTS:
+        return "scan"
+    return "read"
+
+
+def _retry_after(response, seconds):
+    response.headers["Retry-After"] = str(max(1, int(math.ceil(seconds))))
+    return response
+
+
+class Limiter(object):
+
+    def __init__(self, app):
+        config = app.config
+        self.app = app
+        self.limits = config["RATE_LIMITS"]
+        self.max_inflight = config["SHED_MAX_INFLIGHT"]
+        self.max_latency = config["SHED_DB_LATENCY"]
+        self.buckets = TokenBuckets(config["RATE_LIMIT_SLOTS"])
+        self.monitor = LoadMonitor()
+
+    def watch_queries(self):
+        """
+        Times the queries of the app's engines.
+        """
+
+        if not self.max_latency:
+            return
+        for_each_engine(self.app, self._listen)
+
+    def _listen(self, engine):
+        event.listen(engine, "before_cursor_execute", self._query_started)
+        event.listen(engine, "after_cursor_execute", self._query_finished)
+
+    def _query_started(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("nearby_query_started", []).append(time.monotonic())
+
+    def _query_finished(self, conn, cursor, statement, parameters, context, executemany):
+        self.monitor.record_query(time.monotonic() - conn.info["nearby_query_started"].pop())
+
+    def before_request(self):
+        if request.endpoint is None or request.endpoint == "static":
+            return None
+        level = priority(request)
+        limit = self.limits.get(request.endpoint) or self.limits.get(level)
+        if limit is not None:
+            wait = self.buckets.take(
+                "{}|{}".format(request.remote_addr, request.endpoint), *limit
+            )
+            if wait:
+                self.monitor.reject(False)
+                return _retry_after(create_error_response(429, "Too many requests",
+                    "Rate limit of this resource exceeded"
+                ), wait)
+        if level in SHED_AT and self.monitor.load(self.max_inflight, self.max_latency) >= SHED_AT[level]:
+            self.monitor.reject(True)
+            return _retry_after(create_error_response(503, "Service unavailable",
+                "The server is busy, try again later"
+            ), 1)
+        self.monitor.enter()
+        g.nearby_inflight = True
+        return None
+
+    def teardown_request(self, exc=None):
+        if g.pop("nearby_inflight", False):
+            self.monitor.leave()
+
+
+def init_app(app):
+    if not app.config["RATE_LIMIT"]:
+        return None
+    limiter = app.extensions["nearby_limiter"] = Limiter(app)
+    app.before_first_request(limiter.watch_queries)
+    app.before_request(limiter.before_request)
+    app.teardown_request(limiter.teardown_request)
+    return limiter
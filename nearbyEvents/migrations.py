@@ -0,0 +1,251 @@
+"""
+Versioned schema migrations for databases created before the current
+schema. Each migration adds its columns, which is a change of the table
+definition only and does not rewrite the rows, then backfills them a chunk
+of MIGRATION_CHUNK_SIZE rows at a time. Every chunk is its own short
+transaction followed by a MIGRATION_CHUNK_SLEEP pause, so requests keep
+writing while millions of events are migrated. Indexes are built last, one
+per transaction, when the columns they cover are filled.
+
+Applied versions are recorded in the schema_migration table. The
+migrations only add what is missing, so a database created with
+db.create_all() can be migrated too. Columns replaced by a migration, like
+the area_name foreign key of events, are left in place.
+
+    flask migrateDatabase
+    flask migrateDatabase --status
+"""
+import datetime
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, bindparam, func, inspect, select, text
+from nearbyEvents import db
+from nearbyEvents.aggregates import fill_ticket_prices, refresh_area_aggregates, refresh_event_aggregates
+from nearbyEvents.models import Area, Event, SchemaMigration, Ticket, parse_begin
+
+areas = Area.__table__
+events = Event.__table__
+tickets = Ticket.__table__
+
+
+class Migration(object):
+    """
+    A schema change: columns added as (table, column definition) pairs, a
+    backfill generator yielding its progress as (done, total) after each
+    chunk, and names of model indexes to build.
+    """
+
+    def __init__(self, version, name, columns=(), backfill=None, indexes=()):
+        self.version = version
+        self.name = name
+        self.columns = columns
+        self.backfill = backfill
+        self.indexes = indexes
+
+
+def _columns(table):
+    return {column["name"] for column in inspect(db.engine).get_columns(table)}
+
+
+def _id_ranges(table, chunk_size):
+    """
+    Returns the (after, last) id ranges covering the table in chunks and the
+    number of ids they span.
+    """
+
+    low, high = db.session.execute(select([func.min(table.c.id), func.max(table.c.id)])).first()
+    if low is None:
+        return [], 0
+    ranges = [(after, min(after + chunk_size, high)) for after in range(low - 1, high, chunk_size)]
+    return ranges, high - low + 1
+
+
+def _backfill_begins_at(chunk_size):
+    pending = and_(events.c.begins_at == None, events.c.event_begin != None)
+    total = db.session.execute(select([func.count()]).select_from(events).where(pending)).scalar()
+    update = events.update().where(events.c.id == bindparam("_id")).values(begins_at=bindparam("_begins_at"))
+    done = last = 0
+    while True:
+        rows = db.session.execute(
+            select([events.c.id, events.c.event_begin])
+            .where(and_(pending, events.c.id > last))
+            .order_by(events.c.id).limit(chunk_size)
+        ).fetchall()
+        if not rows:
+            return
+        parsed = [{"_id": id, "_begins_at": parse_begin(begin)} for id, begin in rows]
+        parsed = [row for row in parsed if row["_begins_at"] is not None]
+        if parsed:
+            db.session.execute(update, parsed)
+        done += len(rows)
+        last = rows[-1][0]
+        yield done, total
+
+
+def _backfill_area_id(chunk_size):
+    # area_name exists only in databases created before area_id
+    if "area_name" not in _columns("event"):
+        return
+    statement = text(
+        "UPDATE event SET area_id = (SELECT area.id FROM area WHERE area.name = event.area_name) "
+        "WHERE area_id IS NULL AND area_name IS NOT NULL AND id > :after AND id <= :last"
+    )
+    ranges, total = _id_ranges(events, chunk_size)
+    done = 0
+    for after, last in ranges:
+        db.session.execute(statement, {"after": after, "last": last})
+        done += last - after
+        yield done, total
+
+
+def _backfill_ticket_prices(chunk_size):
+    ranges, total = _id_ranges(tickets, chunk_size)
+    done = 0
+    for after, last in ranges:
+        fill_ticket_prices(and_(tickets.c.id > after, tickets.c.id <= last))
+        done += last - after
+        yield done, total
+
+
+def _backfill_aggregates(chunk_size):
+    event_ranges, event_total = _id_ranges(events, chunk_size)
+    area_ranges, area_total = _id_ranges(areas, chunk_size)
+    total = event_total + area_total
+    done = 0
+    for after, last in event_ranges:
+        refresh_event_aggregates(and_(events.c.id > after, events.c.id <= last))
+        done += last - after
+        yield done, total
+    # The area sums read the event counters filled in above
+    for after, last in area_ranges:
+        refresh_area_aggregates(and_(areas.c.id > after, areas.c.id <= last))
+        done += last - after
+        yield done, total
+
+
+MIGRATIONS = [
+    Migration(1, "Typed begin time of events",
+        columns=[("event", "begins_at DATETIME")],
+        backfill=_backfill_begins_at
+    ),
+    Migration(2, "Events linked to areas by id",
+        columns=[("event", "area_id INTEGER REFERENCES area (id) ON DELETE SET NULL")],
+        backfill=_backfill_area_id
+    ),
+    Migration(3, "Price of each ticket",
+        columns=[("ticket", "price FLOAT")],
+        backfill=_backfill_ticket_prices
+    ),
+    Migration(4, "Ticket sales aggregates",
+        columns=[
+            ("event", "tickets_sold INTEGER NOT NULL DEFAULT 0"),
+            ("event", "revenue FLOAT NOT NULL DEFAULT 0"),
+            ("area", "capacity INTEGER NOT NULL DEFAULT 0"),
+            ("area", "tickets_sold INTEGER NOT NULL DEFAULT 0"),
+            ("area", "revenue FLOAT NOT NULL DEFAULT 0"),
+        ],
+        backfill=_backfill_aggregates
+    ),
+    Migration(5, "Indexes for event pages and the reservation sweeper",
+        indexes=["ix_event_area_id_begins_at", "ix_reservation_paid_created_at"]
+    ),
+]
+
+
+def current_version():
+    return db.session.query(func.coalesce(func.max(SchemaMigration.version), 0)).scalar()
+
+
+def stamp(version=None):
+    """
+    Records the migrations up to version (all by default) as applied without
+    running them.
+    """
+
+    if version is None:
+        version = MIGRATIONS[-1].version
+    applied = current_version()
+    for migration in MIGRATIONS:
+        if applied < migration.version <= version:
+            db.session.add(SchemaMigration(
+                version=migration.version, name=migration.name, applied_at=datetime.datetime.now()
+            ))
+    db.session.commit()
+
+
+def _index(name):
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(name)
+
+
+def apply(migration, chunk_size, pause, progress=None):
+    for table, definition in migration.columns:
+        if definition.split()[0] not in _columns(table):
+            db.session.execute("ALTER TABLE {} ADD COLUMN {}".format(table, definition))
+            db.session.commit()
+    if migration.backfill is not None:
+        for done, total in migration.backfill(chunk_size):
+            db.session.commit()
+            if progress is not None:
+                progress(migration, done, total)
+            time.sleep(pause)
+    db.session.commit()
+    for name in migration.indexes:
+        index = _index(name)
+        existing = {i["name"] for i in inspect(db.engine).get_indexes(index.table.name)}
+        if name not in existing:
+            index.create(db.engine)
+    db.session.add(SchemaMigration(
+        version=migration.version, name=migration.name, applied_at=datetime.datetime.now()
+    ))
+    db.session.commit()
+
+
+def migrate(target=None, chunk_size=None, pause=None, progress=None):
+    """
+    Applies the migrations newer than the database up to target (the latest
+    by default) and returns the ones applied.
+    """
+
+    config = current_app.config
+    chunk_size = chunk_size or config["MIGRATION_CHUNK_SIZE"]
+    pause = config["MIGRATION_CHUNK_SLEEP"] if pause is None else pause
+    # New tables, including schema_migration, are created whole
+    db.create_all()
+    applied = current_version()
+    done = []
+    for migration in MIGRATIONS:
+        if applied < migration.version and (target is None or migration.version <= target):
+            apply(migration, chunk_size, pause, progress)
+            done.append(migration)
+    return done
+
+
+@click.command("migrateDatabase")
+@click.option("--target", type=int, default=None, help="Stop at this version.")
+@click.option("--chunk-size", type=int, default=None, help="Rows updated per transaction.")
+@click.option("--status", is_flag=True, help="Only list the migrations and the current version.")
+@with_appcontext
+def migrateDatabase(target, chunk_size, status):
+    if status:
+        db.create_all()
+        applied = current_version()
+        for migration in MIGRATIONS:
+            click.echo("{} {:>3}  {}".format(
+                "applied" if migration.version <= applied else "pending", migration.version, migration.name
+            ))
+        return
+
+    def progress(migration, done, total):
+        click.echo("{:>3} {}: {}/{}".format(migration.version, migration.name, done, total))
+
+    started = time.monotonic()
+    applied = migrate(target, chunk_size, progress=progress)
+    click.echo("Applied {} migrations in {:.1f} s, database at version {}".format(
+        len(applied), time.monotonic() - started, current_version()
+    ))
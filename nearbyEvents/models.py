@@ -1,14 +1,29 @@
 import click
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask.cli import with_appcontext
 from nearbyEvents import db
 import datetime
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///test.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-#db = SQLAlchemy()
+# Formats of event_begin besides ISO 8601
+BEGIN_FORMATS = ("%Y.%m.%d", "%d.%m.%Y")
+
+def parse_begin(value):
+    """
+    Parses the free text begin time of an event, returns None if the format
+    is not recognized.
+    """
+
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    for fmt in BEGIN_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)    
@@ -23,19 +38,35 @@ class User(db.Model):
     managed_events = db.relationship("Event", back_populates="is_managed_by")
 
 class Event(db.Model):
+    # Keyset pagination of the events of an area by begin time
+    __table_args__ = (db.Index("ix_event_area_id_begins_at", "area_id", "begins_at", "id"),)
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False, unique=True)
     max_tickets = db.Column(db.Integer, nullable=False)
     ticket_price = db.Column(db.Float, nullable=True)
     status = db.Column(db.String(16), nullable=False)
     event_begin = db.Column(db.String(64), nullable=True)
+    # event_begin parsed, None if its format is not recognized
+    begins_at = db.Column(db.DateTime, nullable=True)
     event_manager = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="SET NULL", onupdate="CASCADE"), nullable=True)
-    area_name = db.Column(db.String(64), db.ForeignKey("area.name", ondelete="SET NULL", onupdate="CASCADE"), nullable=True)
+    area_id = db.Column(db.Integer, db.ForeignKey("area.id", ondelete="SET NULL"), nullable=True)
+    # Maintained by nearbyEvents.aggregates
+    tickets_sold = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
     
     reservations =  db.relationship("Reservation", back_populates="for_event", cascade="all, delete-orphan")
     is_managed_by = db.relationship("User", back_populates="managed_events", foreign_keys=[event_manager])
     in_area = db.relationship("Area", back_populates="events")
 
+    @property
+    def area_name(self):
+        return self.in_area.name if self.in_area is not None else None
+
+    @db.validates("event_begin")
+    def _parse_event_begin(self, key, value):
+        self.begins_at = parse_begin(value)
+        return value
+
     @staticmethod
     def get_schema():
         schema = {
@@ -65,6 +96,10 @@ class Area(db.Model):
     id = db.Column(db.Integer, primary_key=True)    
     name = db.Column(db.String(64), nullable=False, unique=True)
     country = db.Column(db.String(32), db.ForeignKey("country.country", ondelete="CASCADE", onupdate="CASCADE"), nullable=False, default="Finland")
+    # Sums over the area's events, maintained by nearbyEvents.aggregates
+    capacity = db.Column(db.Integer, nullable=False, default=0)
+    tickets_sold = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
     
     events = db.relationship("Event", back_populates="in_area")
     in_country = db.relationship("Country", back_populates="areas")
@@ -92,6 +127,8 @@ class Country(db.Model):
     areas = db.relationship("Area", back_populates="in_country", cascade="all, delete-orphan")
     
 class Reservation(db.Model):
+    # Lets the reservation sweeper find expired unpaid holds without a scan
+    __table_args__ = (db.Index("ix_reservation_paid_created_at", "paid", "created_at"),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
     event_id = db.Column(db.Integer, db.ForeignKey("event.id", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
@@ -106,14 +143,34 @@ class Ticket(db.Model):
     id = db.Column(db.Integer, primary_key=True)    
     reservation_id = db.Column(db.Integer, db.ForeignKey("reservation.id", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
     type = db.Column(db.String(16), nullable=True)
+    # Event's ticket_price at the time of sale
+    price = db.Column(db.Float, nullable=True)
     
     in_reservation = db.relationship("Reservation", back_populates="tickets")
+
+class IdempotencyKey(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), nullable=False, unique=True)
+    method = db.Column(db.String(8), nullable=False)
+    path = db.Column(db.String(256), nullable=False)
+    status = db.Column(db.Integer, nullable=False)
+    location = db.Column(db.String(256), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class SchemaMigration(db.Model):
+    # Applied migrations of nearbyEvents.migrations
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(128), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
     
     
 @click.command("initializeDatabase")
 @with_appcontext
 def initializeDatabase():# pragma: no cover
+    from nearbyEvents.migrations import stamp
     db.create_all()
+    # A new database has the current schema
+    stamp()
 
 @click.command("generateTestDatabase")
 @with_appcontext
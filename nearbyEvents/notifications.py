@@ -0,0 +1,277 @@
+import datetime
+import os
+import threading
+import time
+from collections import deque
+from flask import current_app, has_app_context
+from sqlalchemy import event as sa_event, inspect
+from nearbyEvents import db
+from nearbyEvents.areas import get_resolver
+from nearbyEvents.models import Area, Event
+
+# Key used to collect flushed catalogue changes in session.info until commit
+CHANGES_KEY = "nearby_changes"
+# Key of the areas and events whose sales counters a flush updates with SQL
+# expressions, see nearbyEvents.aggregates
+COUNTED_KEY = "nearby_counted"
+
+
+class Subscription(object):
+    """
+    A single subscriber of the change broker. Messages are kept in a bounded
+    buffer: when a slow client falls behind, the oldest messages are dropped
+    and counted so that the client can be told to resynchronize instead of
+    the writer ever having to wait for it.
+    """
+
+    def __init__(self, buffer_size):
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._queue = deque(maxlen=buffer_size)
+        self._dropped = 0
+        # Optional callable invoked after every push, used by async consumers
+        self.waker = None
+
+    def push(self, message):
+        with self._lock:
+            if len(self._queue) == self._queue.maxlen:
+                self._dropped += 1
+            self._queue.append(message)
+        self._ready.set()
+        if self.waker is not None:
+            self.waker()
+
+    def drain(self):
+        """
+        Returns all pending messages and the number of messages dropped since
+        the previous drain.
+        """
+
+        self._ready.clear()
+        with self._lock:
+            messages = list(self._queue)
+            self._queue.clear()
+            dropped, self._dropped = self._dropped, 0
+        return messages, dropped
+
+    def get(self, timeout=None):
+        """
+        Waits up to timeout seconds for messages and drains them.
+        """
+
+        self._ready.wait(timeout)
+        return self.drain()
+
+
+class ChangeBroker(object):
+    """
+    In-process fan-out of area and event changes. Publishing only appends to
+    the subscribers' bounded buffers, so it never blocks the writing request.
+    Listeners are plain callables run synchronously after the commit and are
+    meant for cheap work such as cache invalidation.
+    """
+
+    def __init__(self, buffer_size=100):
+        self.buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._listeners = []
+        self._sequence = 0
+
+    def subscribe(self):
+        subscription = Subscription(self.buffer_size)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def publish(self, change):
+        with self._lock:
+            self._sequence += 1
+            message = dict(change, id=self._sequence)
+            subscribers = list(self._subscribers)
+        for listener in self._listeners:
+            listener(message)
+        for subscription in subscribers:
+            subscription.push(message)
+        return message
+
+
+class EpochFile(object):
+    """
+    Cross-process change counter kept in the modification time of a file.
+    Every process that changes the data bumps the epoch; the others compare
+    it with the epoch their cache was built at, which costs one stat call and
+    keeps caches of the server's worker processes coherent without a shared
+    service.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Epochs before and after the latest bump made by this process
+        self.last_bump = (None, None)
+
+    def current(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def bump(self):
+        previous = self.current()
+        if not previous:
+            open(self.path, "a").close()
+        # Keep increasing even if the clock is coarse or goes backwards
+        now = max(time.time_ns(), previous + 1)
+        os.utime(self.path, ns=(now, now))
+        self.last_bump = (previous, now)
+        return now
+
+
+class CatalogueEpochs(object):
+    """
+    The epoch files of areas and events. Registered as the first listener of
+    the change broker, so the epoch of a change is already bumped when the
+    caches of this process are told about it. The names epochs only change
+    when a name is created or renamed, see nearbyEvents.bloom.
+    """
+
+    def __init__(self, directory):
+        self.files = {
+            kind: EpochFile(os.path.join(directory, "{}s.epoch".format(kind)))
+            for kind in ("area", "event")
+        }
+        self.names = {
+            kind: EpochFile(os.path.join(directory, "{}-names.epoch".format(kind)))
+            for kind in ("area", "event")
+        }
+
+    def __getitem__(self, kind):
+        return self.files[kind]
+
+    def on_change(self, message):
+        self.files[message["type"]].bump()
+
+
+def _describe(obj, action):
+    if isinstance(obj, Area):
+        change = {"type": "area", "action": action, "item_id": obj.id, "name": obj.name}
+    else:
+        change = {
+            "type": "event",
+            "action": action,
+            "item_id": obj.id,
+            "name": obj.name,
+            "area_name": _area_name(obj)
+        }
+    state = inspect(obj)
+    if action == "updated":
+        previous = state.attrs.name.history.deleted
+        if previous and previous[0] != obj.name:
+            change["previous_name"] = previous[0]
+    if isinstance(obj, Event):
+        # Where the event is in the calendar, if loaded, see nearbyEvents.calendar
+        for key in ("area_id", "begins_at"):
+            if key not in state.dict:
+                continue
+            change[key] = _plain(state.dict[key])
+            previous = state.attrs[key].history.deleted if action == "updated" else None
+            if previous and previous[0] != state.dict[key]:
+                change["previous_" + key] = _plain(previous[0])
+    return change
+
+
+def _area_name(event):
+    """
+    Returns the name of the event's area. The resources set only area_id, so
+    in_area may be unloaded or still the area the event was moved from.
+    """
+
+    area = inspect(event).dict.get("in_area")
+    if area is not None and area.id == event.area_id:
+        return area.name
+    if event.area_id is None or not has_app_context():
+        return None
+    return get_resolver().name_of(event.area_id)
+
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def mark_counted(session, obj):
+    """
+    Announces an update of the sales counters of a persistent area or event.
+    The counters are set to SQL expressions, which the flush expires without
+    leaving any history for session.is_modified to see.
+    """
+
+    session.info.setdefault(COUNTED_KEY, set()).add(obj)
+
+
+def add_counter_changes(session, rows):
+    """
+    Queues updates of the events in rows, and of their areas, whose sales
+    counters were changed with Core statements. A row has the id, name,
+    area_id, begins_at and area_name of an event.
+    """
+
+    changes = session.info.setdefault(CHANGES_KEY, [])
+    areas = {}
+    for row in rows:
+        changes.append({
+            "type": "event",
+            "action": "updated",
+            "item_id": row.id,
+            "name": row.name,
+            "area_name": row.area_name,
+            "area_id": row.area_id,
+            "begins_at": _plain(row.begins_at)
+        })
+        if row.area_id is not None:
+            areas[row.area_id] = row.area_name
+    for area_id, name in areas.items():
+        changes.append({"type": "area", "action": "updated", "item_id": area_id, "name": name})
+
+
+@sa_event.listens_for(db.session, "after_flush")
+def _collect_changes(session, flush_context):
+    changes = session.info.setdefault(CHANGES_KEY, [])
+    counted = session.info.pop(COUNTED_KEY, ())
+    for obj in session.new:
+        if isinstance(obj, (Area, Event)):
+            changes.append(_describe(obj, "created"))
+    for obj in session.dirty:
+        if isinstance(obj, (Area, Event)) and (obj in counted or session.is_modified(obj)):
+            changes.append(_describe(obj, "updated"))
+    for obj in session.deleted:
+        if isinstance(obj, (Area, Event)):
+            changes.append(_describe(obj, "deleted"))
+
+
+@sa_event.listens_for(db.session, "after_commit")
+def _publish_changes(session):
+    changes = session.info.pop(CHANGES_KEY, None)
+    if not changes or not has_app_context():
+        return
+    broker = current_app.extensions.get("nearby_changes")
+    if broker is None:
+        return
+    for change in changes:
+        broker.publish(change)
+
+
+@sa_event.listens_for(db.session, "after_soft_rollback")
+def _discard_changes(session, previous_transaction):
+    session.info.pop(CHANGES_KEY, None)
+    session.info.pop(COUNTED_KEY, None)
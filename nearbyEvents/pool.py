@@ -0,0 +1,121 @@
+"""
+Connection pool configuration and checkout metrics. The DB_POOL_* settings
+are turned into SQLAlchemy engine options for the primary database and the
+read replicas; SQLALCHEMY_ENGINE_OPTIONS given explicitly take precedence.
+
+With DB_POOL_SIZE set every engine uses a queue pool whose checkouts are
+timed, so an exhausted pool shows up as checkout waits in the metrics and as
+a logged warning for every checkout slower than DB_POOL_SLOW_CHECKOUT seconds
+instead of as unexplained latency.
+"""
+import threading
+import time
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class PoolMetrics(object):
+    """
+    Checkout counts and waits of the pools of one app in this process.
+    """
+
+    def __init__(self, slow_checkout=None, logger=None):
+        self.slow_checkout = slow_checkout
+        self.logger = logger
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.slow_checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait, timed_out=False):
+        slow = self.slow_checkout is not None and wait >= self.slow_checkout
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.slow_checkouts += slow
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        if slow and self.logger is not None:
+            self.logger.warning("Connection checkout took %.3f s%s", wait,
+                " and timed out" if timed_out else ""
+            )
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "slow_checkouts": self.slow_checkouts,
+                "timeouts": self.timeouts,
+                "mean_wait": self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """
+    Queue pool recording the time each checkout takes, including waiting for
+    a free connection, opening one and the pre-ping, in its class's metrics.
+    """
+
+    metrics = None
+
+    def _timed(self, checkout):
+        started = time.monotonic()
+        try:
+            connection = checkout()
+        except TimeoutError:
+            self.metrics.record(time.monotonic() - started, True)
+            raise
+        self.metrics.record(time.monotonic() - started)
+        return connection
+
+    def connect(self):
+        return self._timed(super(TimedQueuePool, self).connect)
+
+    def unique_connection(self):
+        # Used by the engine for every Connection
+        return self._timed(super(TimedQueuePool, self).unique_connection)
+
+    def recreate(self):
+        # Disposing the engine, as every forked server worker does, would
+        # otherwise drop the pre-ping setting
+        pool = super(TimedQueuePool, self).recreate()
+        pool._pre_ping = self._pre_ping
+        return pool
+
+
+def engine_options(config, poolclass):
+    """
+    Returns the engine options of the DB_POOL_* settings of the config.
+    """
+
+    options = {}
+    if config["DB_POOL_PRE_PING"]:
+        options["pool_pre_ping"] = True
+    if config["DB_POOL_RECYCLE"] is not None:
+        options["pool_recycle"] = config["DB_POOL_RECYCLE"]
+    if config["DB_POOL_SIZE"] is not None:
+        options.update(
+            poolclass=poolclass,
+            pool_size=config["DB_POOL_SIZE"],
+            max_overflow=config["DB_POOL_MAX_OVERFLOW"],
+            pool_timeout=config["DB_POOL_TIMEOUT"],
+        )
+        if config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+            # Pooled SQLite connections are handed between threads
+            options["connect_args"] = {"check_same_thread": False}
+    return options
+
+
+def init_app(app):
+    metrics = app.extensions["nearby_pool"] = PoolMetrics(
+        app.config["DB_POOL_SLOW_CHECKOUT"], app.logger
+    )
+    # A class per app, pools are recreated from their class
+    poolclass = type("TimedQueuePool", (TimedQueuePool,), {"metrics": metrics})
+    options = engine_options(app.config, poolclass)
+    options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+    return metrics
@@ -0,0 +1,233 @@
+"""
+Popularity of the area and event items, enabled with POPULARITY_TRACKING.
+Every item GET adds one to the item's counters in a count-min sketch of
+POPULARITY_SKETCH_DEPTH rows of POPULARITY_SKETCH_WIDTH counters. The
+sketch estimates the count of any key in constant memory and never
+underestimates it. Every POPULARITY_DECAY_INTERVAL seconds all counters are
+halved, so the counts follow the recent traffic.
+
+The sketch lives in an anonymous shared memory map created with the app, so
+the workers forked by flask serve count together. Each process keeps the
+POPULARITY_TOP_K items with the highest estimates it has seen. The process
+that decays the sketch writes its list to POPULARITY_FILE (by default
+popular.json in the instance folder), from which a new worker learns the hot
+items before it has seen any traffic. Admins can read the list from
+/admin/popular/.
+"""
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+from flask import current_app, jsonify, request
+from nearbyEvents.auth import admin_required
+from nearbyEvents.utils import create_error_response
+
+KINDS = ("area", "event")
+
+
+class CountMinSketch(object):
+    """
+    Count-min sketch with conservative update in memory shared with forked
+    processes. The first counter of the map holds the time of the last decay.
+    """
+
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self._memory = mmap.mmap(-1, 8 * (1 + width * depth))
+        self._counters = memoryview(self._memory).cast("d")
+        self._counters[0] = time.time()
+        self._lock = multiprocessing.Lock()
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return [1 + row * self.width + (first + row * step) % self.width for row in range(self.depth)]
+
+    def add(self, key, amount=1.0):
+        """
+        Counts the key and returns its new estimate. Increments racing in
+        other processes may be lost, which only lowers the estimate.
+        """
+
+        counters = self._counters
+        indexes = self._indexes(key)
+        estimate = min(counters[i] for i in indexes) + amount
+        for i in indexes:
+            if counters[i] < estimate:
+                counters[i] = estimate
+        return estimate
+
+    def estimate(self, key):
+        counters = self._counters
+        return min(counters[i] for i in self._indexes(key))
+
+    @property
+    def decayed_at(self):
+        return self._counters[0]
+
+    def decay(self, interval, factor=0.5):
+        """
+        Multiplies the counters by factor if the last decay was at least
+        interval seconds ago. Returns True in the process that did it.
+        """
+
+        if time.time() - self._counters[0] < interval or not self._lock.acquire(False):
+            return False
+        try:
+            if time.time() - self._counters[0] < interval:
+                return False
+            counters = self._counters
+            for i in range(1, len(counters)):
+                counters[i] *= factor
+            counters[0] = time.time()
+            return True
+        finally:
+            self._lock.release()
+
+
+class TopK(object):
+    """
+    The k keys with the highest counts seen by this process.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._min = None
+
+    def add(self, key, count):
+        with self._lock:
+            counts = self._counts
+            if key in counts or len(counts) < self.k:
+                counts[key] = count
+                if self._min is not None and (key == self._min or count < counts[self._min]):
+                    self._min = None
+                return
+            if self._min is None:
+                self._min = min(counts, key=counts.get)
+            if count > counts[self._min]:
+                del counts[self._min]
+                counts[key] = count
+                self._min = None
+
+    def items(self):
+        with self._lock:
+            return sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
+
+    def rescore(self, estimate):
+        """
+        Replaces the stored counts with current estimates.
+        """
+
+        with self._lock:
+            self._counts = {key: estimate(key) for key in self._counts}
+            self._min = None
+
+    def __contains__(self, key):
+        return key in self._counts
+
+
+class Popularity(object):
+
+    def __init__(self, width, depth, k, decay_interval, path):
+        self.sketch = CountMinSketch(width, depth)
+        self.top = TopK(k)
+        self.decay_interval = decay_interval
+        self.path = path
+        self._seen_decay = self.sketch.decayed_at
+
+    @staticmethod
+    def _key(kind, item_id):
+        return "{}:{}".format(kind, item_id)
+
+    def record(self, kind, item_id):
+        key = self._key(kind, item_id)
+        self.top.add(key, self.sketch.add(key))
+        if self.sketch.decay(self.decay_interval):
+            self.save()
+        if self.sketch.decayed_at != self._seen_decay:
+            self._seen_decay = self.sketch.decayed_at
+            self.top.rescore(self.sketch.estimate)
+
+    def is_hot(self, kind, item_id):
+        return self._key(kind, item_id) in self.top
+
+    def hottest(self, limit=None, kind=None):
+        """
+        Returns (kind, id, count) of the most requested items, hottest first.
+        """
+
+        result = []
+        for key, count in self.top.items():
+            item_kind, item_id = key.split(":", 1)
+            if kind is None or item_kind == kind:
+                result.append((item_kind, int(item_id), count))
+        return result[:limit]
+
+    def save(self):
+        if self.path is None:
+            return
+        items = [{"kind": kind, "id": item_id, "count": count} for kind, item_id, count in self.hottest()]
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                json.dump(items, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def load(self):
+        """
+        Adds the items of the saved list to this process's top items.
+        """
+
+        try:
+            with open(self.path) as f:
+                items = json.load(f)
+        except (OSError, ValueError, TypeError):
+            return 0
+        for item in items:
+            key = self._key(item["kind"], item["id"])
+            self.top.add(key, max(item["count"], self.sketch.estimate(key)))
+        return len(items)
+
+
+def get_popularity():
+    return current_app.extensions.get("nearby_popularity")
+
+
+def list_popular():
+    popularity = get_popularity()
+    try:
+        limit = int(request.args.get("limit", popularity.top.k))
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return create_error_response(400, "Invalid query parameters", "limit must be a positive integer")
+    kind = request.args.get("kind")
+    if kind is not None and kind not in KINDS:
+        return create_error_response(400, "Invalid query parameters", "kind must be area or event")
+    cache = current_app.extensions.get("nearby_item_cache")
+    items = []
+    for item_kind, item_id, count in popularity.hottest(limit, kind):
+        item = {"kind": item_kind, "id": item_id, "count": round(count, 2)}
+        if cache is not None:
+            item["cached"] = cache.contains(item_kind, item_id)
+        items.append(item)
+    return jsonify({"items": items})
+
+
+def init_app(app):
+    app.add_url_rule("/admin/popular/", "admin_popular", admin_required(list_popular))
+    popularity = app.extensions["nearby_popularity"] = Popularity(
+        app.config["POPULARITY_SKETCH_WIDTH"], app.config["POPULARITY_SKETCH_DEPTH"],
+        app.config["POPULARITY_TOP_K"], app.config["POPULARITY_DECAY_INTERVAL"],
+        app.config["POPULARITY_FILE"] or os.path.join(app.instance_path, "popular.json")
+    )
+    return popularity
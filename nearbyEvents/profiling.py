@@ -0,0 +1,197 @@
+"""
+On-demand profiling of production requests. A request is profiled when it
+carries PROFILE_KEY in the X-Profile header or the profile query parameter,
+or at random with probability PROFILE_SAMPLE_RATE. Without a key and with
+the rate at 0 (the defaults) profiling is off.
+
+The profile covers the whole WSGI call: routing, the request hooks, the
+resource method with its queries and url_for calls, and the JSON encoding of
+the response. Every Python and builtin function call is traced and its own
+time, in microseconds, is added to the stack it ran in. The result is written
+to PROFILE_DIR as collapsed stacks, one "outer;...;inner microseconds" line
+per stack, the input format of flamegraph.pl and speedscope. The response
+carries the name of the profile in the X-Profile-Id header, and the stored
+profiles (the PROFILE_MAX_FILES newest) are served to admins from
+/admin/profiles/.
+"""
+import collections
+import itertools
+import os
+import random
+import re
+import sys
+import threading
+import time
+from flask import Response, abort, current_app, jsonify
+from werkzeug.urls import url_decode
+from nearbyEvents.auth import admin_required
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+PROFILE_NAME = re.compile(r"^[\w.-]+\.folded$")
+
+
+def _frame_name(frame):
+    return "{}:{}".format(frame.f_globals.get("__name__", "?"), frame.f_code.co_name)
+
+
+def _builtin_name(function):
+    module = getattr(function, "__module__", None) or "builtins"
+    return "{}:{}".format(module, getattr(function, "__qualname__", repr(function)))
+
+
+class StackProfile(object):
+    """
+    Profile function for sys.setprofile that adds up the own time of the
+    collapsed call stacks of one thread.
+    """
+
+    def __init__(self):
+        self.stacks = collections.Counter()
+        # Names, start times and time spent in callees of the open calls
+        self._names = []
+        self._started = []
+        self._inner = []
+
+    def __call__(self, frame, event, arg):
+        now = time.perf_counter_ns()
+        if event == "call" or event == "c_call":
+            self._names.append(_frame_name(frame) if event == "call" else _builtin_name(arg))
+            self._started.append(now)
+            self._inner.append(0)
+        elif self._names and event in ("return", "c_return", "c_exception"):
+            elapsed = now - self._started.pop()
+            own = elapsed - self._inner.pop()
+            self.stacks[";".join(self._names)] += own
+            self._names.pop()
+            if self._inner:
+                self._inner[-1] += elapsed
+
+    def collapsed(self):
+        return "".join(
+            "{} {}\n".format(stack, nanoseconds // 1000)
+            for stack, nanoseconds in sorted(self.stacks.items())
+            if nanoseconds >= 1000
+        )
+
+
+class ProfileStore(object):
+    """
+    Directory of collapsed stack files, keeping the newest max_files.
+    """
+
+    def __init__(self, directory, max_files):
+        self.directory = directory
+        self.max_files = max_files
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def save(self, environ, profile):
+        path = re.sub(r"[^\w-]+", "_", environ.get("PATH_INFO", "")).strip("_") or "root"
+        name = "{}-{}-{}-{}-{}.folded".format(
+            time.strftime("%Y%m%dT%H%M%S"), os.getpid(), next(self._counter),
+            environ.get("REQUEST_METHOD", "GET"), path[:60]
+        )
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, name), "w") as f:
+                f.write(profile.collapsed())
+            self._prune()
+        return name
+
+    def _prune(self):
+        names = self.names()
+        for name in names[self.max_files:]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def names(self):
+        """
+        Returns the names of the stored profiles, newest first.
+        """
+
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if PROFILE_NAME.match(entry.name)]
+        except FileNotFoundError:
+            return []
+        entries.sort(key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+        return [entry.name for entry in entries]
+
+    def read(self, name):
+        if not PROFILE_NAME.match(name):
+            return None
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+class ProfilingMiddleware(object):
+    """
+    WSGI middleware profiling the requests chosen by key or sampling.
+    """
+
+    def __init__(self, wsgi_app, store, key=None, sample_rate=0.0):
+        self.wsgi_app = wsgi_app
+        self.store = store
+        self.key = key
+        self.sample_rate = sample_rate
+
+    def wanted(self, environ):
+        if self.key is not None:
+            flag = environ.get("HTTP_X_PROFILE")
+            if flag is None and "profile=" in environ.get("QUERY_STRING", ""):
+                flag = url_decode(environ["QUERY_STRING"]).get("profile")
+            if flag == self.key:
+                return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        if not self.wanted(environ):
+            return self.wsgi_app(environ, start_response)
+        response = {}
+
+        def capture(status, headers, exc_info=None):
+            response["start"] = (status, headers, exc_info)
+            return lambda data: response.setdefault("written", []).append(data)
+
+        profile = StackProfile()
+        sys.setprofile(profile)
+        try:
+            iterable = self.wsgi_app(environ, capture)
+        finally:
+            sys.setprofile(None)
+        name = self.store.save(environ, profile)
+        status, headers, exc_info = response["start"]
+        write = start_response(status, headers + [(PROFILE_ID_HEADER, name)], exc_info)
+        for data in response.get("written", []):
+            write(data)
+        return iterable
+
+
+def list_profiles():
+    store = current_app.extensions["nearby_profiles"]
+    return jsonify({"profiles": store.names()})
+
+
+def get_profile(name):
+    text = current_app.extensions["nearby_profiles"].read(name)
+    if text is None:
+        abort(404)
+    return Response(text, 200, mimetype="text/plain")
+
+
+def init_app(app):
+    store = app.extensions["nearby_profiles"] = ProfileStore(
+        app.config["PROFILE_DIR"] or os.path.join(app.instance_path, "profiles"),
+        app.config["PROFILE_MAX_FILES"]
+    )
+    app.add_url_rule("/admin/profiles/", "admin_profiles", admin_required(list_profiles))
+    app.add_url_rule("/admin/profiles/<name>", "admin_profile", admin_required(get_profile))
+    app.wsgi_app = ProfilingMiddleware(
+        app.wsgi_app, store, app.config["PROFILE_KEY"], app.config["PROFILE_SAMPLE_RATE"]
+    )
+    return store
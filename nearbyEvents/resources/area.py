@@ -1,48 +1,120 @@
-import json
-from jsonschema import validate, ValidationError
+from functools import partial
 from flask import request, Response, url_for
 from flask_restful import Resource
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 from nearbyEvents.models import Area
 from nearbyEvents import db
-from nearbyEvents.utils import NearbyEventsBuilder, create_error_response
+from nearbyEvents.utils import NearbyEventsBuilder, ValidationError, create_error_response, dump_json, validate_json
 from nearbyEvents.constants import *
+from nearbyEvents.tracing import traced
+from nearbyEvents.idempotency import idempotent, record_outcome
+from nearbyEvents.auth import jwt_required
+from nearbyEvents.areas import get_area
+from nearbyEvents.groupcommit import run_unit
+from nearbyEvents.itemcache import serve_item
+
+areas = Area.__table__
 
-class AreaItem(Resource):
 
+@traced("mason")
+def area_item_body(db_area):
     """
-        Retrieve single area based on the area name (string)
+    Builds the Mason body of a single area. Works with both ORM objects and
+    result rows that have the same column names.
     """
 
-    def get(self, area):
-        db_area = Area.query.filter_by(name=area).first()
-        if db_area is None:
-            return create_error_response(404, "Not found", 
-                "No area was found with the name {}".format(area)
-            )
-        
-        body = NearbyEventsBuilder(
+    body = NearbyEventsBuilder(
+        id=db_area.id,
+        name=db_area.name,
+        capacity=db_area.capacity,
+        tickets_sold=db_area.tickets_sold,
+        tickets_remaining=db_area.capacity - db_area.tickets_sold,
+        revenue=db_area.revenue
+    )
+    body.add_namespace("nearby", LINK_RELATIONS_URL)
+    body.add_control("self", url_for("api.areaitem", area_id=db_area.id))
+    body.add_control("profile", AREA_PROFILE)
+    body.add_control("collection", url_for("api.areacollection"))
+    body.add_control_delete_area(db_area.id)
+    body.add_control_modify_area(db_area.id)
+    body.add_control_events_by(db_area.id)
+    return body
+
+
+@traced("mason")
+def area_collection_body(db_areas):
+    body = NearbyEventsBuilder()
+
+    body.add_namespace("nearby", LINK_RELATIONS_URL)
+    body.add_control("self", url_for("api.areacollection"))
+    body.add_control_add_area()
+    body["items"] = []
+    for db_area in db_areas:
+        item = NearbyEventsBuilder(
+            id=db_area.id,
             name=db_area.name
         )
-        body.add_namespace("nearby", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.areaitem", area=area))
-        body.add_control("profile", AREA_PROFILE)
-        body.add_control("collection", url_for("api.areacollection"))
-        body.add_control_delete_area(db_area.name)
-        body.add_control_modify_area(db_area.name)
-        body.add_control_events_by(db_area.name)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        item.add_control("self", url_for("api.areaitem", area_id=db_area.id))
+        item.add_control("profile", AREA_PROFILE)
+        body["items"].append(item)
+    return body
+
+
+def render_area(name=None, area_id=None):
+    """
+    Returns the id, name and response body of the area with the given name
+    or id, or None, see nearbyEvents.itemcache.
+    """
+
+    db_area = get_area(name, area_id)
+    if db_area is None:
+        return None
+    return db_area.id, db_area.name, dump_json(area_item_body(db_area))
+
+
+def update_area(area_id, name, session):
+    """
+    Unit of work renaming an area, see nearbyEvents.groupcommit.
+    """
+
+    db_area = session.query(Area).get(area_id)
+    if db_area is None:
+        return False
+    db_area.name = name
+    return True
+
+
+def area_not_found(area=None, area_id=None):
+    if area_id is not None:
+        message = "No area was found with the id {}".format(area_id)
+    else:
+        message = "No area was found with the name {}".format(area)
+    return create_error_response(404, "Not found", message)
+
+
+class AreaItem(Resource):
+
+    """
+        Retrieve single area based on the area id (integer) or name (string)
+    """
+
+    def get(self, area=None, area_id=None):
+        body = serve_item("area", area, area_id, render_area)
+        if body is None:
+            return area_not_found(area, area_id)
+        
+        return Response(body, 200, mimetype=MASON)
         
     """
-        Modify an area based on the area name (string)
+        Modify an area based on the area id (integer) or name (string)
         Must be JSON and include the parameter: name
     """
-    def put(self, area):
-        db_area = Area.query.filter_by(name=area).first()
+    @jwt_required
+    def put(self, area=None, area_id=None):
+        db_area = get_area(area, area_id)
         if db_area is None:
-            return create_error_response(404, "Not found", 
-                "No area was found with the name {}".format(area)
-            )
+            return area_not_found(area, area_id)
         
         if not request.json:
             return create_error_response(415, "Unsupported media type",
@@ -50,32 +122,30 @@ class AreaItem(Resource):
             )
 
         try:
-            validate(request.json, Area.get_schema())
+            validate_json(request.json, Area)
         except ValidationError as e:
             db.session.rollback()
             return create_error_response(400, "Invalid JSON document", str(e))
     
-        db_area.name = request.json["name"]
-        
         try:
-            db.session.commit()
+            updated = run_unit(partial(update_area, db_area.id, request.json["name"]))
         except IntegrityError:
-            db.session.rollback()
             return create_error_response(409, "Already exists", 
                 "Area with name '{}' already exists.".format(request.json["name"])
             )
+        if not updated:
+            return area_not_found(area, area_id)
         
         return Response(status=204)
 
     """
-        Delete single area based on the area name (string)
+        Delete single area based on the area id (integer) or name (string)
     """
-    def delete(self, area):
-        db_area = Area.query.filter_by(name=area).first()
+    @jwt_required
+    def delete(self, area=None, area_id=None):
+        db_area = get_area(area, area_id)
         if db_area is None:
-            return create_error_response(404, "Not found", 
-                "No area was found with the name {}".format(area)
-            )
+            return area_not_found(area, area_id)
         
         db.session.delete(db_area)
         db.session.commit()
@@ -90,26 +160,19 @@ class AreaCollection(Resource):
         Retrieve all areas in the system
     """
     def get(self):
-        body = NearbyEventsBuilder()
-
-        body.add_namespace("nearby", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.areacollection"))
-        body.add_control_add_area()
-        body["items"] = []
-        for db_area in Area.query.all():
-            item = NearbyEventsBuilder(
-                name=db_area.name
-            )
-            item.add_control("self", url_for("api.areaitem", area=db_area.name))
-            item.add_control("profile", AREA_PROFILE)
-            body["items"].append(item)
-
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        # Rows of the two columns instead of mapped objects, which would all
+        # stay in the session's identity map until the request ends
+        rows = db.session.execute(select([areas.c.id, areas.c.name])).fetchall()
+        body = area_collection_body(rows)
+        return Response(dump_json(body), 200, mimetype=MASON)
         
     """
         Add a new area to the system
         Must be JSON and uses name (string) as the parameter
+        Retries with the same Idempotency-Key header get the original response
     """
+    @jwt_required
+    @idempotent
     def post(self):
         if not request.json:
             return create_error_response(
@@ -118,7 +181,7 @@ class AreaCollection(Resource):
             )
 
         try:
-            validate(request.json, Area.get_schema())
+            validate_json(request.json, Area)
         except ValidationError as e:
             db.session.rollback()
             return create_error_response(400, "Invalid JSON document", str(e))
@@ -126,9 +189,11 @@ class AreaCollection(Resource):
         area = Area(
             name=request.json["name"]
         )
-
         try:
             db.session.add(area)
+            db.session.flush()
+            location = url_for("api.areaitem", area_id=area.id)
+            record_outcome(201, location)
             db.session.commit()
         except IntegrityError:
             db.session.rollback()
@@ -138,5 +203,5 @@ class AreaCollection(Resource):
             )
 
         return Response(status=201, headers={
-            "Location": url_for("api.areaitem", area=request.json["name"])
+            "Location": location
         })
\ No newline at end of file
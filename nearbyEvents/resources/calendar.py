@@ -0,0 +1,55 @@
+import datetime
+from flask import request, Response, url_for
+from flask_restful import Resource
+from nearbyEvents.utils import NearbyEventsBuilder, create_error_response, dump_json
+from nearbyEvents.constants import *
+from nearbyEvents.tracing import traced
+from nearbyEvents.areas import get_resolver
+from nearbyEvents.calendar import add_months, month_days, parse_month
+from nearbyEvents.resources.eventsbyarea import unknown_area
+
+
+@traced("mason")
+def area_calendar_body(area_id, month, days):
+    body = NearbyEventsBuilder(
+        area_id=area_id,
+        month=month.strftime("%Y-%m"),
+        days=days
+    )
+    body.add_namespace("nearby", LINK_RELATIONS_URL)
+    body.add_control("self", url_for("api.areacalendar", area_id=area_id, month=body["month"]))
+    body.add_control("prev", url_for("api.areacalendar", area_id=area_id,
+        month=add_months(month, -1).strftime("%Y-%m")
+    ))
+    body.add_control("next", url_for("api.areacalendar", area_id=area_id,
+        month=add_months(month, 1).strftime("%Y-%m")
+    ))
+    body.add_control_get_area(area_id)
+    body.add_control_events_by(area_id)
+    return body
+
+
+class AreaCalendar(Resource):
+
+    """
+        Number of events and remaining tickets per day of a month for an
+        area. Requires area id (integer) or name (string)
+        Optional query parameter: month (YYYY-MM, the current month by default)
+    """
+    def get(self, area=None, area_id=None):
+        try:
+            if "month" in request.args:
+                month = parse_month(request.args["month"])
+            else:
+                month = datetime.date.today().replace(day=1)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameters", str(e))
+        resolver = get_resolver()
+        if area_id is None:
+            resolved = resolver.resolve(area)
+        else:
+            resolved = area_id if resolver.name_of(area_id) is not None else None
+        if resolved is None:
+            return unknown_area(area, area_id)
+        body = area_calendar_body(resolved, month, month_days(resolved, month))
+        return Response(dump_json(body), 200, mimetype=MASON)
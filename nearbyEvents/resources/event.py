@@ -1,50 +1,146 @@
-import json
-from jsonschema import validate, ValidationError
+from functools import partial
 from flask import request, Response, url_for
 from flask_restful import Resource
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
-from nearbyEvents.models import Area, Event
+from nearbyEvents.models import Event
 from nearbyEvents import db
-from nearbyEvents.utils import NearbyEventsBuilder, create_error_response
+from nearbyEvents.utils import NearbyEventsBuilder, ValidationError, create_error_response, dump_json, validate_json
 from nearbyEvents.constants import *
+from nearbyEvents.tracing import traced
+from nearbyEvents.idempotency import idempotent, record_outcome
+from nearbyEvents.auth import jwt_required
+from nearbyEvents.areas import get_resolver
+from nearbyEvents.bloom import might_exist
+from nearbyEvents.groupcommit import run_unit
+from nearbyEvents.itemcache import serve_item
+
+events = Event.__table__
 
-class EventItem(Resource):
 
+def get_event(name=None, event_id=None):
     """
-        Retrieve single event based on the event name (string)
+    Returns the Event with the given name or id, or None. Names that
+    certainly do not exist are answered without a query.
     """
-    
-    def get(self, event):
-        db_event = Event.query.filter_by(name=event).first()
-        if db_event is None:
-            return create_error_response(404, "Not found", 
-                "No event was found with the name {}".format(event)
-            )
-        
-        body = NearbyEventsBuilder(
+
+    if event_id is not None:
+        return db.session.query(Event).get(event_id)
+    if not might_exist("event", name):
+        return None
+    return Event.query.filter_by(name=name).first()
+
+
+def render_event(name=None, event_id=None):
+    """
+    Returns the id, name and response body of the event with the given name
+    or id, or None, see nearbyEvents.itemcache.
+    """
+
+    db_event = get_event(name, event_id)
+    if db_event is None:
+        return None
+    return db_event.id, db_event.name, dump_json(event_item_body(db_event))
+
+
+def update_event(event_id, name, status, event_begin, area_id, session):
+    """
+    Unit of work modifying an event, see nearbyEvents.groupcommit.
+    """
+
+    db_event = session.query(Event).get(event_id)
+    if db_event is None:
+        return False
+    db_event.name = name
+    db_event.status = status
+    db_event.event_begin = event_begin
+    db_event.area_id = area_id
+    return True
+
+
+def event_not_found(event=None, event_id=None):
+    if event_id is not None:
+        message = "No event was found with the id {}".format(event_id)
+    else:
+        message = "No event was found with the name {}".format(event)
+    return create_error_response(404, "Not found", message)
+
+
+def unknown_area(area_name):
+    return create_error_response(400, "Unknown area",
+        "No area was found with the name {}".format(area_name)
+    )
+
+
+@traced("mason")
+def event_item_body(db_event):
+    """
+    Builds the Mason body of a single event. Works with both ORM objects and
+    result rows that have the same column names.
+    """
+
+    body = NearbyEventsBuilder(
+        id=db_event.id,
+        name=db_event.name,
+        max_tickets=db_event.max_tickets,
+        tickets_sold=db_event.tickets_sold,
+        tickets_remaining=db_event.max_tickets - db_event.tickets_sold,
+        revenue=db_event.revenue
+    )
+    body.add_namespace("nearby", LINK_RELATIONS_URL)
+    body.add_control("self", url_for("api.eventitem", event_id=db_event.id))
+    body.add_control("profile", EVENT_PROFILE)
+    body.add_control("collection", url_for("api.eventcollection"))
+    body.add_control_delete_event(db_event.id)
+    body.add_control_modify_event(db_event.id)
+    if db_event.area_id is not None:
+        body.add_control_get_area(db_event.area_id)
+    return body
+
+
+@traced("mason")
+def event_collection_body(db_events):
+    body = NearbyEventsBuilder()
+
+    body.add_namespace("nearby", LINK_RELATIONS_URL)
+    body.add_control("self", url_for("api.eventcollection"))
+    body.add_control_add_event()
+    body["items"] = []
+    for db_event in db_events:
+        item = NearbyEventsBuilder(
+            id=db_event.id,
             name=db_event.name
         )
-        body.add_namespace("nearby", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.eventitem", event=event))
-        body.add_control("profile", EVENT_PROFILE)
-        body.add_control("collection", url_for("api.eventcollection"))
-        body.add_control_delete_event(db_event.name)
-        body.add_control_modify_event(db_event.name)
-        if db_event.area_name is not None:
-            body.add_control_get_area(db_event.area_name)
+        item.add_control("self", url_for("api.eventitem", event_id=db_event.id))
+        item.add_control("profile", EVENT_PROFILE)
+        if (db_event.area_id != None):
+            item.add_control_get_area(db_event.area_id)
+        body["items"].append(item)
+    return body
+
+
+class EventItem(Resource):
+
+    """
+        Retrieve single event based on the event id (integer) or name (string)
+    """
+    
+    def get(self, event=None, event_id=None):
+        body = serve_item("event", event, event_id, render_event)
+        if body is None:
+            return event_not_found(event, event_id)
         
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(body, 200, mimetype=MASON)
         
     """
-        Modify an event based on the event name (string)
+        Modify an event based on the event id (integer) or name (string)
         Must be JSON and include the parameter: name
     """
-    def put(self, event):
-        db_event = Event.query.filter_by(name=event).first()
+    @jwt_required
+    def put(self, event=None, event_id=None):
+        db_event = get_event(event, event_id)
         if db_event is None:
-            return create_error_response(404, "Not found", 
-                "No event was found with the name {}".format(event)
-            )
+            return event_not_found(event, event_id)
         
         if not request.json:
             return create_error_response(415, "Unsupported media type",
@@ -52,35 +148,36 @@ class EventItem(Resource):
             )
 
         try:
-            validate(request.json, Event.get_schema())
+            validate_json(request.json, Event)
         except ValidationError as e:
             db.session.rollback()
             return create_error_response(400, "Invalid JSON document", str(e))
     
-        db_event.name = request.json["name"]
-        db_event.status = request.json["status"]
-        db_event.event_begin = request.json["event_begin"]
-        db_event.area_name = request.json["area_name"]
-        
+        area_id = get_resolver().resolve(request.json["area_name"])
+        if area_id is None:
+            return unknown_area(request.json["area_name"])
+
         try:
-            db.session.commit()
+            updated = run_unit(partial(update_event, db_event.id,
+                request.json["name"], request.json["status"], request.json["event_begin"], area_id
+            ))
         except IntegrityError:
-            db.session.rollback()
             return create_error_response(409, "Already exists", 
                 "Event with name '{}' already exists.".format(request.json["name"])
             )
+        if not updated:
+            return event_not_found(event, event_id)
         
         return Response(status=204)
     
     """
-        Delete single event based on the event name (string)
+        Delete single event based on the event id (integer) or name (string)
     """
-    def delete(self, event):
-        db_event = Event.query.filter_by(name=event).first()
+    @jwt_required
+    def delete(self, event=None, event_id=None):
+        db_event = get_event(event, event_id)
         if db_event is None:
-            return create_error_response(404, "Not found", 
-                "No event was found with the name {}".format(event)
-            )
+            return event_not_found(event, event_id)
         
         db.session.delete(db_event)
         db.session.commit()
@@ -94,28 +191,20 @@ class EventCollection(Resource):
         Retrieve all events in the system
     """
     def get(self):
-        body = NearbyEventsBuilder()
-
-        body.add_namespace("nearby", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.eventcollection"))
-        body.add_control_add_event()
-        body["items"] = []
-        for db_event in Event.query.all():
-            item = NearbyEventsBuilder(
-                name=db_event.name
-            )
-            item.add_control("self", url_for("api.eventitem", event=db_event.name))
-            item.add_control("profile", EVENT_PROFILE)
-            if (db_event.area_name != None):
-                item.add_control_get_area(db_event.area_name)
-            body["items"].append(item)
-
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        # See AreaCollection.get
+        rows = db.session.execute(
+            select([events.c.id, events.c.name, events.c.area_id])
+        ).fetchall()
+        body = event_collection_body(rows)
+        return Response(dump_json(body), 200, mimetype=MASON)
         
     """
         Add a new event to the system
         Must be JSON and uses name (string) as the parameter
+        Retries with the same Idempotency-Key header get the original response
     """
+    @jwt_required
+    @idempotent
     def post(self):
         if not request.json:
             return create_error_response(
@@ -124,29 +213,35 @@ class EventCollection(Resource):
             )
 
         try:
-            validate(request.json, Event.get_schema())
+            validate_json(request.json, Event)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         
-        db_area = Area.query.filter_by(name=request.json["area_name"]).first()
+        area_id = get_resolver().resolve(request.json["area_name"])
+        if area_id is None:
+            return unknown_area(request.json["area_name"])
+
         event = Event(
             name=request.json["name"],
             max_tickets=request.json["max_tickets"],
             ticket_price=request.json["ticket_price"],
             status=request.json["status"],
-            event_begin=request.json["event_begin"]
+            event_begin=request.json["event_begin"],
+            area_id=area_id
         )
-        event.in_area=db_area
         try:
             db.session.add(event)
+            db.session.flush()
+            location = url_for("api.eventitem", event_id=event.id)
+            record_outcome(201, location)
             db.session.commit()
-        except IntegrityError as e:
-            print(e)
+        except IntegrityError:
+            db.session.rollback()
             return create_error_response(
                 409, "Already exists",
                 "Event with name '{}' already exists.".format(request.json["name"])
             )
 
         return Response(status=201, headers={
-            "Location": url_for("api.eventitem", event=request.json["name"])
+            "Location": location
         })
\ No newline at end of file
@@ -1,40 +1,181 @@
+import base64
+import datetime
 import json
-from jsonschema import validate, ValidationError
-from flask import request, Response, url_for
+from flask import current_app, request, Response, url_for
 from flask_restful import Resource
-from sqlalchemy.exc import IntegrityError
-from nearbyEvents.models import Area, Event
+from sqlalchemy import and_, or_, select
+from nearbyEvents.models import Area, Event, parse_begin
 from nearbyEvents import db
-from nearbyEvents.utils import NearbyEventsBuilder, create_error_response
+from nearbyEvents.utils import NearbyEventsBuilder, create_error_response, dump_json
 from nearbyEvents.constants import *
+from nearbyEvents.tracing import traced
+from nearbyEvents.areas import get_resolver
+
+areas = Area.__table__
+events = Event.__table__
+
+
+class PageArgs(object):
+    """
+    Query parameters of a page of an area's events: limit, after (the cursor
+    from the previous page's next control) and the begin time window from
+    (inclusive) and to (exclusive).
+    """
+
+    def __init__(self, args, default_limit, max_limit):
+        try:
+            self.limit = int(args.get("limit", default_limit))
+        except ValueError:
+            self.limit = None
+        if self.limit is None or not 1 <= self.limit <= max_limit:
+            raise ValueError("limit must be between 1 and {}".format(max_limit))
+        self.after = decode_cursor(args["after"]) if "after" in args else None
+        self.begin_from = self._time(args, "from")
+        self.begin_to = self._time(args, "to")
+        self.query = {key: args[key] for key in ("limit", "from", "to") if key in args}
+
+    @staticmethod
+    def _time(args, key):
+        if key not in args:
+            return None
+        value = parse_begin(args[key])
+        if value is None:
+            raise ValueError("{} must be a date or an ISO 8601 time".format(key))
+        return value
+
+
+def encode_cursor(begins_at, event_id):
+    key = [begins_at.isoformat() if begins_at is not None else None, event_id]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        begins_at, event_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if begins_at is not None:
+            begins_at = datetime.datetime.fromisoformat(begins_at)
+        return begins_at, int(event_id)
+    except (ValueError, TypeError):
+        raise ValueError("after is not a valid cursor")
+
+
+def events_by_area_query(page, area=None, area_id=None):
+    """
+    Returns the query of one page of the events of the area with the given
+    name or id, ordered by begin time, events without a known begin time
+    first. The events are outer joined to the area so that an existing area
+    without matching events still returns one row, with no event, and an
+    unknown area returns none.
+    """
+
+    on = [events.c.area_id == areas.c.id]
+    if page.after is not None:
+        begins_at, event_id = page.after
+        if begins_at is None:
+            on.append(or_(
+                events.c.begins_at != None,
+                and_(events.c.begins_at == None, events.c.id > event_id)
+            ))
+        else:
+            on.append(or_(
+                events.c.begins_at > begins_at,
+                and_(events.c.begins_at == begins_at, events.c.id > event_id)
+            ))
+    if page.begin_from is not None:
+        on.append(events.c.begins_at >= page.begin_from)
+    if page.begin_to is not None:
+        on.append(events.c.begins_at < page.begin_to)
+    return select([
+        events.c.id, events.c.name, events.c.begins_at,
+        areas.c.id.label("area_id"), areas.c.name.label("area_name")
+    ]).select_from(
+        areas.outerjoin(events, and_(*on))
+    ).where(
+        areas.c.id == area_id if area_id is not None else areas.c.name == area
+    ).order_by(
+        events.c.begins_at.asc().nullsfirst(), events.c.id
+    ).limit(page.limit + 1)
+
+
+@traced("mason")
+def events_by_area_body(area_id, rows, page=None):
+    """
+    Builds the Mason body of a page of an area's events from the rows of
+    events_by_area_query. Rows without an event are skipped and the extra
+    row fetched beyond the limit becomes the next control.
+    """
+
+    body = NearbyEventsBuilder()
+
+    query = page.query if page else {}
+    body.add_namespace("nearby", LINK_RELATIONS_URL)
+    body.add_control("self", url_for("api.eventsbyarea", area_id=area_id, **query))
+    body.add_control_get_areas()
+    body["items"]=[]
+
+    rows = [row for row in rows if row.name is not None]
+    if page is not None and len(rows) > page.limit:
+        rows = rows[:page.limit]
+        last = rows[-1]
+        body.add_control("next", url_for("api.eventsbyarea", area_id=area_id,
+            after=encode_cursor(last.begins_at, last.id), **query
+        ))
+
+    for db_event in rows:
+        #body.add_control_get_event(db_event.id)
+        item = NearbyEventsBuilder(
+            id=db_event.id,
+            name=db_event.name,
+            area_name=db_event.area_name
+        )
+        item.add_control("self", url_for("api.eventitem", event_id=db_event.id))
+        item.add_control("profile", EVENT_PROFILE)
+        item.add_control_get_area(db_event.area_id)
+        body["items"].append(item)
+    return body
+
+
+def parse_page_args():
+    """
+    Reads the page of the current request, raises ValueError with a message
+    for the client if the parameters are not valid.
+    """
+
+    config = current_app.config
+    return PageArgs(request.args, config["EVENTS_PAGE_SIZE"], config["EVENTS_MAX_PAGE_SIZE"])
+
+
+def unknown_area(area=None, area_id=None):
+    if area_id is not None:
+        message = "No area was found with the id {}".format(area_id)
+    else:
+        message = "No area was found with the name {}".format(area)
+    return create_error_response(404, "Not found", message)
+
 
 class EventsByArea(Resource):
 
     """
-        Retrieve events that are in a given area. Requires area name (string)
-    """
-    def get(self, area):
-        db_eventsbyarea = Event.query.filter(Event.area_name == area).all()
-        if db_eventsbyarea is None:
-            return create_error_response(404, "Not found", 
-                "No area was found with the name {}".format(area)
-            )
-        body = NearbyEventsBuilder()
-
-        body.add_namespace("nearby", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.eventsbyarea", area=area))
-        body.add_control_get_areas()
-        body["items"]=[]
-        
-        for db_event in db_eventsbyarea:
-            #body.add_control_get_event(db_event.name)
-            item = NearbyEventsBuilder(
-                name=db_event.name,
-                area_name=db_event.area_name
-            )
-            item.add_control("self", url_for("api.eventitem", event=db_event.name))
-            item.add_control("profile", EVENT_PROFILE)
-            item.add_control_get_area(db_event.area_name)
-            body["items"].append(item)
-        
-        return Response(json.dumps(body), 200, mimetype=MASON)
\ No newline at end of file
+        Retrieve events that are in a given area. Requires area id (integer)
+        or name (string)
+        Optional query parameters: limit, after (cursor of the next page),
+        from and to (begin time window)
+    """
+    def get(self, area=None, area_id=None):
+        try:
+            page = parse_page_args()
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameters", str(e))
+        resolver = get_resolver()
+        if area_id is None:
+            resolved = resolver.resolve(area)
+        else:
+            resolved = area_id if resolver.name_of(area_id) is not None else None
+        if resolved is None:
+            return unknown_area(area, area_id)
+        rows = db.session.execute(events_by_area_query(page, area_id=resolved)).fetchall()
+        if not rows:
+            # Deleted after the area map was loaded
+            return unknown_area(area, area_id)
+        body = events_by_area_body(resolved, rows, page)
+        return Response(dump_json(body), 200, mimetype=MASON)
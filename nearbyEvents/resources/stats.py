@@ -0,0 +1,55 @@
+from flask import request, Response, url_for
+from flask_restful import Resource
+from nearbyEvents.utils import NearbyEventsBuilder, create_error_response, dump_json
+from nearbyEvents.constants import *
+
+MAX_BINS = 1000
+MAX_HORIZON = 3650
+
+
+def _parse_percentiles(value):
+    percentiles = tuple(float(p) for p in value.split(","))
+    if not percentiles or any(not 0 <= p <= 100 for p in percentiles):
+        raise ValueError
+    return percentiles
+
+
+class SalesStatistics(Resource):
+
+    """
+        Sales and pricing statistics over all events and tickets.
+        Optional query parameters: percentiles (comma separated, 0-100),
+        bins (price histogram bins) and horizon (days of the sell-through curve)
+    """
+    def get(self):
+        try:
+            percentiles = _parse_percentiles(request.args.get("percentiles", "5,25,50,75,95"))
+            bins = int(request.args.get("bins", 10))
+            horizon = int(request.args.get("horizon", 30))
+            if not 1 <= bins <= MAX_BINS or not 0 <= horizon <= MAX_HORIZON:
+                raise ValueError
+        except ValueError:
+            return create_error_response(400, "Invalid query parameters",
+                "percentiles must be numbers between 0 and 100, bins between 1 and {} "
+                "and horizon between 0 and {}".format(MAX_BINS, MAX_HORIZON)
+            )
+
+        # NumPy is only imported once statistics are requested
+        from nearbyEvents import analytics
+        snapshot = analytics.get_snapshot()
+
+        body = NearbyEventsBuilder(
+            tickets={
+                "sold": int(snapshot.ticket_event.size),
+                "paid": int(snapshot.ticket_paid.sum())
+            },
+            prices=analytics.price_statistics(snapshot, percentiles),
+            price_histogram=analytics.price_histogram(snapshot, bins),
+            areas=analytics.area_statistics(snapshot, percentiles),
+            event_sell_through=analytics.event_sell_through(snapshot, percentiles),
+            sell_through_curve=analytics.sell_through_curve(snapshot, horizon)
+        )
+        body.add_namespace("nearby", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.salesstatistics"))
+        body.add_control_get_areas()
+        return Response(dump_json(body), 200, mimetype=MASON)
@@ -0,0 +1,59 @@
+import json
+from flask import Response, current_app
+from flask_restful import Resource
+from nearbyEvents.constants import *
+
+
+def format_sse(message, event=None):
+    """
+    Formats a single server-sent event. The broker sequence number is used as
+    the event id so that clients can tell whether they missed something.
+    """
+
+    lines = []
+    if event is not None:
+        lines.append("event: {}".format(event))
+    if "id" in message:
+        lines.append("id: {}".format(message["id"]))
+    lines.append("data: {}".format(json.dumps(message)))
+    return "\n".join(lines) + "\n\n"
+
+
+def stream_changes(broker, subscription, keepalive):
+    """
+    Yields change notifications of a subscription as server-sent events until
+    the client goes away. When the subscriber buffer overflowed a resync event
+    is sent instead of the lost messages, telling the client to re-fetch.
+    """
+
+    try:
+        yield "retry: {}\n\n".format(SSE_RETRY_MS)
+        while True:
+            messages, dropped = subscription.get(timeout=keepalive)
+            if dropped:
+                yield format_sse({"dropped": dropped}, event="resync")
+            for message in messages:
+                yield format_sse(message, event=message["type"])
+            if not messages and not dropped:
+                yield ": keepalive\n\n"
+    finally:
+        broker.unsubscribe(subscription)
+
+
+class CatalogueUpdates(Resource):
+
+    """
+        Stream area and event change notifications as server-sent events
+    """
+    def get(self):
+        broker = current_app.extensions["nearby_changes"]
+        subscription = broker.subscribe()
+        response = Response(
+            stream_changes(broker, subscription, current_app.config["SSE_KEEPALIVE"]),
+            200,
+            mimetype=SSE,
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+        # A response closed before the stream started never runs its finally
+        response.call_on_close(lambda: broker.unsubscribe(subscription))
+        return response
@@ -0,0 +1,197 @@
+"""
+Read replica routing. With READ_REPLICAS set, GET and HEAD requests read from
+one of the given read-only databases, in turn, and everything else, including
+every flush, goes to the primary database (SQLALCHEMY_DATABASE_URI).
+
+A replica may lag behind the primary, so a client that has written something
+reads from the primary for the next READ_REPLICA_STICKY_SECONDS seconds: a
+successful write sets a cookie with the time until which the client's reads
+stay on the primary. The per-process caches (area map, name filters) always
+load from the primary, see use_primary.
+
+With READ_ONLY_AUTOCOMMIT the session of a GET or HEAD request runs without a
+transaction: every query checks a connection out and returns it right away,
+so a request that is busy rendering does not hold a connection and its read
+lock.
+
+SQLite replica files are brought up to date with the primary by
+flask syncReplicas, which copies the primary with the SQLite backup API.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+import click
+from flask import current_app, g, has_app_context, has_request_context, request
+from flask.cli import with_appcontext
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+
+# Cookie holding the time until which the client reads from the primary
+STICKY_COOKIE = "nearby-primary-until"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def read_engine():
+    """
+    Returns the replica engine chosen for the current request, or None if
+    it reads from the primary.
+    """
+
+    if not has_app_context():
+        return None
+    return g.get("nearby_read_engine")
+
+
+def for_each_engine(app, callback):
+    """
+    Calls callback with each engine of the app, the primary and the binds.
+    Engines are created on first use, so callers run this with the first
+    request.
+    """
+
+    state = get_state(app)
+    for bind in [None] + list(app.config.get("SQLALCHEMY_BINDS") or {}):
+        callback(state.db.get_engine(app, bind))
+
+
+@contextmanager
+def use_primary():
+    """
+    Makes the queries run within the block read from the primary, for reads
+    that must not see a lagging replica.
+    """
+
+    engine = g.pop("nearby_read_engine", None) if has_app_context() else None
+    try:
+        yield
+    finally:
+        if engine is not None:
+            g.nearby_read_engine = engine
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends the queries of a request routed to a replica there.
+    Flushes always go to the primary.
+    """
+
+    def __init__(self, db, autocommit=False, **options):
+        if not autocommit and has_request_context() and request.method in ("GET", "HEAD"):
+            autocommit = db.get_app().config["READ_ONLY_AUTOCOMMIT"]
+        super(RoutingSession, self).__init__(db, autocommit=autocommit, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        engine = read_engine()
+        if engine is not None and not self._flushing:
+            return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaRouter(object):
+    """
+    Chooses the database each request reads from.
+    """
+
+    def __init__(self, app, binds, sticky_seconds):
+        self.app = app
+        self.binds = binds
+        self.sticky_seconds = sticky_seconds
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def engines(self):
+        state = get_state(self.app)
+        return [state.db.get_engine(self.app, bind) for bind in self.binds]
+
+    def next_engine(self):
+        with self._lock:
+            bind = self.binds[self._next % len(self.binds)]
+            self._next += 1
+        return get_state(self.app).db.get_engine(self.app, bind)
+
+    def is_sticky(self, req):
+        try:
+            return float(req.cookies.get(STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def before_request(self):
+        if request.method in ("GET", "HEAD") and not self.is_sticky(request):
+            g.nearby_read_engine = self.next_engine()
+
+    def after_request(self, response):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(STICKY_COOKIE,
+                "{:.3f}".format(time.time() + self.sticky_seconds),
+                max_age=int(math.ceil(self.sticky_seconds)), httponly=True
+            )
+        return response
+
+
+def init_app(app):
+    uris = app.config["READ_REPLICAS"]
+    if not uris:
+        return None
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    names = []
+    for i, uri in enumerate(uris):
+        names.append("replica-{}".format(i))
+        binds[names[-1]] = uri
+    app.config["SQLALCHEMY_BINDS"] = binds
+    router = app.extensions["nearby_replicas"] = ReplicaRouter(
+        app, names, app.config["READ_REPLICA_STICKY_SECONDS"]
+    )
+    app.before_request(router.before_request)
+    app.after_request(router.after_request)
+    return router
+
+
+def sync_replicas(app):
+    """
+    Copies the primary database over the SQLite replicas of the app and
+    returns the names of the replicas that were synced. Replicas on other
+    databases are left to their own replication.
+    """
+
+    db = get_state(app).db
+    primary = db.get_engine(app)
+    router = app.extensions.get("nearby_replicas")
+    if router is None or primary.url.drivername != "sqlite":
+        return []
+    synced = []
+    source = primary.raw_connection()
+    try:
+        for bind, engine in zip(router.binds, router.engines()):
+            if engine.url.drivername != "sqlite":
+                continue
+            target = engine.raw_connection()
+            try:
+                source.connection.backup(target.connection)
+            finally:
+                target.close()
+            synced.append(bind)
+    finally:
+        source.close()
+    return synced
+
+
+@click.command("syncReplicas")
+@click.option("--interval", type=float, default=None,
+    help="Keep syncing every INTERVAL seconds."
+)
+@with_appcontext
+def syncReplicas(interval):
+    while True:
+        started = time.monotonic()
+        synced = sync_replicas(current_app._get_current_object())
+        click.echo("Synced {} replicas ({:.3f} s)".format(len(synced), time.monotonic() - started))
+        if interval is None:
+            return
+        time.sleep(interval)
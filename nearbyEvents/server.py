@@ -0,0 +1,234 @@
+"""
+Pre-forking production server. The master process imports and configures the
+app once, then forks the workers so that imported modules, mapped classes,
+the URL map and compiled schemas are shared copy-on-write. Each worker warms
+up before it starts accepting connections on the shared listening socket.
+
+Signals handled by the master:
+
+    SIGHUP           start a new set of workers, then stop the old ones
+    SIGTERM, SIGINT  stop gracefully, letting in-flight requests finish
+"""
+import errno
+import gc
+import os
+import select
+import signal
+import socket
+import threading
+import time
+import traceback
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.serving import make_server
+from nearbyEvents import db
+from nearbyEvents.startup import preload
+
+
+def warm_up(app):
+    """
+    Prepares a freshly forked worker for traffic: connections inherited from
+    the master are dropped, a new one is opened and the registered warm-up
+    hooks prime the caches.
+    """
+
+    with app.app_context():
+        engine = db.get_engine(app)
+        engine.dispose()
+        with engine.connect() as connection:
+            connection.execute("SELECT 1")
+        for hook in app.extensions["nearby_warmup"]:
+            # Caches that fail to prime are filled on first use instead
+            try:
+                hook()
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Warm-up hook %r failed", hook)
+        db.session.remove()
+
+
+class Worker(object):
+
+    def __init__(self, pid, ready_fd):
+        self.pid = pid
+        # Closed once the worker reported that it finished warming up
+        self.ready_fd = ready_fd
+        self.ready = False
+        self.stop_sent = None
+
+
+class Master(object):
+    """
+    Forks and supervises the worker processes. Workers that die unexpectedly
+    are replaced; workers that do not finish within graceful_timeout after
+    being asked to stop are killed.
+    """
+
+    def __init__(self, app, host, port, workers, graceful_timeout=30, backlog=2048):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.worker_count = workers
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.workers = {}
+        self.stopping = False
+        self.reload_requested = False
+
+    def run(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(self.backlog)
+        self.socket.set_inheritable(True)
+
+        preload(self.app)
+        # Objects created so far are never freed, keep the collector from
+        # touching their pages so that they stay shared with the workers
+        gc.freeze()
+
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGHUP, self._request_reload)
+
+        click.echo("Serving on http://{}:{}/ with {} workers (master {})".format(
+            self.host, self.socket.getsockname()[1], self.worker_count, os.getpid()
+        ))
+        self.spawn_workers()
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.poll()
+            if not self.stopping and len(self.live_workers()) < self.worker_count:
+                self.spawn_workers(self.worker_count - len(self.live_workers()))
+        self.stop_workers(list(self.workers.values()))
+        self.socket.close()
+
+    def _request_stop(self, signum, frame):
+        self.stopping = True
+
+    def _request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def live_workers(self):
+        return [worker for worker in self.workers.values() if worker.stop_sent is None]
+
+    def spawn_workers(self, count=None):
+        spawned = []
+        for i in range(self.worker_count if count is None else count):
+            ready_read, ready_write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(ready_read)
+                self.run_worker(ready_write)
+            os.close(ready_write)
+            worker = Worker(pid, ready_read)
+            self.workers[pid] = worker
+            spawned.append(worker)
+        return spawned
+
+    def run_worker(self, ready_fd):
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            warm_up(self.app)
+            server = make_server(self.host, self.port, self.app, threaded=True, fd=self.socket.fileno())
+            # Let server_close wait for the threads of in-flight requests
+            server.daemon_threads = False
+            server.block_on_close = True
+
+            def stop(signum, frame):
+                threading.Thread(target=server.shutdown).start()
+
+            signal.signal(signal.SIGTERM, stop)
+            os.write(ready_fd, b"1")
+            os.close(ready_fd)
+            server.serve_forever()
+            server.server_close()
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def poll(self, timeout=0.5):
+        pending = {
+            worker.ready_fd: worker for worker in self.workers.values()
+            if worker.ready_fd is not None
+        }
+        if pending:
+            readable = select.select(list(pending), [], [], timeout)[0]
+        else:
+            readable = []
+            time.sleep(timeout)
+        for fd in readable:
+            worker = pending[fd]
+            worker.ready = os.read(fd, 1) == b"1"
+            worker.ready_fd = None
+            os.close(fd)
+        self.reap()
+        now = time.monotonic()
+        for worker in self.workers.values():
+            if worker.stop_sent is not None and now - worker.stop_sent > self.graceful_timeout:
+                self._kill(worker.pid, signal.SIGKILL)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is not None and worker.ready_fd is not None:
+                os.close(worker.ready_fd)
+                worker.ready_fd = None
+
+    def reload(self):
+        old = self.live_workers()
+        new = self.spawn_workers()
+        deadline = time.monotonic() + self.graceful_timeout
+        while time.monotonic() < deadline and any(
+            worker.pid in self.workers and worker.ready_fd is not None for worker in new
+        ):
+            self.poll(0.1)
+            if self.stopping:
+                return
+        for worker in old:
+            self._stop(worker)
+
+    def stop_workers(self, workers):
+        for worker in workers:
+            if worker.stop_sent is None:
+                self._stop(worker)
+        while self.workers:
+            self.poll(0.1)
+
+    def _stop(self, worker):
+        worker.stop_sent = time.monotonic()
+        self._kill(worker.pid, signal.SIGTERM)
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+
+@click.command("serve")
+@click.option("--host", "-h", default="127.0.0.1", help="The interface to bind to.")
+@click.option("--port", "-p", default=5000, help="The port to bind to.")
+@click.option("--workers", "-w", default=None, type=int, help="Number of worker processes, defaults to the number of CPUs.")
+@click.option("--graceful-timeout", default=30, help="Seconds a stopping worker may take to finish its requests.")
+@with_appcontext
+def serve(host, port, workers, graceful_timeout):
+    if not hasattr(os, "fork"):
+        raise click.UsageError("serve needs a platform with os.fork, use 'flask run' instead.")
+    app = current_app._get_current_object()
+    Master(app, host, port, workers or os.cpu_count(), graceful_timeout).run()
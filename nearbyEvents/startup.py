@@ -0,0 +1,130 @@
+"""
+Startup work of the app and a report of where the startup time goes.
+
+By default create_app finishes all initialization up front so that the first
+request does not pay for it. With LAZY_INIT the app skips that and defers
+jsonschema, mapper configuration and URL map sorting to first use, which gets
+a new process serving sooner.
+
+In both modes the modules of the CLI commands, of the backup endpoints and
+of features that are turned off are not imported by create_app: commands
+are registered by name through LazyGroup and views through LazyView.
+"""
+import json
+import subprocess
+import sys
+from collections import namedtuple
+import click
+from flask.cli import AppGroup
+from sqlalchemy.orm import configure_mappers
+from werkzeug.utils import cached_property, import_string
+from nearbyEvents.models import Area, Event
+from nearbyEvents.utils import get_validator
+
+StartupProfile = namedtuple("StartupProfile", ["seconds", "modules"])
+ModuleImport = namedtuple("ModuleImport", ["name", "depth", "self_us", "cumulative_us"])
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+from nearbyEvents import create_app
+create_app(json.loads({config!r}))
+print(time.perf_counter() - start)
+"""
+
+
+class LazyGroup(AppGroup):
+    """
+    The app's command group, importing the module of a command given as
+    "module:attribute" when the command is looked up.
+    """
+
+    def __init__(self, name, commands):
+        super(LazyGroup, self).__init__(name)
+        self.lazy_commands = dict(commands)
+
+    def list_commands(self, ctx):
+        return sorted(set(super(LazyGroup, self).list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, name):
+        if name in self.lazy_commands:
+            self.add_command(import_string(self.lazy_commands.pop(name)), name)
+        return super(LazyGroup, self).get_command(ctx, name)
+
+
+class LazyView(object):
+    """
+    View function given as "module:attribute", imported on the first request.
+    """
+
+    def __init__(self, import_name):
+        self.import_name = import_name
+        self.__name__ = import_name.rpartition(":")[2]
+
+    @cached_property
+    def view(self):
+        return import_string(self.import_name)
+
+    def __call__(self, *args, **kwargs):
+        return self.view(*args, **kwargs)
+
+
+def preload(app):
+    """
+    Does the initialization that would otherwise happen on first use.
+    """
+
+    configure_mappers()
+    for model in (Area, Event):
+        get_validator(model)
+    app.url_map.update()
+
+
+def parse_importtime(output):
+    """
+    Parses the stderr of python -X importtime into ModuleImport tuples.
+    """
+
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        stripped = name.lstrip(" ")
+        depth = (len(name) - len(stripped) - 1) // 2
+        modules.append(ModuleImport(stripped.strip(), depth, int(self_us), int(cumulative_us)))
+    return modules
+
+
+def profile_startup(lazy=False, config=None):
+    """
+    Creates the app in a fresh interpreter and returns the seconds spent in
+    importing the package and create_app together with the import times of
+    every module loaded on the way.
+    """
+
+    config = dict(config or {
+        "SQLALCHEMY_DATABASE_URI": "sqlite://",
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False
+    })
+    config["LAZY_INIT"] = lazy
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(config=json.dumps(config))],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True
+    )
+    return StartupProfile(float(result.stdout.strip().splitlines()[-1]), parse_importtime(result.stderr))
+
+
+@click.command("startupProfile")
+@click.option("--lazy", is_flag=True, help="Profile the lazy initialization mode.")
+@click.option("--top", default=20, help="Number of modules to list.")
+def startupProfile(lazy, top):
+    profile = profile_startup(lazy)
+    click.echo("create_app ready after {:.1f} ms ({} modules imported)".format(
+        profile.seconds * 1000, len(profile.modules)
+    ))
+    click.echo("{:>10} {:>10}  module".format("self ms", "total ms"))
+    for module in sorted(profile.modules, key=lambda m: m.self_us, reverse=True)[:top]:
+        click.echo("{:10.1f} {:10.1f}  {}".format(
+            module.self_us / 1000, module.cumulative_us / 1000, module.name
+        ))
@@ -4,6 +4,10 @@
 const DEBUG = true;
 const MASONJSON = "application/vnd.mason+json";
 const PLAINJSON = "application/json";
+const UPDATES = "/api/updates/";
+
+// Collection view that is re-fetched when the server pushes a change
+let currentCollection = null;
 
 function renderError(jqxhr) {
     let msg = jqxhr.responseJSON["@error"]["@message"];
@@ -132,6 +136,24 @@ function followLink(event, a, renderer) {
     getResource($(a).attr("href"), renderer);
 }
 
+function showCollection(href, renderer) {
+    currentCollection = {href: href, renderer: renderer};
+}
+
+function subscribeUpdates() {
+    if (typeof EventSource === "undefined") {
+        return;
+    }
+    let source = new EventSource(UPDATES);
+    ["area", "event", "resync"].forEach(function (type) {
+        source.addEventListener(type, function () {
+            if (currentCollection !== null) {
+                getResource(currentCollection.href, currentCollection.renderer);
+            }
+        });
+    });
+}
+
 function submitArea(event) {
     event.preventDefault();
 
@@ -202,6 +224,7 @@ function renderAreaForm(ctrl) {
 }
 
 function renderArea(body) {
+    currentCollection = null;
     $("div.navigation").html(
         "<a href='" +
         body["@controls"].collection.href +
@@ -227,6 +250,7 @@ function renderEventForm(ctrl) {
 }
 
 function renderEvent(body) {
+    currentCollection = null;
     $("div.navigation").html(
         "<a href='" +
         body["@controls"].collection.href +
@@ -240,6 +264,7 @@ function renderEvent(body) {
 }
 
 function renderAreas(body) {
+    showCollection(body["@controls"].self.href, renderAreas);
     $("div.navigation").empty();
     $("div.tablecontrols").empty();
     $(".resulttable thead").html(
@@ -254,6 +279,7 @@ function renderAreas(body) {
 }
 
 function renderEvents(body) {
+    showCollection(body["@controls"].self.href, renderEvents);
     $("div.navigation").empty();
     $("div.tablecontrols").empty();
     $(".resulttable thead").html(
@@ -268,6 +294,7 @@ function renderEvents(body) {
 }
 
 function renderEventsByArea(body) {
+    showCollection(body["@controls"].self.href, renderEventsByArea);
     $("div.navigation").empty();
     $("div.tablecontrols").empty();
 	$("div.form").empty();
@@ -288,4 +315,5 @@ function renderEventsByArea(body) {
 
 $(document).ready(function () {
     getResource("http://localhost:5000/api/areas/", renderAreas);
+    subscribeUpdates();
 });
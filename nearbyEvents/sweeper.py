@@ -0,0 +1,228 @@
+"""
+Expiry of unpaid reservations. Holds that stay unpaid for longer than
+RESERVATION_HOLD_TTL seconds are deleted together with their tickets, which
+gives their capacity back to the event and its area.
+
+Expired reservations are found through the (paid, created_at) index and
+deleted in batches of RESERVATION_SWEEP_BATCH, each in its own short
+transaction with a pause in between, so the sweeper never keeps the write
+lock away from the booking path for long.
+
+Every worker of the pre-forking server starts a background sweeper, but only
+the one holding the RESERVATION_SWEEP_LOCK file sweeps. The lock is released
+when its holder exits, and another worker takes over on its next tick.
+"""
+import datetime
+import os
+import threading
+import time
+from collections import namedtuple
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from nearbyEvents import db
+from nearbyEvents.aggregates import release_reservations
+from nearbyEvents.models import Reservation, Ticket
+
+try:
+    import fcntl
+except ImportError:
+    # No pre-forking server without fork either, so the one process sweeps
+    fcntl = None
+
+SweepResult = namedtuple("SweepResult", ["reservations", "tickets", "batches", "seconds"])
+
+
+class SweepMetrics(object):
+    """
+    Totals and the latest result of the sweeps run in this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.reservations = 0
+        self.tickets = 0
+        self.last = None
+        self.last_run = None
+
+    def record(self, result):
+        with self._lock:
+            self.runs += 1
+            self.reservations += result.reservations
+            self.tickets += result.tickets
+            self.last = result
+            self.last_run = datetime.datetime.now()
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "reservations_expired": self.reservations,
+                "tickets_released": self.tickets,
+                "last_run": self.last_run.isoformat() if self.last_run else None,
+                "last": self.last._asdict() if self.last else None,
+            }
+
+
+def _expire_batch(cutoff, batch_size):
+    ids = [row.id for row in db.session.query(Reservation.id).filter(
+        Reservation.paid == False,
+        Reservation.created_at < cutoff
+    ).order_by(Reservation.created_at).limit(batch_size).with_for_update(skip_locked=True)]
+    if not ids:
+        return 0, 0
+    # The first statement takes the write lock; re-checking paid in every
+    # statement keeps a hold that was paid meanwhile
+    release_reservations(ids)
+    expired = db.session.query(Reservation.id).filter(
+        Reservation.id.in_(ids), Reservation.paid == False
+    )
+    tickets = Ticket.query.filter(
+        Ticket.reservation_id.in_(expired.subquery())
+    ).delete(synchronize_session=False)
+    reservations = Reservation.query.filter(
+        Reservation.id.in_(ids), Reservation.paid == False
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return reservations, tickets
+
+
+def sweep_expired_reservations(ttl, batch_size=500, pause=0.01):
+    """
+    Deletes the unpaid reservations older than ttl seconds and their tickets.
+    Must be called within an application context.
+    : param int ttl: seconds an unpaid reservation is held
+    : param int batch_size: reservations deleted per transaction
+    : param float pause: seconds to sleep between batches
+    """
+
+    start = time.perf_counter()
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=ttl)
+    reservations = tickets = batches = 0
+    try:
+        while True:
+            expired, released = _expire_batch(cutoff, batch_size)
+            if not expired:
+                break
+            reservations += expired
+            tickets += released
+            batches += 1
+            if expired < batch_size:
+                break
+            time.sleep(pause)
+    except Exception:
+        db.session.rollback()
+        raise
+    result = SweepResult(reservations, tickets, batches, time.perf_counter() - start)
+    current_app.extensions["nearby_sweeper"].record(result)
+    if reservations:
+        current_app.logger.info(
+            "Expired %d unpaid reservations (%d tickets) in %d batches, %.3f s",
+            reservations, tickets, batches, result.seconds
+        )
+    return result
+
+
+class SweeperLock(object):
+    """
+    Lock file electing the one process that sweeps. Acquiring never blocks,
+    the lock is kept until released or until the process exits.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self):
+        return self._file is not None or fcntl is None
+
+    def acquire(self):
+        if self.held:
+            return True
+        lock_file = open(self.path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ReservationSweeper(threading.Thread):
+    """
+    Background thread running a sweep every interval seconds while it holds
+    the sweeper lock.
+    """
+
+    def __init__(self, app, interval, lock):
+        super(ReservationSweeper, self).__init__(name="nearby-sweeper", daemon=True)
+        self.app = app
+        self.interval = interval
+        self.lock = lock
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            self._sweep_while_running()
+        finally:
+            self.lock.release()
+
+    def _sweep_while_running(self):
+        config = self.app.config
+        while not self.stopped.wait(self.interval):
+            if not self.lock.acquire():
+                continue
+            with self.app.app_context():
+                try:
+                    sweep_expired_reservations(
+                        config["RESERVATION_HOLD_TTL"], config["RESERVATION_SWEEP_BATCH"]
+                    )
+                except Exception:
+                    self.app.logger.exception("Reservation sweep failed")
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_sweeper(app):
+    """
+    Starts the background sweeper of this process if RESERVATION_SWEEP_INTERVAL
+    is set. Threads do not survive a fork, so this is done on the first
+    request of each process rather than in create_app.
+    """
+
+    interval = app.config["RESERVATION_SWEEP_INTERVAL"]
+    if not interval or "nearby_sweeper_thread" in app.extensions:
+        return
+    lock = SweeperLock(
+        app.config["RESERVATION_SWEEP_LOCK"] or os.path.join(app.instance_path, "sweeper.lock")
+    )
+    sweeper = app.extensions["nearby_sweeper_thread"] = ReservationSweeper(app, interval, lock)
+    sweeper.start()
+
+
+@click.command("sweepReservations")
+@click.option("--loop", is_flag=True, help="Keep sweeping every RESERVATION_SWEEP_INTERVAL seconds.")
+@with_appcontext
+def sweepReservations(loop):
+    config = current_app.config
+    while True:
+        result = sweep_expired_reservations(
+            config["RESERVATION_HOLD_TTL"], config["RESERVATION_SWEEP_BATCH"]
+        )
+        click.echo("Expired {} reservations, released {} tickets in {} batches ({:.3f} s)".format(
+            result.reservations, result.tickets, result.batches, result.seconds
+        ))
+        if not loop:
+            return
+        time.sleep(config["RESERVATION_SWEEP_INTERVAL"] or 60)
@@ -0,0 +1,334 @@
+"""
+Request tracing. With TRACE_FILE or TRACE_COLLECTOR set, every request,
+or a TRACE_SAMPLE_RATE share of them, is recorded as a trace of spans:
+
+    GET /api/areas/<area>/events/      the whole WSGI call
+      EventsByArea.get                 the resource method
+        sql SELECT                     each statement
+        jsonschema.validate            validation of request documents
+        mason.events_by_area_body      building the Mason body
+        json.dumps                     encoding the response
+
+A W3C traceparent header continues the caller's trace (its sampled flag is
+honoured) and the response names the request's span in a traceresponse
+header. Finished spans are exported in the Zipkin v2 JSON format by a thread
+of each process, appended one per line to TRACE_FILE and posted in batches
+to TRACE_COLLECTOR (for example http://localhost:9411/api/v2/spans). When
+the export falls behind, spans beyond TRACE_QUEUE_SIZE are dropped.
+
+Spans of code running outside a traced request, and the reads served
+natively by the async serving mode, are not recorded.
+"""
+import contextvars
+import functools
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from flask import request
+from sqlalchemy import event
+from nearbyEvents.routing import for_each_engine
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+# Longest statement text stored in a span
+MAX_STATEMENT = 500
+
+_current = contextvars.ContextVar("nearby_span", default=None)
+
+
+def _new_id(size):
+    return os.urandom(size).hex()
+
+
+class Span(object):
+
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "name", "kind",
+        "tags", "timestamp", "_started", "duration")
+
+    def __init__(self, tracer, trace_id, parent_id, name, kind=None, tags=None):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.tags = tags or {}
+        self.timestamp = int(time.time() * 1e6)
+        self._started = time.perf_counter()
+        self.duration = None
+
+    def child(self, name, **tags):
+        return Span(self.tracer, self.trace_id, self.span_id, name, tags=tags)
+
+    def finish(self):
+        self.duration = max(1, int((time.perf_counter() - self._started) * 1e6))
+        self.tracer.exporter.export(self)
+
+    def traceparent(self):
+        return "00-{}-{}-01".format(self.trace_id, self.span_id)
+
+    def as_zipkin(self, service):
+        span = {
+            "traceId": self.trace_id,
+            "id": self.span_id,
+            "name": self.name,
+            "timestamp": self.timestamp,
+            "duration": self.duration,
+            "localEndpoint": {"serviceName": service},
+            "tags": {key: str(value) for key, value in self.tags.items()},
+        }
+        if self.parent_id is not None:
+            span["parentId"] = self.parent_id
+        if self.kind is not None:
+            span["kind"] = self.kind
+        return span
+
+
+def current_span():
+    return _current.get()
+
+
+@contextmanager
+def span(name, **tags):
+    """
+    Records the block as a child of the current span. Does nothing outside a
+    traced request.
+    """
+
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, **tags)
+    token = _current.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.tags["error"] = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+def traced(kind):
+    """
+    Decorator recording each call of the function as a span named
+    kind.function_name.
+    """
+
+    def decorator(function):
+        name = "{}.{}".format(kind, function.__name__)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_resource(view):
+    """
+    Flask-RESTful view decorator recording the resource method as a span.
+    """
+
+    resource = view.view_class.__name__
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if _current.get() is None:
+            return view(*args, **kwargs)
+        with span("{}.{}".format(resource, request.method.lower())):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+class SpanExporter(object):
+    """
+    Exports finished spans from a background thread of each process.
+    """
+
+    def __init__(self, service, path=None, url=None, queue_size=10000, batch_size=100, interval=1.0):
+        self.service = service
+        self.path = path
+        self.url = url
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self._queue = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_thread(self):
+        # Threads do not survive a fork, each worker starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.queue_size)
+            threading.Thread(target=self._run, name="nearby-trace-export", daemon=True).start()
+            self._pid = os.getpid()
+
+    def export(self, finished):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(finished)
+        except queue.Full:
+            self.dropped += 1
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self.write([finished.as_zipkin(self.service) for finished in batch])
+            except Exception:
+                self.dropped += len(batch)
+            finally:
+                for i in range(len(batch)):
+                    self._queue.task_done()
+
+    def write(self, spans):
+        if self.path is not None:
+            with open(self.path, "a") as f:
+                f.write("".join(json.dumps(s) + "\n" for s in spans))
+        if self.url is not None:
+            post = urllib.request.Request(self.url, data=json.dumps(spans).encode(),
+                headers={"Content-Type": "application/json"}
+            )
+            urllib.request.urlopen(post, timeout=5).close()
+
+    def flush(self):
+        """
+        Waits until the spans exported so far have been written.
+        """
+
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.join()
+
+
+class Tracer(object):
+
+    def __init__(self, app, exporter, sample_rate=1.0):
+        self.app = app
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def start(self, environ):
+        """
+        Returns the root span of the request, or None if it is not traced.
+        """
+
+        match = TRACEPARENT.match(environ.get("HTTP_TRACEPARENT", "").strip().lower())
+        if match:
+            trace_id, parent_id, flags = match.groups()
+            if not int(flags, 16) & 1:
+                return None
+        elif random.random() < self.sample_rate:
+            trace_id, parent_id = _new_id(16), None
+        else:
+            return None
+        return Span(self, trace_id, parent_id,
+            "{} {}".format(environ.get("REQUEST_METHOD", "GET"), environ.get("PATH_INFO", "")),
+            kind="SERVER", tags={"http.method": environ.get("REQUEST_METHOD", "GET")}
+        )
+
+    def watch_queries(self):
+        """
+        Records the statements of the app's engines.
+        """
+
+        for_each_engine(self.app, self._listen)
+
+    def _listen(self, engine):
+        event.listen(engine, "before_cursor_execute", self._query_started)
+        event.listen(engine, "after_cursor_execute", self._query_finished)
+        event.listen(engine, "handle_error", self._query_failed)
+
+    def _query_started(self, conn, cursor, statement, parameters, context, executemany):
+        parent = _current.get()
+        if parent is not None:
+            verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "SQL"
+            conn.info["nearby_sql_span"] = parent.child("sql " + verb,
+                **{"db.statement": statement[:MAX_STATEMENT], "db.url": conn.engine.url.database}
+            )
+
+    def _query_finished(self, conn, cursor, statement, parameters, context, executemany):
+        query = conn.info.pop("nearby_sql_span", None)
+        if query is not None:
+            query.finish()
+
+    def _query_failed(self, context):
+        query = context.connection.info.pop("nearby_sql_span", None) if context.connection else None
+        if query is not None:
+            query.tags["error"] = type(context.original_exception).__name__
+            query.finish()
+
+    def name_root(self):
+        # Request hook, names the root span after the matched rule
+        root = _current.get()
+        if root is not None and root.kind == "SERVER" and request.url_rule is not None:
+            root.name = "{} {}".format(request.method, request.url_rule.rule)
+            root.tags["http.route"] = request.url_rule.rule
+
+
+class TracingMiddleware(object):
+
+    def __init__(self, wsgi_app, tracer):
+        self.wsgi_app = wsgi_app
+        self.tracer = tracer
+
+    def __call__(self, environ, start_response):
+        root = self.tracer.start(environ)
+        if root is None:
+            return self.wsgi_app(environ, start_response)
+
+        def traced_start(status, headers, exc_info=None):
+            root.tags["http.status_code"] = status.split(" ", 1)[0]
+            headers = headers + [("traceresponse", root.traceparent())]
+            return start_response(status, headers, exc_info)
+
+        token = _current.set(root)
+        try:
+            return self.wsgi_app(environ, traced_start)
+        except Exception as e:
+            root.tags["error"] = type(e).__name__
+            raise
+        finally:
+            _current.reset(token)
+            root.finish()
+
+
+def init_app(app):
+    path = app.config["TRACE_FILE"]
+    url = app.config["TRACE_COLLECTOR"]
+    if path is None and url is None:
+        return None
+    exporter = SpanExporter(app.config["TRACE_SERVICE_NAME"], path, url, app.config["TRACE_QUEUE_SIZE"])
+    tracer = app.extensions["nearby_tracer"] = Tracer(app, exporter, app.config["TRACE_SAMPLE_RATE"])
+    app.before_first_request(tracer.watch_queries)
+    app.before_request(tracer.name_root)
+    app.wsgi_app = TracingMiddleware(app.wsgi_app, tracer)
+    return tracer
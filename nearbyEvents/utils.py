@@ -2,6 +2,7 @@ import json
 from flask import Response, request, url_for
 from nearbyEvents.constants import *
 from nearbyEvents.models import *
+from nearbyEvents.tracing import span
 
 # This code is based on the PWP course example of University of Oulu
 # https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/
@@ -69,17 +70,17 @@ class MasonBuilder(dict):
 # These controls are adapted from the example by https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/
 class NearbyEventsBuilder(MasonBuilder):
 
-    def add_control_delete_area(self, area):
+    def add_control_delete_area(self, area_id):
         self.add_control(
             "nearby:delete-area",
-            url_for("api.areaitem", area=area),
+            url_for("api.areaitem", area_id=area_id),
             method="DELETE",
             title="Delete this area"
         )
-    def add_control_delete_event(self, event):
+    def add_control_delete_event(self, event_id):
         self.add_control(
             "nearby:delete-event",
-            url_for("api.eventitem", event=event),
+            url_for("api.eventitem", event_id=event_id),
             method="DELETE",
             title="Delete this event"
         )
@@ -94,10 +95,10 @@ class NearbyEventsBuilder(MasonBuilder):
             schema=Area.get_schema()
         )
         
-    def add_control_get_area(self, area):
+    def add_control_get_area(self, area_id):
         self.add_control(
             "nearby:area",
-            url_for("api.areaitem", area=area),
+            url_for("api.areaitem", area_id=area_id),
             method="GET",
             title="Add a new event"
         )
@@ -112,38 +113,38 @@ class NearbyEventsBuilder(MasonBuilder):
             schema=Event.get_schema()
         )
         
-    def add_control_events_by(self, area):
+    def add_control_events_by(self, area_id):
         self.add_control(
             "nearby:events-by",
-            url_for("api.eventsbyarea", area=area),
+            url_for("api.eventsbyarea", area_id=area_id),
             method="GET",
             title="Add a new event"
         )
 
-    def add_control_modify_area(self, area):
+    def add_control_modify_area(self, area_id):
         self.add_control(
             "nearby:edit-area",
-            url_for("api.areaitem", area=area),
+            url_for("api.areaitem", area_id=area_id),
             method="PUT",
             encoding="json",
             title="Edit this area",
             schema=Area.get_schema()
         )
     
-    def add_control_modify_event(self, event):
+    def add_control_modify_event(self, event_id):
         self.add_control(
             "nearby:edit-event",
-            url_for("api.eventitem", event=event),
+            url_for("api.eventitem", event_id=event_id),
             method="PUT",
             encoding="json",
             title="Edit this event",
             schema=Event.get_schema()
         )
 
-    def add_control_get_event(self, event):
+    def add_control_get_event(self, event_id):
         self.add_control(
             "items",
-            url_for("api.eventitem", event=event),
+            url_for("api.eventitem", event_id=event_id),
             method="GET",
             title="Get this event"
         )
@@ -169,6 +170,55 @@ class NearbyEventsBuilder(MasonBuilder):
         }
         return schema
 
+_validators = {}
+
+class ValidationError(Exception):
+    """
+    Raised by validate_json when a document does not match the schema. Lets
+    the resources handle invalid documents without importing jsonschema,
+    which is only loaded when the first document is validated.
+    """
+
+def get_validator(model):
+    """
+    Returns a jsonschema validator for the schema of the given model. The
+    schema is checked and compiled once per process instead of on every
+    request; validators built before forking are shared by the workers.
+    : param model: model class with a get_schema method
+    """
+
+    validator = _validators.get(model)
+    if validator is None:
+        from jsonschema.validators import validator_for
+        schema = model.get_schema()
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        validator = _validators[model] = cls(schema)
+    return validator
+
+def validate_json(document, model):
+    """
+    Validates a JSON document against the schema of the given model.
+    : param document: the parsed JSON document
+    : param model: model class with a get_schema method
+    : raises ValidationError: if the document is not valid
+    """
+
+    from jsonschema import ValidationError as SchemaValidationError
+    try:
+        with span("jsonschema.validate", model=model.__name__):
+            get_validator(model).validate(document)
+    except SchemaValidationError as e:
+        raise ValidationError(str(e))
+
+def dump_json(body):
+    """
+    Encodes a response body, recorded as a span of the request's trace.
+    """
+
+    with span("json.dumps"):
+        return json.dumps(body)
+
 def create_error_response(status_code, title, message=None):
     resource_url = request.path
     body = MasonBuilder(resource_url=resource_url)
@@ -144,7 +144,7 @@ class TestAreaCollection(object):
         valid = _get_area_json()
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 201
-        assert resp.headers["Location"].endswith(self.RESOURCE_URL + valid["name"] + "/")
+        assert resp.headers["Location"].endswith(self.RESOURCE_URL + "id/4/")
         resp = client.get(resp.headers["Location"])
         assert resp.status_code == 200
         body = json.loads(resp.data)
@@ -186,6 +186,10 @@ class TestAreaItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
         _check_control_get_method("collection", client, body)
+        assert body["capacity"] == 150
+        assert body["tickets_sold"] == 0
+        assert body["tickets_remaining"] == 150
+        assert body["revenue"] == 0
 
     def test_put_wrong_mediatype(self, client):
         valid = _get_area_json()
@@ -267,7 +271,7 @@ class TestEventCollection(object):
         valid["area_name"]=valid_area["name"]
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 201
-        assert resp.headers["Location"].endswith(self.RESOURCE_URL + valid["name"] + "/")
+        assert resp.headers["Location"].endswith(self.RESOURCE_URL + "id/4/")
         resp = client.get(resp.headers["Location"])
         assert resp.status_code == 200
         body = json.loads(resp.data)
@@ -289,6 +293,12 @@ class TestEventCollection(object):
         valid["name"] = "test-event-1"
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 409
+
+    def test_post_unknown_area(self, client):
+        valid = _get_event_json()
+        valid["area_name"] = "non-area-x"
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 400
         
 class TestEventItem(object):
 
@@ -302,6 +312,15 @@ class TestEventItem(object):
     RESOURCE_URL = "/api/events/test-event-1/"
     INVALID_URL = "/api/event/non-event-x/"
 
+    def test_get(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["max_tickets"] == 150
+        assert body["tickets_sold"] == 0
+        assert body["tickets_remaining"] == 150
+        assert body["revenue"] == 0
+
     def test_put_wrong_mediatype(self, client):
         valid = _get_event_json()
         resp = client.put(self.RESOURCE_URL, data="")
@@ -318,6 +337,22 @@ class TestEventItem(object):
         resp = client.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 204
         
+    def test_put_unknown_area(self, client):
+        valid = _get_event_json()
+        valid["area_name"] = "non-area-x"
+        resp = client.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 400
+
+    def test_put_renamed_area(self, client):
+        resp = client.put("/api/areas/test-area-3/", json={"name": "test-area-renamed"})
+        assert resp.status_code == 204
+        valid = _get_event_json()
+        resp = client.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 400
+        valid["area_name"] = "test-area-renamed"
+        resp = client.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 204
+
     def test_put_valid_request_duplicate(self, client):
         valid = _get_event_json()
         valid["name"] = "test-event-2"
@@ -364,4 +399,400 @@ class TestEventByArea(object):
             assert "name" in item
             _check_control_get_method("self", client, item)
         _check_control_get_method("self", client, body)
-               
\ No newline at end of file
+
+    def test_get_unknown_area(self, client):
+        resp = client.get("/api/areas/non-area-x/events/")
+        assert resp.status_code == 404
+        client.delete("/api/events/test-event-1/")
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+
+    def test_get_pages(self, client):
+        begin = datetime.datetime(2030, 1, 1)
+        for i in range(5):
+            valid = _get_event_json(i)
+            valid["area_name"] = "test-area-1"
+            # Two events at the same time, one without a known begin time
+            valid["event_begin"] = (begin + datetime.timedelta(days=min(i, 3))).isoformat()
+            if i == 4:
+                valid["event_begin"] = "soon"
+            assert client.post("/api/events/", json=valid).status_code == 201
+        names = []
+        url = self.RESOURCE_URL + "?limit=2&from=2000-01-01"
+        pages = 0
+        while url:
+            body = json.loads(client.get(url).data)
+            names.extend(item["name"] for item in body["items"])
+            url = body["@controls"].get("next", {}).get("href")
+            pages += 1
+        assert pages == 3
+        assert names == ["test-event-1"] + ["extra-event-{}".format(i) for i in range(4)]
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?limit=3").data)
+        assert body["items"][0]["name"] == "extra-event-4"
+        next_page = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert len(body["items"]) + len(next_page["items"]) == 6
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?from=2030-01-02&to=2030-01-04").data)
+        assert [item["name"] for item in body["items"]] == ["extra-event-1", "extra-event-2"]
+
+    def test_get_invalid_query(self, client):
+        for query in ["?limit=0", "?limit=x", "?from=someday", "?after=abc"]:
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 400
+               
+class TestCatalogueUpdates(object):
+
+    """
+    Tests that area and event changes are pushed to update stream subscribers and that slow subscribers
+    only lose buffered messages instead of blocking writers.
+    """
+
+    RESOURCE_URL = "/api/updates/"
+
+    def test_get_stream(self, client):
+        resp = client.get(self.RESOURCE_URL, buffered=False)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/event-stream"
+        chunks = iter(resp.response)
+        assert next(chunks).startswith(b"retry:")
+        broker = app.extensions["nearby_changes"]
+        assert broker.subscriber_count == 1
+        client.post("/api/areas/", json=_get_area_json())
+        chunk = next(chunks).decode()
+        assert chunk.startswith("event: area")
+        data = json.loads(chunk.split("data: ", 1)[1])
+        assert data["action"] == "created"
+        assert data["name"] == "extra-area-1"
+        client.post("/api/events/", json=_get_event_json())
+        data = json.loads(next(chunks).decode().split("data: ", 1)[1])
+        assert (data["type"], data["action"]) == ("event", "created")
+        assert data["area_name"] == "test-area-3"
+        client.put("/api/events/test-event-1/", json=dict(_get_event_json(), name="test-event-1", area_name="extra-area-1"))
+        # Skip the capacity updates of the areas
+        data = {"type": "area"}
+        while data["type"] == "area":
+            data = json.loads(next(chunks).decode().split("data: ", 1)[1])
+        assert data["name"] == "test-event-1"
+        assert data["area_name"] == "extra-area-1"
+        resp.close()
+        assert broker.subscriber_count == 0
+
+    def test_closed_before_stream(self, client):
+        broker = app.extensions["nearby_changes"]
+        with app.test_request_context(self.RESOURCE_URL):
+            resp = app.full_dispatch_request()
+            assert broker.subscriber_count == 1
+            resp.close()
+        assert broker.subscriber_count == 0
+
+    def test_publish_on_write(self, client):
+        broker = app.extensions["nearby_changes"]
+        subscription = broker.subscribe()
+        client.put("/api/areas/test-area-1/", json={"name": "test-area-renamed"})
+        client.delete("/api/events/test-event-2/")
+        client.post("/api/areas/", json={"name": "test-area-2"})
+        messages, dropped = subscription.drain()
+        assert dropped == 0
+        # The deleted event's capacity is taken off its area
+        assert [(m["type"], m["action"]) for m in messages] == [
+            ("area", "updated"), ("area", "updated"), ("event", "deleted")
+        ]
+        assert messages[0]["previous_name"] == "test-area-1"
+        assert messages[1]["name"] == "test-area-2"
+
+    def test_bounded_buffer(self, client):
+        broker = app.extensions["nearby_changes"]
+        subscription = broker.subscribe()
+        for i in range(broker.buffer_size + 5):
+            client.post("/api/areas/", json=_get_area_json(i))
+        messages, dropped = subscription.drain()
+        assert len(messages) == broker.buffer_size
+        assert dropped == 5
+        assert messages[-1]["name"] == "extra-area-{}".format(broker.buffer_size + 4)
+
+class TestIdempotencyKeys(object):
+
+    """
+    Tests that retried POSTs with the same Idempotency-Key get the original response replayed.
+    """
+
+    RESOURCE_URL = "/api/areas/"
+
+    def test_replay(self, client):
+        headers = {"Idempotency-Key": "retry-1"}
+        resp = client.post(self.RESOURCE_URL, json=_get_area_json(), headers=headers)
+        assert resp.status_code == 201
+        location = resp.headers["Location"]
+        resp = client.post(self.RESOURCE_URL, json=_get_area_json(), headers=headers)
+        assert resp.status_code == 201
+        assert resp.headers["Location"] == location
+        assert resp.headers["Idempotent-Replayed"] == "true"
+        # Not validated again
+        resp = client.post(self.RESOURCE_URL, data="", headers=headers)
+        assert resp.status_code == 201
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert len(body["items"]) == 4
+
+    def test_replay_event(self, client):
+        headers = {"Idempotency-Key": "retry-event"}
+        resp = client.post("/api/events/", json=_get_event_json(), headers=headers)
+        assert resp.status_code == 201
+        resp = client.post("/api/events/", json=_get_event_json(), headers=headers)
+        assert resp.status_code == 201
+        assert resp.headers["Location"].endswith("/api/events/id/4/")
+
+    def test_without_key(self, client):
+        resp = client.post(self.RESOURCE_URL, json=_get_area_json())
+        assert resp.status_code == 201
+        resp = client.post(self.RESOURCE_URL, json=_get_area_json())
+        assert resp.status_code == 409
+
+    def test_new_key_conflict(self, client):
+        resp = client.post(self.RESOURCE_URL, json=_get_area_json(), headers={"Idempotency-Key": "a"})
+        assert resp.status_code == 201
+        resp = client.post(self.RESOURCE_URL, json=_get_area_json(), headers={"Idempotency-Key": "b"})
+        assert resp.status_code == 409
+        resp = client.post(self.RESOURCE_URL, json=_get_area_json(), headers={"Idempotency-Key": ""})
+        assert resp.status_code == 400
+
+    def test_key_reused_elsewhere(self, client):
+        headers = {"Idempotency-Key": "retry-1"}
+        resp = client.post(self.RESOURCE_URL, json=_get_area_json(), headers=headers)
+        assert resp.status_code == 201
+        resp = client.post("/api/events/", json=_get_event_json(), headers=headers)
+        assert resp.status_code == 422
+
+    def test_expiry(self, client):
+        headers = {"Idempotency-Key": "retry-1"}
+        resp = client.post(self.RESOURCE_URL, json=_get_area_json(), headers=headers)
+        assert resp.status_code == 201
+        app.config["IDEMPOTENCY_TTL"] = 0
+        resp = client.post(self.RESOURCE_URL, json=_get_area_json(), headers=headers)
+        assert resp.status_code == 409
+        # The expired key can be used for a new area
+        resp = client.post(self.RESOURCE_URL, json=_get_area_json(2), headers=headers)
+        assert resp.status_code == 201
+        location = resp.headers["Location"]
+        app.config["IDEMPOTENCY_TTL"] = 60
+        resp = client.post(self.RESOURCE_URL, json=_get_area_json(2), headers=headers)
+        assert resp.headers["Location"] == location
+        assert resp.headers["Idempotent-Replayed"] == "true"
+
+    def test_purge(self, client):
+        from nearbyEvents.idempotency import purge_keys
+        from nearbyEvents.models import IdempotencyKey
+        app.config["IDEMPOTENCY_MAX_KEYS"] = 2
+        for i in range(4):
+            client.post(self.RESOURCE_URL, json=_get_area_json(i), headers={"Idempotency-Key": str(i)})
+        with app.app_context():
+            purge_keys()
+            db.session.commit()
+            assert [k.key for k in IdempotencyKey.query.all()] == ["2", "3"]
+
+class TestSalesStatistics(object):
+
+    """
+    Tests the statistics resource against values computed directly from the populated database.
+    """
+
+    RESOURCE_URL = "/api/stats/"
+
+    def _sell_tickets(self):
+        with app.app_context():
+            user = User(first_name="stats", last_name="test", birth_date=datetime.date(1990, 1, 1), email="stats@test")
+            for number, count, days in [(1, 3, 10), (2, 1, 0)]:
+                event = Event.query.filter_by(name="test-event-{}".format(number)).first()
+                event.ticket_price = 10 * number
+                reservation = Reservation(
+                    paid=number == 1,
+                    created_at=datetime.datetime.now() - datetime.timedelta(days=days)
+                )
+                reservation.for_event = event
+                reservation.user_booked = user
+                for i in range(count):
+                    reservation.tickets.append(Ticket(type="basic"))
+                db.session.add(reservation)
+            db.session.commit()
+
+    def test_get(self, client):
+        self._sell_tickets()
+        resp = client.get(self.RESOURCE_URL + "?bins=2&horizon=12")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_control_get_method("self", client, body)
+        assert body["tickets"] == {"sold": 4, "paid": 3}
+        assert body["prices"]["events"]["percentiles"]["50"] == 19
+        assert body["prices"]["tickets"]["mean"] == 12.5
+        assert body["price_histogram"]["counts"] == [3, 1]
+        areas = {area["area_name"]: area for area in body["areas"]}
+        assert areas["test-area-1"]["tickets_sold"] == 3
+        assert areas["test-area-1"]["revenue"] == 30
+        assert areas["test-area-2"]["price_percentiles"]["50"] == 20
+        curve = body["sell_through_curve"]
+        assert curve["capacity"] == 450
+        # Three tickets sold about 11 days ahead, one about a day ahead
+        assert curve["tickets_sold"][0] == 4
+        assert curve["tickets_sold"][2] == 3
+        assert curve["tickets_sold"][10] == 3
+        assert curve["tickets_sold"][12] == 0
+
+    def test_get_invalid(self, client):
+        for query in ["?bins=0", "?horizon=x", "?percentiles=50,101", "?percentiles=nan", "?percentiles=inf"]:
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 400
+
+    def test_grouped_percentiles(self, client):
+        import numpy as np
+        from nearbyEvents.analytics import grouped_percentiles
+        rng = np.random.RandomState(0)
+        groups = rng.randint(0, 5, 500)
+        values = rng.exponential(20, 500)
+        points, counts = grouped_percentiles(groups, values, 6, (0, 10, 50, 99, 100))
+        for group in range(5):
+            expected = np.percentile(values[groups == group], (0, 10, 50, 99, 100))
+            assert np.allclose(points[group], expected)
+        assert counts[5] == 0
+        assert np.isnan(points[5]).all()
+
+class TestAreaResolver(object):
+
+    """
+    Tests that area lookups are answered from the resolver's map and that the map follows area
+    changes made in this process and in other processes sharing the database.
+    """
+
+    def _count_queries(self):
+        statements = []
+        engine = db.get_engine(app)
+        event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        return statements
+
+    def test_resolve_without_queries(self, client):
+        from nearbyEvents.areas import get_area
+        with app.app_context():
+            resolver = app.extensions["nearby_areas"]
+            resolver.load()
+            statements = self._count_queries()
+            assert resolver.resolve("test-area-1") is not None
+            assert resolver.resolve("non-area-x") is None
+            assert get_area("non-area-x") is None
+            assert statements == []
+            assert get_area("test-area-1") is get_area("test-area-1")
+            assert len(statements) == 1
+
+    def test_invalidated_by_other_process(self, client):
+        other = nearbyEvents.create_app(dict(app.config))
+        with other.app_context():
+            assert other.extensions["nearby_areas"].exists("test-area-1")
+        resp = client.put("/api/areas/test-area-1/", json={"name": "test-area-renamed"})
+        assert resp.status_code == 204
+        with other.app_context():
+            resolver = other.extensions["nearby_areas"]
+            assert not resolver.exists("test-area-1")
+            assert resolver.exists("test-area-renamed")
+
+class TestNameFilters(object):
+
+    """
+    Tests that requests for unknown names are answered from the Bloom filters without queries and
+    that names created in this or another process are never reported missing.
+    """
+
+    def test_bloom_filter(self, client):
+        from nearbyEvents.bloom import BloomFilter
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add("event-{}".format(i))
+        assert all("event-{}".format(i) in bloom for i in range(1000))
+        false_positives = sum("other-{}".format(i) in bloom for i in range(10000))
+        assert false_positives < 300
+
+    def test_unknown_event_without_query(self, client):
+        with app.app_context():
+            app.extensions["nearby_names"]["event"].build()
+        statements = TestAreaResolver()._count_queries()
+        resp = client.get("/api/events/non-event-x/")
+        assert resp.status_code == 404
+        resp = client.delete("/api/events/non-event-x/")
+        assert resp.status_code == 404
+        assert statements == []
+
+    def test_created_names_found(self, client):
+        with app.app_context():
+            app.extensions["nearby_names"]["event"].build()
+        resp = client.post("/api/events/", json=_get_event_json())
+        assert resp.status_code == 201
+        resp = client.put("/api/events/test-event-1/", json=dict(_get_event_json(2), area_name="test-area-1"))
+        assert resp.status_code == 204
+        assert client.get("/api/events/extra-event-1/").status_code == 200
+        assert client.get("/api/events/extra-event-2/").status_code == 200
+        assert client.get("/api/events/test-event-1/").status_code == 404
+        # The filter stayed current, no rebuild was needed
+        name_filter = app.extensions["nearby_names"]["event"]
+        assert name_filter._seen == name_filter.epoch.current()
+
+    def test_created_by_other_process(self, client):
+        with app.app_context():
+            app.extensions["nearby_names"]["event"].build()
+        other = nearbyEvents.create_app(dict(app.config))
+        other.test_client().post("/api/events/", json=_get_event_json())
+        assert client.get("/api/events/extra-event-1/").status_code == 200
+
+    def test_other_writes_keep_filter(self, client):
+        name_filter = app.extensions["nearby_names"]["event"]
+        with app.app_context():
+            name_filter.build()
+        other = nearbyEvents.create_app(dict(app.config))
+        resp = other.test_client().put("/api/events/test-event-1/", json=dict(
+            _get_event_json(), name="test-event-1", status="Done"
+        ))
+        assert resp.status_code == 204
+        # Only new names make the other processes rebuild their filters
+        assert name_filter._seen == name_filter.epoch.current()
+
+class TestIdRoutes(object):
+
+    """
+    Tests that areas and events are addressed by id, that the name routes stay as aliases and that
+    renaming an area only updates the area row.
+    """
+
+    def test_aliases(self, client):
+        for by_id, by_name in [
+            ("/api/areas/id/1/", "/api/areas/test-area-1/"),
+            ("/api/events/id/2/", "/api/events/test-event-2/"),
+            ("/api/areas/id/1/events/", "/api/areas/test-area-1/events/"),
+        ]:
+            resp = client.get(by_id)
+            assert resp.status_code == 200
+            assert json.loads(resp.data) == json.loads(client.get(by_name).data)
+        body = json.loads(client.get("/api/events/id/2/").data)
+        assert body["id"] == 2
+        assert body["@controls"]["self"]["href"] == "/api/events/id/2/"
+        assert body["@controls"]["nearby:area"]["href"] == "/api/areas/id/2/"
+        for url in ["/api/areas/id/99/", "/api/events/id/99/", "/api/areas/id/99/events/"]:
+            assert client.get(url).status_code == 404
+
+    def test_modify_by_id(self, client):
+        resp = client.put("/api/events/id/1/", json=_get_event_json())
+        assert resp.status_code == 204
+        assert client.get("/api/events/extra-event-1/").status_code == 200
+        resp = client.delete("/api/areas/id/3/")
+        assert resp.status_code == 204
+        assert client.get("/api/areas/test-area-3/").status_code == 404
+        body = json.loads(client.get("/api/events/id/1/").data)
+        assert "nearby:area" not in body["@controls"]
+
+    def test_rename_area(self, client):
+        statements = TestAreaResolver()._count_queries()
+        resp = client.put("/api/areas/id/1/", json={"name": "test-area-renamed"})
+        assert resp.status_code == 204
+        updates = [statement for statement in statements if statement.startswith("UPDATE")]
+        assert len(updates) == 1
+        assert updates[0].startswith("UPDATE area")
+        body = json.loads(client.get("/api/areas/test-area-renamed/events/").data)
+        assert [item["name"] for item in body["items"]] == ["test-event-1"]
+        assert body["items"][0]["area_name"] == "test-area-renamed"
+        assert client.get("/api/areas/test-area-1/").status_code == 404
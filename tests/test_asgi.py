@@ -0,0 +1,177 @@
+import os
+import sys
+import pytest
+import tempfile
+import json
+import asyncio
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents.models
+from nearbyEvents import db
+from nearbyEvents.asgi import create_asgi_app
+from test_api import _populate_db, _get_area_json
+
+@pytest.fixture
+def asgi_app():
+    db_fd, db_fname = tempfile.mkstemp()
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False
+    }
+    asgi_app = create_asgi_app(config)
+    with asgi_app.flask_app.app_context():
+        nearbyEvents.models.db.create_all()
+        _populate_db()
+
+    yield asgi_app
+
+    asgi_app.shutdown()
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+def _scope(method, path, headers=()):
+    path, _, query = path.partition("?")
+    return {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "root_path": "",
+        "query_string": query.encode(),
+        "headers": [(k.encode(), v.encode()) for k, v in headers],
+        "server": ("testserver", 80),
+        "client": ("127.0.0.1", 5000),
+    }
+
+async def _call(asgi_app, method, path, body=b"", headers=()):
+    messages = []
+    incoming = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if incoming:
+            return incoming.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app(_scope(method, path, headers), receive, send)
+    status = messages[0]["status"]
+    headers = dict(messages[0]["headers"])
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return status, headers, body
+
+def _request(asgi_app, method, path, body=b"", headers=()):
+    return asyncio.run(_call(asgi_app, method, path, body, headers))
+
+class TestAsgiReadPaths(object):
+
+    """
+    Tests that the natively served read paths answer exactly like the WSGI app does.
+    """
+
+    URLS = [
+        "/api/areas/",
+        "/api/areas/test-area-1/",
+        "/api/areas/non-area-x/",
+        "/api/events/",
+        "/api/events/test-event-1/",
+        "/api/events/non-event-x/",
+        "/api/areas/test-area-1/events/",
+        "/api/areas/test-area-1/events/?limit=1&from=2000-01-01",
+        "/api/areas/test-area-1/events/?limit=0",
+        "/api/areas/non-area-x/events/",
+        "/api/areas/id/1/",
+        "/api/areas/id/99/",
+        "/api/events/id/1/",
+        "/api/events/id/99/",
+        "/api/areas/id/1/events/",
+        "/api/areas/id/99/events/",
+    ]
+
+    def test_same_as_wsgi(self, asgi_app):
+        client = asgi_app.flask_app.test_client()
+        for url in self.URLS:
+            status, headers, body = _request(asgi_app, "GET", url)
+            resp = client.get(url)
+            assert status == resp.status_code
+            assert headers[b"content-type"].decode() == resp.headers["Content-Type"]
+            assert json.loads(body) == json.loads(resp.data)
+
+    def test_head(self, asgi_app):
+        status, headers, body = _request(asgi_app, "HEAD", "/api/areas/")
+        assert status == 200
+        assert body == b""
+
+    def test_first_request_functions(self, asgi_app):
+        calls = []
+        asgi_app.flask_app.before_first_request(lambda: calls.append(True))
+        status, headers, body = _request(asgi_app, "GET", "/api/areas/")
+        assert status == 200
+        assert calls == [True]
+        _request(asgi_app, "GET", "/api/areas/")
+        _request(asgi_app, "POST", "/api/areas/", json.dumps(_get_area_json()).encode(),
+            [("content-type", "application/json")]
+        )
+        assert calls == [True]
+
+class TestAsgiWsgiFallback(object):
+
+    """
+    Tests that writes are passed to the Flask app.
+    """
+
+    def test_post(self, asgi_app):
+        status, headers, body = _request(asgi_app, "POST", "/api/areas/",
+            json.dumps(_get_area_json()).encode(),
+            [("content-type", "application/json")]
+        )
+        assert status == 201
+        assert headers[b"location"].endswith(b"/api/areas/id/4/")
+        status, headers, body = _request(asgi_app, "GET", "/api/areas/extra-area-1/")
+        assert status == 200
+        assert json.loads(body)["name"] == "extra-area-1"
+
+class TestAsgiUpdates(object):
+
+    """
+    Tests that the update stream is served on the event loop and ends when the client disconnects.
+    """
+
+    def test_stream(self, asgi_app):
+        async def scenario():
+            chunks = []
+            received = asyncio.Event()
+            disconnect = asyncio.Event()
+
+            async def receive():
+                await disconnect.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                chunks.append(message)
+                if b"event: area" in message.get("body", b""):
+                    received.set()
+
+            stream = asyncio.ensure_future(
+                asgi_app(_scope("GET", "/api/updates/"), receive, send)
+            )
+            await asyncio.sleep(0.05)
+            status, headers, body = await _call(asgi_app, "POST", "/api/areas/",
+                json.dumps(_get_area_json()).encode(),
+                [("content-type", "application/json")]
+            )
+            assert status == 201
+            await asyncio.wait_for(received.wait(), 5)
+            disconnect.set()
+            await asyncio.wait_for(stream, 5)
+            return chunks
+
+        chunks = asyncio.run(scenario())
+        assert chunks[0]["status"] == 200
+        assert dict(chunks[0]["headers"])[b"content-type"] == b"text/event-stream"
+        assert asgi_app.flask_app.extensions["nearby_changes"].subscriber_count == 0
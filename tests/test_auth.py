@@ -0,0 +1,90 @@
+import hashlib
+import os
+import sys
+import time
+import jwt
+import pytest
+import tempfile
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents import db
+from test_api import _populate_db, _get_area_json
+
+@pytest.fixture
+def app():
+    db_fd, db_fname = tempfile.mkstemp()
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "JWT_REQUIRED": True,
+        "JWT_KEYS": {"default": "first-secret", "2021": "second-secret"},
+        "JWT_CACHE_SIZE": 2
+    })
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+
+    yield app
+
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+def _token(secret="first-secret", kid=None, **claims):
+    headers = {"kid": kid} if kid else None
+    return jwt.encode(dict({"sub": "admin"}, **claims), secret, headers=headers).decode()
+
+def _auth(token):
+    return {"Authorization": "Bearer " + token}
+
+def test_writes_need_token(app):
+    client = app.test_client()
+    assert client.get("/api/areas/test-area-1/").status_code == 200
+    resp = client.post("/api/areas/", json=_get_area_json())
+    assert resp.status_code == 401
+    assert resp.headers["WWW-Authenticate"] == "Bearer"
+    resp = client.post("/api/areas/", json=_get_area_json(), headers=_auth(_token("wrong")))
+    assert resp.status_code == 401
+    resp = client.post("/api/areas/", json=_get_area_json(), headers=_auth(_token()))
+    assert resp.status_code == 201
+    resp = client.put("/api/areas/extra-area-1/", json={"name": "renamed"},
+        headers=_auth(_token("second-secret", kid="2021"))
+    )
+    assert resp.status_code == 204
+    resp = client.delete("/api/areas/renamed/", headers=_auth(_token(kid="unknown")))
+    assert resp.status_code == 401
+
+def test_verified_tokens_are_cached(app, monkeypatch):
+    verifier = app.extensions["nearby_jwt"]
+    calls = []
+    decode = jwt.decode
+    monkeypatch.setattr(jwt, "decode", lambda *args, **kwargs: calls.append(1) or decode(*args, **kwargs))
+    token = _token(exp=int(time.time()) + 60)
+    client = app.test_client()
+    for i in range(3):
+        resp = client.post("/api/areas/", json=_get_area_json(i), headers=_auth(token))
+        assert resp.status_code == 201
+    assert len(calls) == 1
+    assert verifier.cache.hits == 2
+    # Expired tokens are rejected even when cached
+    digest = hashlib.sha256(token.encode()).digest()
+    assert verifier.cache.get(digest, time.time()) is not None
+    assert verifier.cache.get(digest, time.time() + 120) is None
+    assert verifier.cache.get(digest, time.time()) is None
+
+def test_cache_is_bounded(app):
+    verifier = app.extensions["nearby_jwt"]
+    for i in range(5):
+        verifier.verify(_token(n=i))
+    assert len(verifier.cache._claims) == 2
+
+def test_no_keys(app):
+    config = dict(app.config, JWT_KEYS=None, SECRET_KEY="password")
+    app = nearbyEvents.create_app(config)
+    client = app.test_client()
+    admin = _auth(_token("password", admin=True))
+    assert client.get("/admin/metrics/", headers=admin).status_code == 404
+    assert client.post("/api/areas/", json=_get_area_json(), headers=admin).status_code == 401
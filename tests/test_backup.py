@@ -0,0 +1,86 @@
+import gzip
+import os
+import shutil
+import sys
+import jwt
+import pytest
+import tempfile
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents import db
+from nearbyEvents.backup import BackupError, get_store, restore, snapshot
+from nearbyEvents.models import Area
+from test_api import _populate_db
+
+@pytest.fixture
+def app():
+    db_fd, db_fname = tempfile.mkstemp()
+    backup_dir = tempfile.mkdtemp()
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "JWT_KEYS": {"default": "secret"},
+        "BACKUP_DIR": backup_dir,
+        "BACKUP_KEEP": 2,
+        "BACKUP_STEP_PAGES": 1
+    })
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+
+    yield app
+
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+    shutil.rmtree(backup_dir)
+
+def _admin(admin=True):
+    return {"Authorization": "Bearer " + jwt.encode({"admin": admin}, "secret").decode()}
+
+def test_snapshot_and_restore(app):
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["backupDatabase"])
+    assert result.exit_code == 0, result.output
+    store = get_store(app)
+    name = store.names()[0]
+    with gzip.open(store.path(name)) as f:
+        assert f.read(16) == b"SQLite format 3\x00"
+
+    client = app.test_client()
+    assert client.delete("/api/areas/test-area-1/").status_code == 204
+    assert client.get("/api/areas/test-area-1/").status_code == 404
+    result = runner.invoke(args=["restoreDatabase", name])
+    assert result.exit_code == 0, result.output
+    assert client.get("/api/areas/test-area-1/").status_code == 200
+    with app.app_context():
+        assert Area.query.count() == 3
+
+def test_corrupt_snapshot(app):
+    with app.app_context():
+        name = snapshot(app)["name"]
+        store = get_store(app)
+        with open(store.path(name), "r+b") as f:
+            f.seek(40)
+            f.write(b"\xff\xff\xff\xff")
+        with pytest.raises(BackupError):
+            restore(app, name)
+        with pytest.raises(BackupError):
+            restore(app, "../development.db")
+        assert Area.query.count() == 3
+
+def test_admin_backups(app):
+    client = app.test_client()
+    assert client.post("/admin/backups/").status_code == 401
+    assert client.post("/admin/backups/", headers=_admin(False)).status_code == 403
+    names = []
+    for i in range(3):
+        resp = client.post("/admin/backups/", headers=_admin())
+        assert resp.status_code == 201
+        names.append(resp.get_json()["name"])
+    body = client.get("/admin/backups/", headers=_admin()).get_json()
+    assert [backup["name"] for backup in body["backups"]] == sorted(names, reverse=True)[:2]
+    assert len(body["backups"][0]["sha256"]) == 64
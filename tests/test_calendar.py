@@ -0,0 +1,105 @@
+import datetime
+import os
+import sys
+import pytest
+import tempfile
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents import db
+from nearbyEvents.models import Area, Event, Reservation, Ticket, User
+from nearbyEvents.sweeper import sweep_expired_reservations
+from test_api import _populate_db, _get_event_json
+
+@pytest.fixture
+def app():
+    db_fd, db_fname = tempfile.mkstemp()
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False
+    })
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+        area = Area.query.filter_by(name="test-area-1").one()
+        for i, begin in enumerate(["2020.03.05", "2020.03.05", "2020.03.20", "2020.04.01"]):
+            db.session.add(Event(name="past-event-{}".format(i), max_tickets=10 + i, ticket_price=5,
+                status="Done", event_begin=begin, area_id=area.id, tickets_sold=i
+            ))
+        db.session.commit()
+
+    yield app
+
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+def test_calendar(app):
+    client = app.test_client()
+    body = client.get("/api/areas/test-area-1/calendar/?month=2020-03").get_json()
+    assert body["month"] == "2020-03"
+    assert body["days"] == [
+        {"date": "2020-03-05", "events": 2, "tickets_remaining": 20},
+        {"date": "2020-03-20", "events": 1, "tickets_remaining": 10},
+    ]
+    assert body["@controls"]["next"]["href"] == "/api/areas/id/{}/calendar/?month=2020-04".format(body["area_id"])
+    assert body["@controls"]["prev"]["href"].endswith("month=2020-02")
+
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    body = client.get("/api/areas/id/{}/calendar/?month={}".format(
+        body["area_id"], tomorrow.strftime("%Y-%m")
+    )).get_json()
+    assert body["days"] == [{"date": tomorrow.isoformat(), "events": 1, "tickets_remaining": 150}]
+
+    assert client.get("/api/areas/test-area-1/calendar/?month=2020-13").status_code == 400
+    assert client.get("/api/areas/test-area-1/calendar/?month=0001-01").status_code == 400
+    assert client.get("/api/areas/test-area-1/calendar/?month=9999-12").status_code == 400
+    assert client.get("/api/areas/no-area/calendar/").status_code == 404
+    assert client.get("/api/areas/id/999/calendar/").status_code == 404
+
+def test_calendar_invalidation(app):
+    client = app.test_client()
+    url = "/api/areas/test-area-1/calendar/?month=2020-03"
+    assert len(client.get(url).get_json()["days"]) == 2
+    with app.app_context():
+        # Not announced, so the cached month is served
+        db.session.execute(Event.__table__.delete().where(Event.name == "past-event-2"))
+        db.session.commit()
+    assert len(client.get(url).get_json()["days"]) == 2
+
+    # A change in another month keeps the entry
+    valid = _get_event_json()
+    valid["area_name"] = "test-area-1"
+    valid["event_begin"] = "2020.04.02"
+    assert client.post("/api/events/", json=valid).status_code == 201
+    assert len(client.get(url).get_json()["days"]) == 2
+
+    # Moving an event into the month drops it
+    valid["event_begin"] = "2020.03.09"
+    assert client.put("/api/events/{}/".format(valid["name"]), json=valid).status_code == 204
+    days = client.get(url).get_json()["days"]
+    assert [day["date"] for day in days] == ["2020-03-05", "2020-03-09"]
+
+    # And moving it out of the month again too
+    valid["event_begin"] = "2020.04.02"
+    assert client.put("/api/events/{}/".format(valid["name"]), json=valid).status_code == 204
+    assert [day["date"] for day in client.get(url).get_json()["days"]] == ["2020-03-05"]
+
+def test_calendar_sale_invalidation(app):
+    client = app.test_client()
+    url = "/api/areas/test-area-1/calendar/?month=2020-03"
+    assert client.get(url).get_json()["days"][1]["tickets_remaining"] == 10
+    with app.app_context():
+        reservation = Reservation(paid=False, created_at=datetime.datetime.now() - datetime.timedelta(days=1))
+        reservation.for_event = Event.query.filter_by(name="past-event-2").one()
+        reservation.user_booked = User(first_name="a", last_name="b", birth_date=datetime.date(1990, 1, 1), email="a@b")
+        reservation.tickets.append(Ticket(type="basic"))
+        db.session.add(reservation)
+        db.session.commit()
+    assert client.get(url).get_json()["days"][1]["tickets_remaining"] == 9
+
+    with app.app_context():
+        assert sweep_expired_reservations(ttl=60).reservations == 1
+    assert client.get(url).get_json()["days"][1]["tickets_remaining"] == 10
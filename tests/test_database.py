@@ -12,6 +12,7 @@ import nearbyEvents.models
 from nearbyEvents import app
 from nearbyEvents.models import User, Event, Area, Country, Reservation, Ticket
 import datetime
+import time
 
 @pytest.fixture
 def db_handle():
@@ -556,4 +557,151 @@ def test_ticket_onmodify_area(db_handle):
         assert db_event.event_manager == db_user_updated.id
         assert db_user_updated == db_event.is_managed_by
         assert db_reservation.user_booked == db_user_2
-        assert db_reservation.for_event == db_event_2
\ No newline at end of file
+        assert db_reservation.for_event == db_event_2
+
+def test_sweep_expired_reservations(db_handle):
+    """
+    Tests that only unpaid reservations older than the hold time are deleted
+    by the sweeper, together with their tickets, in batches.
+    """
+    from nearbyEvents.sweeper import sweep_expired_reservations
+    with app.app_context():
+        event = _get_Event()
+        area = _get_Area()
+        area.in_country = _get_Country()
+        event.in_area = area
+        user = _get_user()
+        old = datetime.datetime.now() - datetime.timedelta(hours=1)
+        for paid, created_at in [(False, old), (False, old), (False, old), (True, old), (False, datetime.datetime.now())]:
+            reservation = Reservation(paid=paid, created_at=created_at)
+            reservation.for_event = event
+            reservation.user_booked = user
+            for i in range(2):
+                ticket = _get_Ticket()
+                ticket.in_reservation = reservation
+            db_handle.session.add(reservation)
+        db_handle.session.commit()
+
+        result = sweep_expired_reservations(ttl=60, batch_size=2, pause=0)
+        assert result.reservations == 3
+        assert result.tickets == 6
+        assert result.batches == 2
+        assert Reservation.query.count() == 2
+        assert Ticket.query.count() == 4
+        assert Reservation.query.filter_by(paid=False).one().created_at > old
+        metrics = app.extensions["nearby_sweeper"].as_dict()
+        assert metrics["runs"] == 1
+        assert metrics["reservations_expired"] == 3
+
+        result = sweep_expired_reservations(ttl=60)
+        assert result.reservations == 0
+
+def test_sales_aggregates(db_handle):
+    """
+    Tests that the ticket sales counters of events and areas follow tickets
+    being sold and released, events moving between areas and events being
+    deleted, and that refresh_aggregates recomputes the same values.
+    """
+    from nearbyEvents.aggregates import refresh_aggregates
+    with app.app_context():
+        country = _get_Country()
+        area = _get_Area()
+        other = Area(name="Oulu - Linnanmaa")
+        area.in_country = country
+        other.in_country = country
+        event = _get_Event()
+        event.in_area = area
+        user = _get_user()
+        reservation = Reservation(paid=False, created_at=datetime.datetime.now())
+        reservation.for_event = event
+        reservation.user_booked = user
+        for i in range(3):
+            _get_Ticket().in_reservation = reservation
+        db_handle.session.add(reservation)
+        db_handle.session.add(other)
+        db_handle.session.commit()
+
+        assert (event.tickets_sold, event.revenue) == (3, 57)
+        assert (area.capacity, area.tickets_sold, area.revenue) == (150, 3, 57)
+
+        # Price changes only affect tickets sold afterwards
+        event.ticket_price = 10
+        db_handle.session.delete(reservation.tickets[0])
+        _get_Ticket().in_reservation = reservation
+        db_handle.session.commit()
+        assert (event.tickets_sold, event.revenue) == (3, 48)
+        assert (area.tickets_sold, area.revenue) == (3, 48)
+
+        event.in_area = other
+        event.max_tickets = 100
+        db_handle.session.commit()
+        assert (area.capacity, area.tickets_sold, area.revenue) == (0, 0, 0)
+        assert (other.capacity, other.tickets_sold, other.revenue) == (100, 3, 48)
+
+        Event.query.update({"tickets_sold": 0})
+        db_handle.session.commit()
+        refresh_aggregates()
+        assert (event.tickets_sold, event.revenue) == (3, 48)
+        assert (other.capacity, other.tickets_sold, other.revenue) == (100, 3, 48)
+
+        db_handle.session.delete(event)
+        db_handle.session.commit()
+        assert (other.capacity, other.tickets_sold, other.revenue) == (0, 0, 0)
+
+def test_sweep_releases_aggregates(db_handle):
+    """
+    Tests that tickets released by the reservation sweeper are subtracted
+    from the sales counters.
+    """
+    from nearbyEvents.sweeper import sweep_expired_reservations
+    with app.app_context():
+        area = _get_Area()
+        area.in_country = _get_Country()
+        event = _get_Event()
+        event.in_area = area
+        user = _get_user()
+        old = datetime.datetime.now() - datetime.timedelta(hours=1)
+        for paid in [False, True]:
+            reservation = Reservation(paid=paid, created_at=old)
+            reservation.for_event = event
+            reservation.user_booked = user
+            _get_Ticket().in_reservation = reservation
+            _get_Ticket().in_reservation = reservation
+            db_handle.session.add(reservation)
+        db_handle.session.commit()
+        assert area.tickets_sold == 4
+
+        sweep_expired_reservations(ttl=60)
+        db_handle.session.expire_all()
+        assert (event.tickets_sold, event.revenue) == (2, 38)
+        assert (area.tickets_sold, area.revenue) == (2, 38)
+
+def test_single_sweeper(db_handle):
+    """
+    Tests that of the sweepers sharing a lock file only the one holding it
+    sweeps, and that another takes over once it is released.
+    """
+    from nearbyEvents.sweeper import ReservationSweeper, SweeperLock
+    lock_fd, lock_fname = tempfile.mkstemp()
+    holder = SweeperLock(lock_fname)
+    assert holder.acquire()
+    assert not SweeperLock(lock_fname).acquire()
+
+    sweeper = ReservationSweeper(app, 0.01, SweeperLock(lock_fname))
+    sweeper.start()
+    try:
+        time.sleep(0.2)
+        assert app.extensions["nearby_sweeper"].as_dict()["runs"] == 0
+        holder.release()
+        deadline = time.time() + 5
+        while not app.extensions["nearby_sweeper"].as_dict()["runs"] and time.time() < deadline:
+            time.sleep(0.01)
+        assert app.extensions["nearby_sweeper"].as_dict()["runs"] > 0
+        assert not holder.acquire()
+    finally:
+        sweeper.stop()
+        sweeper.join()
+    assert holder.acquire()
+    holder.release()
+    os.close(lock_fd)
+    os.unlink(lock_fname)
@@ -0,0 +1,85 @@
+import os
+import sys
+import pytest
+import tempfile
+import threading
+from concurrent.futures import Future
+from functools import partial
+from sqlalchemy.exc import IntegrityError
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents import db
+from nearbyEvents.models import Area, Event
+from nearbyEvents.resources.area import update_area
+from test_api import _populate_db, _get_event_json
+
+@pytest.fixture
+def app():
+    db_fd, db_fname = tempfile.mkstemp()
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "GROUP_COMMIT": True,
+        "GROUP_COMMIT_WINDOW": 0.2
+    })
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+
+    yield app
+
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+def test_concurrent_puts_share_commits(app):
+    client = app.test_client()
+    for i in range(10):
+        assert client.post("/api/events/", json=_get_event_json(i)).status_code == 201
+    statuses = {}
+
+    def cancel(i):
+        document = dict(_get_event_json(i), status="Cancelled-{}".format(i))
+        statuses[i] = app.test_client().put("/api/events/extra-event-{}/".format(i), json=document).status_code
+
+    threads = [threading.Thread(target=cancel, args=(i,)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert set(statuses.values()) == {204}
+    metrics = app.extensions["nearby_group_commit"].metrics.as_dict()
+    assert metrics["units"] == 10
+    assert metrics["batches"] < 10
+    with app.app_context():
+        assert Event.query.filter(Event.status.like("Cancelled-%")).count() == 10
+
+def test_conflict_in_batch(app):
+    committer = app.extensions["nearby_group_commit"]
+    batch = [
+        (partial(update_area, 1, "renamed"), Future()),
+        (partial(update_area, 2, "renamed"), Future()),
+        (partial(update_area, 3, "other"), Future()),
+        (partial(update_area, 99, "missing"), Future()),
+    ]
+    with app.app_context():
+        committer.commit_batch(batch)
+        db.session.remove()
+        assert batch[0][1].result() is True
+        with pytest.raises(IntegrityError):
+            batch[1][1].result()
+        assert batch[2][1].result() is True
+        assert batch[3][1].result() is False
+        assert sorted(area.name for area in Area.query) == ["other", "renamed", "test-area-2"]
+    assert committer.metrics.fallbacks == 1
+
+def test_put_outcomes(app):
+    client = app.test_client()
+    resp = client.put("/api/areas/test-area-1/", json={"name": "test-area-2"})
+    assert resp.status_code == 409
+    resp = client.put("/api/areas/test-area-1/", json={"name": "test-area-renamed"})
+    assert resp.status_code == 204
+    assert client.get("/api/areas/test-area-renamed/").status_code == 200
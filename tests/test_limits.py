@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+import sys
+import pytest
+import tempfile
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents import db
+from nearbyEvents.limits import TokenBuckets
+from test_api import _populate_db, _get_area_json
+
+@pytest.fixture
+def app():
+    db_fd, db_fname = tempfile.mkstemp()
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "RATE_LIMIT": True,
+        "RATE_LIMITS": {"scan": (0.5, 3), "api.areaitem": (0.5, 2)},
+        "SHED_MAX_INFLIGHT": 1
+    })
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+
+    yield app
+
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+def test_rate_limit(app):
+    client = app.test_client()
+    for i in range(3):
+        assert client.get("/api/areas/").status_code == 200
+    resp = client.get("/api/areas/")
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == "2"
+    # Buckets are per route and per client
+    assert client.get("/api/events/").status_code == 200
+    other = app.test_client()
+    resp = other.get("/api/areas/", environ_base={"REMOTE_ADDR": "10.0.0.2"})
+    assert resp.status_code == 200
+    for i in range(2):
+        assert client.get("/api/areas/test-area-1/").status_code == 200
+    assert client.get("/api/areas/test-area-1/").status_code == 429
+    assert app.extensions["nearby_limiter"].monitor.limited == 2
+
+def _drain(buckets):
+    buckets.take("client|route", 0.001, 2)
+    buckets.take("client|route", 0.001, 2)
+
+def test_buckets_shared_with_forked_workers():
+    buckets = TokenBuckets(16)
+    worker = multiprocessing.get_context("fork").Process(target=_drain, args=(buckets,))
+    worker.start()
+    worker.join()
+    assert buckets.take("client|route", 0.001, 2) > 0
+    assert buckets.take("other|route", 0.001, 2) == 0
+
+def test_load_shedding(app):
+    client = app.test_client()
+    monitor = app.extensions["nearby_limiter"].monitor
+    monitor.enter()
+    resp = client.get("/api/events/")
+    assert resp.status_code == 503
+    assert "Retry-After" in resp.headers
+    assert client.get("/api/events/test-event-1/").status_code == 200
+    monitor.enter()
+    assert client.get("/api/events/test-event-1/").status_code == 503
+    assert client.post("/api/areas/", json=_get_area_json()).status_code == 201
+    monitor.leave()
+    monitor.leave()
+    assert client.get("/api/events/").status_code == 200
+    assert monitor.inflight == 0
+    assert monitor.shed == 2
+
+def test_load_shedding_recovers(app):
+    client = app.test_client()
+    limiter = app.extensions["nearby_limiter"]
+    limiter.max_latency = 0.01
+    limiter.monitor.record_query(1.0)
+    assert client.get("/api/events/test-event-1/").status_code == 503
+    # No queries run while shedding, the average decays with time instead
+    limiter.monitor.sampled -= 10
+    assert client.get("/api/events/test-event-1/").status_code == 200
+    assert limiter.monitor.current_latency() < limiter.max_latency
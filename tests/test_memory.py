@@ -0,0 +1,89 @@
+import gc
+import os
+import sys
+import pytest
+import tempfile
+import tracemalloc
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents import db
+from nearbyEvents.models import Area, Country, Event
+from nearbyEvents.resources.area import AreaCollection
+from nearbyEvents.resources.event import EventCollection
+from nearbyEvents.utils import NearbyEventsBuilder
+
+AREAS = 100
+EVENTS_PER_AREA = 40
+# Regression limits: peak allocation of a request as a multiple of its
+# response size, and memory retained over REQUESTS requests
+MAX_RATIO = {"/api/events/": 12, "/api/areas/": 25}
+MAX_GROWTH = 64 * 1024
+REQUESTS = 5
+
+@pytest.fixture(scope="module")
+def app():
+    db_fd, db_fname = tempfile.mkstemp()
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False
+    })
+    with app.app_context():
+        db.create_all()
+        db.session.add(Country(country="Finland", currency="EUR"))
+        db.session.flush()
+        db.session.execute(Area.__table__.insert(), [
+            {"name": "area-{}".format(i)} for i in range(AREAS)
+        ])
+        db.session.execute(Event.__table__.insert(), [
+            {"name": "event-{}-{}".format(i, j), "max_tickets": 100, "ticket_price": 10,
+             "status": "On sale", "area_id": i + 1, "tickets_sold": 0, "revenue": 0}
+            for i in range(AREAS) for j in range(EVENTS_PER_AREA)
+        ])
+        db.session.commit()
+        db.session.remove()
+
+    yield app
+
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+def _live(cls):
+    gc.collect()
+    return sum(1 for obj in gc.get_objects() if type(obj) is cls)
+
+@pytest.mark.parametrize("path", ["/api/events/", "/api/areas/"])
+def test_collection_memory(app, path):
+    client = app.test_client()
+    size = len(client.get(path).data)
+    builders = _live(NearbyEventsBuilder)
+    tracemalloc.start()
+    try:
+        gc.collect()
+        baseline, _ = tracemalloc.get_traced_memory()
+        for i in range(REQUESTS):
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+            resp = client.get(path)
+            assert resp.status_code == 200
+            resp.close()
+            del resp
+            current, peak = tracemalloc.get_traced_memory()
+            assert (peak - start) / size < MAX_RATIO[path]
+        gc.collect()
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert retained - baseline < MAX_GROWTH
+    assert _live(NearbyEventsBuilder) == builders
+
+@pytest.mark.parametrize("resource", [AreaCollection, EventCollection])
+def test_collections_skip_identity_map(app, resource):
+    with app.test_request_context("/"):
+        resource().get()
+        assert len(db.session.identity_map) == 0
+        db.session.remove()
+    assert _live(Event) == 0
+    assert _live(Area) == 0
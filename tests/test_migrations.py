@@ -0,0 +1,105 @@
+import datetime
+import os
+import sqlite3
+import sys
+import pytest
+import tempfile
+from sqlalchemy import inspect
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents import db
+from nearbyEvents.migrations import MIGRATIONS, current_version, migrate
+from nearbyEvents.models import Area, Event, Ticket
+
+# Tables as created before the typed begin time, area ids, ticket prices
+# and aggregates
+OLD_SCHEMA = """
+CREATE TABLE country (country VARCHAR(32) PRIMARY KEY, timezone DATETIME, currency VARCHAR(3));
+CREATE TABLE user (id INTEGER PRIMARY KEY, first_name VARCHAR(32) NOT NULL, last_name VARCHAR(32) NOT NULL,
+    birth_date DATE NOT NULL, email VARCHAR(64) NOT NULL UNIQUE, nationality VARCHAR(32) REFERENCES country (country));
+CREATE TABLE area (id INTEGER PRIMARY KEY, name VARCHAR(64) NOT NULL UNIQUE,
+    country VARCHAR(32) NOT NULL REFERENCES country (country));
+CREATE TABLE event (id INTEGER PRIMARY KEY, name VARCHAR(64) NOT NULL UNIQUE, max_tickets INTEGER NOT NULL,
+    ticket_price FLOAT, status VARCHAR(16) NOT NULL, event_begin VARCHAR(64), event_manager INTEGER REFERENCES user (id),
+    area_name VARCHAR(64) REFERENCES area (name) ON DELETE SET NULL ON UPDATE CASCADE);
+CREATE TABLE reservation (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES user (id),
+    event_id INTEGER NOT NULL REFERENCES event (id), paid BOOLEAN NOT NULL, created_at DATETIME NOT NULL);
+CREATE TABLE ticket (id INTEGER PRIMARY KEY, reservation_id INTEGER NOT NULL REFERENCES reservation (id),
+    type VARCHAR(16));
+INSERT INTO country VALUES ('Finland', NULL, 'EUR');
+INSERT INTO user VALUES (1, 'user', 'test', '2000-01-01', 'user.test@gmail.com', 'Finland');
+"""
+EVENTS = 25
+
+@pytest.fixture
+def app():
+    db_fd, db_fname = tempfile.mkstemp()
+    conn = sqlite3.connect(db_fname)
+    conn.executescript(OLD_SCHEMA)
+    conn.executemany("INSERT INTO area (name, country) VALUES (?, 'Finland')", [("area-1",), ("area-2",)])
+    conn.executemany(
+        "INSERT INTO event (name, max_tickets, ticket_price, status, event_begin, area_name) VALUES (?, 10, 5, 'On sale', ?, ?)",
+        [("event-{}".format(i), "2021.06.{:02}".format(i + 1) if i else "soon", "area-{}".format(i % 2 + 1))
+         for i in range(EVENTS)]
+    )
+    conn.execute("INSERT INTO reservation VALUES (1, 1, 2, 1, '2021-05-01 00:00:00')")
+    conn.executemany("INSERT INTO ticket (reservation_id, type) VALUES (1, ?)", [("adult",)] * 3)
+    conn.commit()
+    conn.close()
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "MIGRATION_CHUNK_SIZE": 4,
+        "MIGRATION_CHUNK_SLEEP": 0
+    })
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+def test_migrate_old_database(app):
+    progress = []
+    with app.app_context():
+        applied = migrate(progress=lambda migration, done, total: progress.append((migration.version, done, total)))
+        assert [m.version for m in applied] == [m.version for m in MIGRATIONS]
+        assert current_version() == MIGRATIONS[-1].version
+        # Backfills run in chunks of MIGRATION_CHUNK_SIZE
+        assert [p for p in progress if p[0] == 2][-1] == (2, EVENTS, EVENTS)
+        assert len([p for p in progress if p[0] == 2]) == 7
+
+        event = Event.query.filter_by(name="event-3").one()
+        assert event.begins_at == datetime.datetime(2021, 6, 4)
+        assert event.area_name == "area-2"
+        assert Event.query.filter_by(name="event-0").one().begins_at is None
+        assert Event.query.filter(Event.area_id == None).count() == 0
+        assert [t.price for t in Ticket.query] == [5, 5, 5]
+        sold = Event.query.filter_by(name="event-1").one()
+        assert (sold.tickets_sold, sold.revenue) == (3, 15)
+        area = Area.query.filter_by(name="area-2").one()
+        assert (area.capacity, area.tickets_sold, area.revenue) == (120, 3, 15)
+        indexes = {i["name"] for i in inspect(db.engine).get_indexes("event")}
+        assert "ix_event_area_id_begins_at" in indexes
+
+        assert migrate() == []
+
+def test_migrate_to_target(app):
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["migrateDatabase", "--target", "2"])
+    assert result.exit_code == 0, result.output
+    assert "database at version 2" in result.output
+    result = runner.invoke(args=["migrateDatabase", "--status"])
+    assert result.output.splitlines()[1].startswith("applied")
+    assert result.output.splitlines()[2].startswith("pending")
+    with app.app_context():
+        assert "price" not in {c["name"] for c in inspect(db.engine).get_columns("ticket")}
+    result = runner.invoke(args=["migrateDatabase"])
+    assert result.exit_code == 0, result.output
+    client = app.test_client()
+    body = client.get("/api/areas/area-1/events/").get_json()
+    assert len(body["items"]) == 13
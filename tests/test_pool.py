@@ -0,0 +1,81 @@
+import json
+import jwt
+import os
+import sys
+import pytest
+import tempfile
+from sqlalchemy.exc import TimeoutError
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents import db
+from nearbyEvents.pool import TimedQueuePool
+from test_api import _populate_db
+
+@pytest.fixture
+def app():
+    db_fd, db_fname = tempfile.mkstemp()
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "DB_POOL_SIZE": 1,
+        "DB_POOL_MAX_OVERFLOW": 0,
+        "DB_POOL_TIMEOUT": 0.2,
+        "DB_POOL_PRE_PING": True,
+        "READ_ONLY_AUTOCOMMIT": True,
+        "JWT_KEYS": {"default": "secret"}
+    })
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+        db.session.remove()
+
+    yield app
+
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+def test_pool_options(app):
+    with app.app_context():
+        engine = db.get_engine(app)
+        assert isinstance(engine.pool, TimedQueuePool)
+        assert engine.pool.size() == 1
+        engine.dispose()
+        assert isinstance(engine.pool, TimedQueuePool)
+        assert engine.pool._pre_ping
+
+def test_checkout_metrics(app):
+    metrics = app.extensions["nearby_pool"]
+    with app.app_context():
+        engine = db.get_engine(app)
+        held = engine.connect()
+        with pytest.raises(TimeoutError):
+            engine.connect()
+        held.close()
+    assert metrics.timeouts == 1
+    assert metrics.slow_checkouts == 1
+    assert metrics.max_wait >= 0.2
+    client = app.test_client()
+    assert client.get("/admin/metrics/").status_code == 401
+    token = jwt.encode({"admin": True}, "secret").decode()
+    resp = client.get("/admin/metrics/", headers={"Authorization": "Bearer " + token})
+    body = json.loads(resp.data)
+    assert body["pool"]["timeouts"] == 1
+    assert body["pool"]["checkouts"] == metrics.checkouts
+
+def test_read_only_autocommit(app):
+    with app.test_request_context("/api/areas/", method="GET"):
+        assert db.session.autocommit
+        db.session.query(nearbyEvents.models.Area).all()
+        # The connection went back to the pool after the query
+        assert db.get_engine(app).pool.checkedout() == 0
+        db.session.remove()
+    with app.test_request_context("/api/areas/", method="POST"):
+        assert not db.session.autocommit
+        db.session.remove()
+    client = app.test_client()
+    assert client.get("/api/areas/test-area-1/").status_code == 200
+    assert client.post("/api/areas/", json={"name": "pooled"}).status_code == 201
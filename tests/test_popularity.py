@@ -0,0 +1,157 @@
+import datetime
+import json
+import os
+import sys
+import jwt
+import pytest
+import tempfile
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents import db
+from nearbyEvents.models import Event, Reservation, Ticket, User
+from nearbyEvents.popularity import CountMinSketch, TopK
+from nearbyEvents.sweeper import sweep_expired_reservations
+from test_api import _populate_db, _get_event_json
+
+@pytest.fixture
+def app():
+    db_fd, db_fname = tempfile.mkstemp()
+    pop_fd, pop_fname = tempfile.mkstemp()
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "JWT_KEYS": {"default": "secret"},
+        "ITEM_CACHE": True,
+        "POPULARITY_FILE": pop_fname
+    })
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+
+    yield app
+
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+    os.close(pop_fd)
+    os.unlink(pop_fname)
+
+def _admin(admin=True):
+    return {"Authorization": "Bearer " + jwt.encode({"admin": admin}, "secret").decode()}
+
+def test_sketch_and_top_k():
+    sketch = CountMinSketch(64, 4)
+    top = TopK(3)
+    counts = {"key-{}".format(i): 200 // (i + 1) for i in range(50)}
+    for key, count in counts.items():
+        for n in range(count):
+            top.add(key, sketch.add(key))
+    for key, count in counts.items():
+        assert sketch.estimate(key) >= count
+    assert [key for key, count in top.items()] == ["key-0", "key-1", "key-2"]
+    assert sketch.decay(0)
+    assert 100 <= sketch.estimate("key-0") < 200
+    top.rescore(sketch.estimate)
+    assert top.items()[0][1] == sketch.estimate("key-0")
+
+def test_admin_popular(app):
+    client = app.test_client()
+    for i in range(5):
+        assert client.get("/api/events/test-event-2/").status_code == 200
+    for i in range(2):
+        assert client.get("/api/areas/test-area-1/").status_code == 200
+    assert client.get("/admin/popular/").status_code == 401
+    assert client.get("/admin/popular/", headers=_admin(False)).status_code == 403
+    items = client.get("/admin/popular/", headers=_admin()).get_json()["items"]
+    assert items[0] == {"kind": "event", "id": 2, "count": 5, "cached": True}
+    assert items[1]["kind"] == "area"
+    items = client.get("/admin/popular/?kind=area&limit=1", headers=_admin()).get_json()["items"]
+    assert [(item["kind"], item["count"]) for item in items] == [("area", 2)]
+    assert client.get("/admin/popular/?limit=0", headers=_admin()).status_code == 400
+
+def test_item_cache_invalidation(app):
+    client = app.test_client()
+    cache = app.extensions["nearby_item_cache"]
+    first = client.get("/api/events/test-event-1/").data
+    with app.app_context():
+        # Changes that are not announced are not seen
+        db.session.execute(Event.__table__.update().values(max_tickets=1))
+        db.session.commit()
+    assert client.get("/api/events/id/1/").data == first
+    assert cache.hits == 1
+
+    valid = _get_event_json()
+    valid["name"] = "test-event-1"
+    valid["area_name"] = "test-area-2"
+    assert client.put("/api/events/test-event-1/", json=valid).status_code == 204
+    # The hot item is rendered again right after the change
+    app.extensions["nearby_cache_warmer"].flush()
+    assert cache.contains("event", 1)
+    body = client.get("/api/events/test-event-1/").get_json()
+    assert body["max_tickets"] == 1
+    assert body["@controls"]["nearby:area"]["href"] == "/api/areas/id/2/"
+
+    client.get("/api/events/test-event-3/")
+    # A change made by another worker drops all events, the hot ones are
+    # rendered again
+    app.extensions["nearby_epochs"]["event"].bump()
+    assert cache.get("event", item_id=1) is None
+    app.extensions["nearby_cache_warmer"].flush()
+    assert cache.contains("event", 1)
+    assert cache.contains("event", 3)
+    assert client.get("/api/events/no-such-event/").status_code == 404
+
+def test_warm_up_from_saved_list(app):
+    client = app.test_client()
+    for i in range(3):
+        client.get("/api/areas/test-area-3/")
+    popularity = app.extensions["nearby_popularity"]
+    popularity.save()
+    with open(app.config["POPULARITY_FILE"]) as f:
+        assert json.load(f)[0]["kind"] == "area"
+
+    fresh = nearbyEvents.create_app(dict(app.config, ITEM_CACHE_WARM=1))
+    with fresh.app_context():
+        for hook in fresh.extensions["nearby_warmup"]:
+            hook()
+    cache = fresh.extensions["nearby_item_cache"]
+    assert cache.contains("area", 3)
+    assert cache.warmed == 1
+
+def test_item_cache_by_id_after_change(app):
+    client = app.test_client()
+    assert client.get("/api/areas/id/1/").get_json()["name"] == "test-area-1"
+    assert client.get("/api/events/id/1/").get_json()["name"] == "test-event-1"
+    assert client.put("/api/areas/id/1/", json={"name": "renamed-area"}).status_code == 204
+    assert client.get("/api/areas/id/1/").get_json()["name"] == "renamed-area"
+    valid = _get_event_json()
+    valid["name"] = "renamed-event"
+    assert client.put("/api/events/id/1/", json=valid).status_code == 204
+    assert client.get("/api/events/id/1/").get_json()["name"] == "renamed-event"
+
+    assert client.get("/api/events/id/2/").status_code == 200
+    assert client.delete("/api/events/id/2/").status_code == 204
+    assert client.get("/api/events/id/2/").status_code == 404
+
+def test_item_cache_after_sale(app):
+    client = app.test_client()
+    assert client.get("/api/events/test-event-2/").get_json()["tickets_sold"] == 0
+    assert client.get("/api/areas/test-area-2/").get_json()["tickets_sold"] == 0
+    with app.app_context():
+        reservation = Reservation(paid=False, created_at=datetime.datetime.now() - datetime.timedelta(days=1))
+        reservation.for_event = Event.query.filter_by(name="test-event-2").one()
+        reservation.user_booked = User(first_name="a", last_name="b", birth_date=datetime.date(1990, 1, 1), email="a@b")
+        reservation.tickets.append(Ticket(type="basic"))
+        db.session.add(reservation)
+        db.session.commit()
+    assert client.get("/api/events/test-event-2/").get_json()["tickets_sold"] == 1
+    assert client.get("/api/areas/test-area-2/").get_json()["tickets_sold"] == 1
+
+    # Tickets released by the sweeper are announced too
+    with app.app_context():
+        assert sweep_expired_reservations(ttl=60).reservations == 1
+    assert client.get("/api/events/id/2/").get_json()["tickets_sold"] == 0
+    assert client.get("/api/areas/id/2/").get_json()["tickets_sold"] == 0
@@ -0,0 +1,71 @@
+import os
+import sys
+import jwt
+import pytest
+import tempfile
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents import db
+from test_api import _populate_db
+
+@pytest.fixture
+def app():
+    db_fd, db_fname = tempfile.mkstemp()
+    profile_dir = tempfile.mkdtemp()
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "JWT_KEYS": {"default": "secret"},
+        "PROFILE_KEY": "profile-key",
+        "PROFILE_DIR": profile_dir,
+        "PROFILE_MAX_FILES": 2
+    })
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+
+    yield app
+
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+    for name in os.listdir(profile_dir):
+        os.unlink(os.path.join(profile_dir, name))
+    os.rmdir(profile_dir)
+
+def _admin(admin=True):
+    return {"Authorization": "Bearer " + jwt.encode({"admin": admin}, "secret").decode()}
+
+def test_profile_on_request(app):
+    client = app.test_client()
+    assert "X-Profile-Id" not in client.get("/api/events/").headers
+    assert "X-Profile-Id" not in client.get("/api/events/", headers={"X-Profile": "wrong"}).headers
+    resp = client.get("/api/events/", headers={"X-Profile": "profile-key"})
+    assert resp.status_code == 200
+    name = resp.headers["X-Profile-Id"]
+    stacks = client.get("/admin/profiles/" + name, headers=_admin()).data.decode()
+    lines = stacks.splitlines()
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any("nearbyEvents.resources.event:get" in line for line in lines)
+    assert any("sqlalchemy" in line for line in lines)
+    assert any("json:dumps" in line for line in lines)
+    assert any("werkzeug.routing:match" in line for line in lines)
+    resp = client.get("/api/events/?profile=profile-key")
+    assert "X-Profile-Id" in resp.headers
+
+def test_profiles_are_admin_only(app):
+    client = app.test_client()
+    for i in range(3):
+        client.get("/api/areas/", headers={"X-Profile": "profile-key"})
+    assert client.get("/admin/profiles/").status_code == 401
+    assert client.get("/admin/profiles/", headers=_admin(False)).status_code == 403
+    resp = client.get("/admin/profiles/", headers=_admin())
+    assert len(resp.get_json()["profiles"]) == 2
+    assert client.get("/admin/profiles/..%2Fsecret.folded", headers=_admin()).status_code == 404
+
+def test_sampling(app):
+    app.wsgi_app.sample_rate = 1.0
+    assert "X-Profile-Id" in app.test_client().get("/api/areas/").headers
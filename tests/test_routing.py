@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+import pytest
+import tempfile
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents import db
+from nearbyEvents.routing import STICKY_COOKIE, sync_replicas
+from test_api import _populate_db, _get_area_json
+
+@pytest.fixture
+def app():
+    files = [tempfile.mkstemp() for i in range(3)]
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + files[0][1],
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "READ_REPLICAS": ["sqlite:///" + fname for fd, fname in files[1:]]
+    })
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+        sync_replicas(app)
+
+    yield app
+
+    db.session.remove()
+    for fd, fname in files:
+        os.close(fd)
+        os.unlink(fname)
+
+def _area_names(client):
+    body = json.loads(client.get("/api/areas/").data)
+    return [item["name"] for item in body["items"]]
+
+def test_reads_use_replicas(app):
+    writer = app.test_client()
+    resp = writer.post("/api/areas/", json=_get_area_json())
+    assert resp.status_code == 201
+    reader = app.test_client()
+    # Both replicas lag until they are synced
+    for i in range(2):
+        assert "extra-area-1" not in _area_names(reader)
+        assert reader.get("/api/areas/extra-area-1/").status_code == 404
+    assert sync_replicas(app) == ["replica-0", "replica-1"]
+    for i in range(2):
+        assert "extra-area-1" in _area_names(reader)
+        assert reader.get("/api/areas/extra-area-1/").status_code == 200
+
+def test_read_your_writes(app):
+    writer = app.test_client()
+    assert writer.get("/api/areas/").headers.get("Set-Cookie") is None
+    resp = writer.post("/api/areas/", json=_get_area_json())
+    assert STICKY_COOKIE in resp.headers["Set-Cookie"]
+    assert "extra-area-1" in _area_names(writer)
+    assert writer.get("/api/areas/extra-area-1/").status_code == 200
+    # Rejected writes do not make the client sticky
+    resp = app.test_client().post("/api/areas/", json=_get_area_json())
+    assert resp.status_code == 409
+    assert resp.headers.get("Set-Cookie") is None
+
+def test_sync_command(app):
+    app.test_client().post("/api/areas/", json=_get_area_json())
+    result = app.test_cli_runner().invoke(args=["syncReplicas"])
+    assert "Synced 2 replicas" in result.output
+    assert "extra-area-1" in _area_names(app.test_client())
@@ -0,0 +1,79 @@
+import os
+import sys
+import signal
+import socket
+import subprocess
+import pytest
+import tempfile
+import time
+import requests
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents.server import warm_up
+
+SERVER_SCRIPT = """
+import sys
+import nearbyEvents
+from nearbyEvents.server import Master
+app = nearbyEvents.create_app({{
+    "SQLALCHEMY_DATABASE_URI": "sqlite:///{db}",
+    "SQLALCHEMY_TRACK_MODIFICATIONS": False
+}})
+with app.app_context():
+    nearbyEvents.db.create_all()
+Master(app, "127.0.0.1", {port}, 2, graceful_timeout=5).run()
+"""
+
+@pytest.fixture
+def db_fname():
+    db_fd, db_fname = tempfile.mkstemp()
+    yield db_fname
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _wait_until_serving(url, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return requests.get(url, timeout=1)
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise AssertionError("server did not start")
+
+def test_warm_up(db_fname):
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False
+    })
+    primed = []
+    app.extensions["nearby_warmup"].append(lambda: primed.append(True))
+    warm_up(app)
+    assert primed == [True]
+    assert "serve" in app.cli.list_commands(None)
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_serve_reload_and_stop(db_fname):
+    port = _free_port()
+    url = "http://127.0.0.1:{}/api/areas/".format(port)
+    master = subprocess.Popen(
+        [sys.executable, "-c", SERVER_SCRIPT.format(db=db_fname, port=port)],
+        cwd=o_path
+    )
+    try:
+        assert _wait_until_serving(url).status_code == 200
+        master.send_signal(signal.SIGHUP)
+        for i in range(20):
+            assert requests.get(url, timeout=5).status_code == 200
+            time.sleep(0.05)
+        master.send_signal(signal.SIGTERM)
+        assert master.wait(timeout=10) == 0
+    finally:
+        if master.poll() is None:
+            master.kill()
@@ -0,0 +1,69 @@
+import os
+import sys
+import subprocess
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+from nearbyEvents.startup import profile_startup, parse_importtime
+
+# Seconds a new process may spend in importing the package and running
+# create_app on top of importing the frameworks it is built on
+STARTUP_MARGIN = 0.5
+LAZY_STARTUP_MARGIN = 0.35
+
+BASELINE_PROBE = """
+import time
+start = time.perf_counter()
+import flask, flask_restful, flask_sqlalchemy, sqlalchemy, jwt
+print(time.perf_counter() - start)
+"""
+
+# Only imported by the CLI commands, the backup endpoints and features that are off by default
+UNUSED_MODULES = [
+    "nearbyEvents.server", "nearbyEvents.migrations", "nearbyEvents.backup",
+    "nearbyEvents.limits", "nearbyEvents.profiling"
+]
+
+def _baseline():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", BASELINE_PROBE],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+def test_parse_importtime():
+    modules = parse_importtime(
+        "import time: self [us] | cumulative | imported package\n"
+        "import time:       299 |       1269 |   flask_cors.core\n"
+        "import time:      1223 |     255315 | nearbyEvents\n"
+    )
+    assert modules[0] == ("flask_cors.core", 1, 299, 1269)
+    assert modules[1] == ("nearbyEvents", 0, 1223, 255315)
+
+def test_startup_budget():
+    profile = profile_startup()
+    assert profile.seconds < _baseline() + STARTUP_MARGIN
+    names = [m.name for m in profile.modules]
+    assert "jsonschema" in names
+    for name in UNUSED_MODULES:
+        assert name not in names
+
+def test_lazy_startup_budget():
+    profile = profile_startup(lazy=True)
+    assert profile.seconds < _baseline() + LAZY_STARTUP_MARGIN
+    names = [m.name for m in profile.modules]
+    # Only needed once the first document is validated
+    assert "jsonschema" not in names
+    for name in UNUSED_MODULES:
+        assert name not in names
+
+def test_enabled_features_imported():
+    profile = profile_startup(config={
+        "SQLALCHEMY_DATABASE_URI": "sqlite://",
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "RATE_LIMIT": True,
+        "PROFILE_SAMPLE_RATE": 0.5
+    })
+    names = [m.name for m in profile.modules]
+    assert "nearbyEvents.limits" in names
+    assert "nearbyEvents.profiling" in names
@@ -0,0 +1,79 @@
+import json
+import os
+import sys
+import pytest
+import tempfile
+o_path = os.getcwd()
+sys.path.append(o_path)
+
+import nearbyEvents
+from nearbyEvents import db
+from test_api import _populate_db, _get_event_json
+
+@pytest.fixture
+def app():
+    db_fd, db_fname = tempfile.mkstemp()
+    trace_fd, trace_fname = tempfile.mkstemp()
+    app = nearbyEvents.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "TRACE_FILE": trace_fname
+    })
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+
+    yield app
+
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+    os.close(trace_fd)
+    os.unlink(trace_fname)
+
+def _spans(app):
+    app.extensions["nearby_tracer"].exporter.flush()
+    with open(app.config["TRACE_FILE"]) as f:
+        return [json.loads(line) for line in f]
+
+def test_request_spans(app):
+    resp = app.test_client().get("/api/areas/test-area-1/events/")
+    assert resp.status_code == 200
+    spans = _spans(app)
+    root = [s for s in spans if s.get("kind") == "SERVER"]
+    assert len(root) == 1
+    root = root[0]
+    assert root["name"] == "GET /api/areas/<area>/events/"
+    assert root["tags"]["http.status_code"] == "200"
+    assert resp.headers["traceresponse"] == "00-{}-{}-01".format(root["traceId"], root["id"])
+    assert {s["traceId"] for s in spans} == {root["traceId"]}
+    by_name = {s["name"]: s for s in spans}
+    resource = by_name["EventsByArea.get"]
+    assert resource["parentId"] == root["id"]
+    for name in ("sql SELECT", "mason.events_by_area_body", "json.dumps"):
+        assert by_name[name]["parentId"] == resource["id"]
+    assert "FROM area" in by_name["sql SELECT"]["tags"]["db.statement"]
+
+def test_validation_span(app):
+    resp = app.test_client().post("/api/events/", json=_get_event_json())
+    assert resp.status_code == 201
+    names = [s["name"] for s in _spans(app)]
+    assert "EventCollection.post" in names
+    assert "jsonschema.validate" in names
+    assert "sql INSERT" in names
+
+def test_trace_context(app):
+    client = app.test_client()
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    parent = "00f067aa0ba902b7"
+    resp = client.get("/api/areas/", headers={"traceparent": "00-{}-{}-01".format(trace_id, parent)})
+    assert resp.headers["traceresponse"].startswith("00-" + trace_id)
+    # Unsampled traces are propagated by the caller but not recorded
+    resp = client.get("/api/areas/", headers={"traceparent": "00-{}-{}-00".format("1" * 32, parent)})
+    assert "traceresponse" not in resp.headers
+    spans = _spans(app)
+    root = [s for s in spans if s.get("kind") == "SERVER"]
+    assert len(root) == 1
+    assert root[0]["traceId"] == trace_id
+    assert root[0]["parentId"] == parent